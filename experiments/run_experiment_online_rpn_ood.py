@@ -17,9 +17,10 @@ from mrcnn_modified.config import cfg
 
 from region_refiner import RegionRefiner
 
-from py_od_utils import computeFeatStatistics_torch, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor
+from py_od_utils import computeFeatStatistics_torch, load_feature_statistics, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor, load_regression_statistics
 
 import AccuracyEvaluator as ae
+from StreamingTestPipeline import StreamingTestPipeline
 
 
 parser = argparse.ArgumentParser()
@@ -36,6 +37,10 @@ parser.add_argument('--save_RPN_features', action='store_true', help='Save, in t
 parser.add_argument('--save_detector_features', action='store_true', help='Save, in the features directory (in the output directory), detector\'s features.')
 parser.add_argument('--load_RPN_features', action='store_true', help='Load, from the features directory (in the output directory), RPN features.')
 parser.add_argument('--load_detector_features', action='store_true', help='Load, from the features directory (in the output directory), detector\'s features.')
+parser.add_argument('--cache_backbone_features', action='store_true', help='Cache the backbone features of the training images extracted for the RPN, so that the detector\'s features are extracted without running the backbone again.')
+parser.add_argument('--backbone_cache_max_gb', action='store', type=float, default=16, help='Maximum size, in GB, of the backbone features cache. The features of the images that do not fit are computed again.')
+parser.add_argument('--backbone_cache_on_disk', action='store_true', help='Store the backbone features cache in a memory-mapped file in the output directory, instead of keeping it in RAM.')
+parser.add_argument('--streaming_test', action='store_true', help='Classify, refine and evaluate the proposals of each test image as soon as they are extracted, instead of extracting the features of the whole test set first.')
 
 
 args = parser.parse_args()
@@ -90,16 +95,26 @@ if not os.path.exists(output_dir):
 # Initialize feature extractor
 feature_extractor = FeatureExtractor(cfg_target_task, cfg_rpn, train_in_cpu=args.CPU)
 
+# The backbone features of the training images are cached only if they are computed by both the RPN and the detector
+if args.cache_backbone_features and not args.only_ood and not args.load_RPN_models and not args.load_detector_models and not args.load_RPN_features and not args.load_detector_features:
+    feature_extractor.enableBackboneCache(path=os.path.join(output_dir, 'backbone_cache.bin') if args.backbone_cache_on_disk else None,
+                                          max_bytes=int(args.backbone_cache_max_gb * 2**30))
+
 # Train RPN
 if not args.only_ood and not args.load_RPN_models:
     # Extract RPN features for the training set
     if not args.save_RPN_features and not args.load_RPN_features:
         negatives, positives, COXY = feature_extractor.extractRPNFeatures(is_train=True, output_dir=output_dir, save_features=args.save_RPN_features)
+        # Features statistics are accumulated during the extraction
+        stats_rpn = feature_extractor.feature_stats_rpn.compute()
     else:
         if args.save_RPN_features:
             feature_extractor.extractRPNFeatures(is_train=True, output_dir=output_dir, save_features=args.save_RPN_features)
         positives, negatives = load_features_classifier(features_dir = os.path.join(output_dir, 'features_RPN'))
-    stats_rpn = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU)
+        # Use the statistics saved with the features, if available
+        stats_rpn = load_feature_statistics(os.path.join(output_dir, 'features_RPN'))
+        if stats_rpn is None:
+            stats_rpn = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU)
 
     # RPN Region Classifier initialization
     classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path, is_rpn=True)
@@ -111,7 +126,10 @@ if not args.only_ood and not args.load_RPN_models:
     # RPN Region Refiner initialization
     region_refiner = RegionRefiner(cfg_online_path, is_rpn=True)
     if args.save_RPN_features or args.load_RPN_features:
-        COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_RPN'))
+        # The statistics of the regression examples are enough to train the refiner, if they were saved
+        COXY = load_regression_statistics(os.path.join(output_dir, 'features_RPN'), device='cpu' if args.CPU else 'cuda')
+        if COXY is None:
+            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_RPN'))
 
     # Train RPN region Refiner
     models_reg_rpn = region_refiner.trainRegionRefiner(normalize_COXY(COXY, stats_rpn, args.CPU), output_dir=output_dir)
@@ -155,11 +173,19 @@ else:
     # Extract detector features for the train set
     if not args.save_detector_features and not args.load_detector_features:
         negatives, positives, COXY = feature_extractor.extractFeatures(is_train=True, output_dir=output_dir, save_features=args.save_detector_features)
+        # Features statistics are accumulated during the extraction
+        stats = feature_extractor.feature_stats_detector.compute()
     else:
         if args.save_detector_features:
             feature_extractor.extractFeatures(is_train=True, output_dir=output_dir, save_features=args.save_detector_features)
         positives, negatives = load_features_classifier(features_dir = os.path.join(output_dir, 'features_detector'))
-    stats = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU)
+        # Use the statistics saved with the features, if available
+        stats = load_feature_statistics(os.path.join(output_dir, 'features_detector'))
+        if stats is None:
+            stats = computeFeatStatistics_torch(positives, negatives, features_dim=positives[0].size()[1], cpu_tensor=args.CPU)
+
+    # Backbone features are not needed anymore
+    feature_extractor.releaseBackboneCache()
 
     # Detector Region Classifier initialization
     classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path)
@@ -171,7 +197,10 @@ else:
     # Detector Region Refiner initialization
     region_refiner = RegionRefiner(cfg_online_path)
     if args.save_detector_features or args.load_detector_features:
-        COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
+        # The statistics of the regression examples are enough to train the refiner, if they were saved
+        COXY = load_regression_statistics(os.path.join(output_dir, 'features_detector'), device='cpu' if args.CPU else 'cuda')
+        if COXY is None:
+            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
     if args.normalize_features_regressor_detector:
         models = region_refiner.trainRegionRefiner(normalize_COXY(COXY, stats, args.CPU), output_dir=output_dir)
     else:
@@ -189,27 +218,49 @@ if args.save_detector_models:
     torch.save(stats, os.path.join(output_dir, 'stats_detector'))
 
 # Test models
-print('Extracting features for the test set')
-test_boxes = feature_extractor.extractFeatures(is_train=False, output_dir=output_dir)
-
-# Compute classification predictions
-print('Computing classification predictions')
-predictions = regionClassifier.testRegionClassifier(model, test_boxes)
-
-# Refine predictions with the region refiners
-print('Refining predictions with bounding box regressors')
-refined_predictions = region_refiner.predict(predictions, test_boxes, models=models, normalize_features=args.normalize_features_regressor_detector, stats=stats)
-
-# Test dataset creation for accuracy evaluation
-print('Computing test dataset for accuracy evaluation')
-cfg.merge_from_file(cfg_target_task)
-cfg.freeze()
-dataset = make_data_loader(cfg, is_train=False, is_distributed=False, is_target_task=True, icwt_21_objs=is_tabletop)
-
-# Detector Accuracy evaluator initialization
-print('Accuracy evaluator initialization')
-accuracy_evaluator = ae.AccuracyEvaluator(cfg_online_path, output_dir)
-
-# Compute accuracy
-print('Computing accuracy')
-result_reg = accuracy_evaluator.evaluate(dataset.dataset, refined_predictions, is_target_task=True, cls_agnostic_bbox_reg=False, icwt_21_objs=is_tabletop)
\ No newline at end of file
+if args.streaming_test:
+    # Test dataset creation for accuracy evaluation, leaving unchanged the global cfg cloned by the feature extractor
+    print('Computing test dataset for accuracy evaluation')
+    cfg_test = cfg.clone()
+    cfg_test.merge_from_file(cfg_target_task)
+    dataset = make_data_loader(cfg_test, is_train=False, is_distributed=False, is_target_task=True, icwt_21_objs=is_tabletop)
+
+    # Detector Accuracy evaluator initialization
+    print('Accuracy evaluator initialization')
+    accuracy_evaluator = ae.AccuracyEvaluator(cfg_online_path, output_dir)
+
+    # Predictions are computed and evaluated image by image, while the test features are extracted
+    print('Extracting features for the test set and computing predictions')
+    test_pipeline = StreamingTestPipeline(regionClassifier, model, region_refiner, models, accuracy_evaluator, dataset.dataset,
+                                          normalize_features_regressor=args.normalize_features_regressor_detector, stats=stats)
+    feature_extractor.extractFeatures(is_train=False, output_dir=output_dir, test_pipeline=test_pipeline)
+
+    # Compute accuracy
+    print('Computing accuracy')
+    result_reg = accuracy_evaluator.evaluate(dataset.dataset, test_pipeline.evaluator, is_target_task=True, cls_agnostic_bbox_reg=False, icwt_21_objs=is_tabletop)
+
+else:
+    print('Extracting features for the test set')
+    test_boxes = feature_extractor.extractFeatures(is_train=False, output_dir=output_dir)
+
+    # Compute classification predictions
+    print('Computing classification predictions')
+    predictions = regionClassifier.testRegionClassifier(model, test_boxes)
+
+    # Refine predictions with the region refiners
+    print('Refining predictions with bounding box regressors')
+    refined_predictions = region_refiner.predict(predictions, test_boxes, models=models, normalize_features=args.normalize_features_regressor_detector, stats=stats)
+
+    # Test dataset creation for accuracy evaluation
+    print('Computing test dataset for accuracy evaluation')
+    cfg.merge_from_file(cfg_target_task)
+    cfg.freeze()
+    dataset = make_data_loader(cfg, is_train=False, is_distributed=False, is_target_task=True, icwt_21_objs=is_tabletop)
+
+    # Detector Accuracy evaluator initialization
+    print('Accuracy evaluator initialization')
+    accuracy_evaluator = ae.AccuracyEvaluator(cfg_online_path, output_dir)
+
+    # Compute accuracy
+    print('Computing accuracy')
+    result_reg = accuracy_evaluator.evaluate(dataset.dataset, refined_predictions, is_target_task=True, cls_agnostic_bbox_reg=False, icwt_21_objs=is_tabletop)
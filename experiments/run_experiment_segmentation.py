@@ -15,7 +15,7 @@ from feature_extractor import FeatureExtractor
 from accuracy_evaluator import AccuracyEvaluator
 from region_refiner import RegionRefiner
 
-from py_od_utils import computeFeatStatistics_torch, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor, load_positives_from_COXY
+from py_od_utils import computeFeatStatistics_torch, load_feature_statistics, normalize_COXY, falkon_models_to_cuda, load_features_classifier, load_features_regressor, load_regression_statistics, load_positives_from_COXY
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--output_dir', action='store', type=str, default='online_segmentation_experiment_ycbv', help='Set experiment\'s output directory. Default directory is segmentation_experiment_ycbv.')
@@ -72,6 +72,8 @@ if not os.path.exists(output_dir):
 
 # Initialize feature extractor
 feature_extractor = FeatureExtractor(cfg_target_task, train_in_cpu=args.CPU)
+# Statistics of the segmentation features, if they are extracted and kept in memory
+feature_stats_segmentation = None
 
 # Load detector models if requested, else train them
 if args.load_detector_models:
@@ -83,6 +85,9 @@ else:
     # Extract detector features for the train set
     if not args.save_detector_features and not args.load_detector_features:
         negatives, positives, COXY, negatives_segmentation, positives_segmentation = feature_extractor.extractFeatures(is_train=True, output_dir=output_dir, save_features=args.save_detector_features, extract_features_segmentation=True, use_only_gt_positives_detection=args.use_only_gt_positives_detection)
+        # Features statistics are accumulated during the extraction
+        feature_stats_detector = feature_extractor.feature_stats_detector
+        feature_stats_segmentation = feature_extractor.feature_stats_segmentation
         del feature_extractor
         torch.cuda.empty_cache()
 
@@ -95,6 +100,7 @@ else:
             torch.cuda.empty_cache()
 
         if not args.use_only_gt_positives_detection:
+            # Regression examples are always kept by the extractor when positives are taken from them
             positives = load_positives_from_COXY(COXY)
 
         # Delete already used data
@@ -102,8 +108,7 @@ else:
             del COXY
             torch.cuda.empty_cache()
 
-        stats = computeFeatStatistics_torch(positives, negatives, features_dim=negatives[0][0].size()[1],
-                                            cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
+        stats = feature_stats_detector.compute(pos_fraction=pos_fraction_feat_stats)
 
         # Detector Region Classifier initialization
         classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path)
@@ -137,13 +142,17 @@ else:
         region_refiner = RegionRefiner(cfg_online_path)
         # Load COXY only if regressor features do not need to be normalized or if they are required to compute positives for classification
         if not args.normalize_features_regressor_detector or not args.use_only_gt_positives_detection:
-            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
-
-            # Features can be extracted in a device that does not correspond to the one used for training.
-            # Convert them to the proper device.
-            COXY['C'] = COXY['C'].to(training_device)
-            COXY['X'] = COXY['X'].to(training_device)
-            COXY['Y'] = COXY['Y'].to(training_device)
+            # The statistics of the regression examples are enough to train the refiner, if they were saved,
+            # while the positives for classification need the examples themselves
+            COXY = load_regression_statistics(os.path.join(output_dir, 'features_detector'), device=training_device) if args.use_only_gt_positives_detection else None
+            if COXY is None:
+                COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
+
+                # Features can be extracted in a device that does not correspond to the one used for training.
+                # Convert them to the proper device.
+                COXY['C'] = COXY['C'].to(training_device)
+                COXY['X'] = COXY['X'].to(training_device)
+                COXY['Y'] = COXY['Y'].to(training_device)
 
         # Train Detector Region Refiner if regressor features do not need to be normalized
         if not args.normalize_features_regressor_detector:
@@ -172,7 +181,10 @@ else:
             for j in range(len(negatives[i])):
                 negatives[i][j] = negatives[i][j].to(training_device)
 
-        stats = computeFeatStatistics_torch(positives, negatives, features_dim=negatives[0][0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
+        # Use the statistics saved with the features, if available
+        stats = load_feature_statistics(os.path.join(output_dir, 'features_detector'), pos_fraction=pos_fraction_feat_stats)
+        if stats is None:
+            stats = computeFeatStatistics_torch(positives, negatives, features_dim=negatives[0][0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
 
         # Detector Region Classifier initialization
         classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path)
@@ -186,13 +198,16 @@ else:
         torch.cuda.empty_cache()
 
         if args.normalize_features_regressor_detector and args.use_only_gt_positives_detection:
-            COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
+            # The statistics of the regression examples are enough to train the refiner, if they were saved
+            COXY = load_regression_statistics(os.path.join(output_dir, 'features_detector'), device=training_device)
+            if COXY is None:
+                COXY = load_features_regressor(features_dir=os.path.join(output_dir, 'features_detector'))
 
-            # Features can be extracted in a device that does not correspond to the one used for training.
-            # Convert them to the proper device.
-            COXY['C'] = COXY['C'].to(training_device)
-            COXY['X'] = COXY['X'].to(training_device)
-            COXY['Y'] = COXY['Y'].to(training_device)
+                # Features can be extracted in a device that does not correspond to the one used for training.
+                # Convert them to the proper device.
+                COXY['C'] = COXY['C'].to(training_device)
+                COXY['X'] = COXY['X'].to(training_device)
+                COXY['Y'] = COXY['Y'].to(training_device)
 
         # Train Detector Region Refiner if regressor features do not need to be normalized
         if args.normalize_features_regressor_detector:
@@ -221,7 +236,12 @@ if not args.load_segmentation_models:
     for i in range(len(positives_segmentation)):
         positives_segmentation[i] = positives_segmentation[i].to(training_device)
         negatives_segmentation[i] = [negatives_segmentation[i].to(training_device)]
-    stats_segm = computeFeatStatistics_torch(positives_segmentation, negatives_segmentation, features_dim=positives_segmentation[0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
+    if feature_stats_segmentation is not None:
+        stats_segm = feature_stats_segmentation.compute(pos_fraction=pos_fraction_feat_stats)
+    else:
+        stats_segm = load_feature_statistics(os.path.join(output_dir, 'features_segmentation'), pos_fraction=pos_fraction_feat_stats)
+    if stats_segm is None:
+        stats_segm = computeFeatStatistics_torch(positives_segmentation, negatives_segmentation, features_dim=positives_segmentation[0].size()[1], cpu_tensor=args.CPU, pos_fraction=pos_fraction_feat_stats)
     # Per-pixel classifier initialization
     classifier = falkon.FALKONWrapper(cfg_path=cfg_online_path, is_segmentation=True)
     regionClassifier = ocr.OnlineRegionClassifier(classifier, positives_segmentation, negatives_segmentation, stats_segm, cfg_path=cfg_online_path, is_segmentation=True)
@@ -2,6 +2,7 @@ import sys
 import os
 
 from mrcnn_modified.data.datasets.evaluation import evaluate
+from mrcnn_modified.data.datasets.evaluation.detection_eval import StreamingDetectionEvaluator
 basedir = os.path.dirname(__file__)
 sys.path.append(os.path.abspath(os.path.join(basedir, os.path.pardir)))
 
@@ -17,15 +18,19 @@ class AccuracyEvaluator():
         self.num_classes = cfg['NUM_CLASSES']
         self.output_folder = output_folder
 
+    def make_post_processor(self, cls_agnostic_bbox_reg=True):
+        return odp.OnlineDetectionPostProcessor(score_thresh=self.score_thresh, nms=self.nms,
+                                                detections_per_img=self.detections_per_img,
+                                                cls_agnostic_bbox_reg=cls_agnostic_bbox_reg)
+
     def evaluate(self, dataset, predictions, cls_agnostic_bbox_reg=True,
                  box_only=False, iou_types=("bbox",), expected_results=(), draw_preds=False,
                  expected_results_sigma_tol=4, is_target_task=False, icwt_21_objs=False):
         print('Evaluating predictions')
-        post_processor = odp.OnlineDetectionPostProcessor(score_thresh=self.score_thresh, nms=self.nms,
-                                                          detections_per_img=self.detections_per_img,
-                                                          cls_agnostic_bbox_reg=cls_agnostic_bbox_reg)
-
-        predictions = post_processor(predictions, self.num_classes)
+        # Streamed predictions (StreamingDetectionEvaluator) are already post-processed and evaluated
+        if not isinstance(predictions, StreamingDetectionEvaluator):
+            post_processor = self.make_post_processor(cls_agnostic_bbox_reg=cls_agnostic_bbox_reg)
+            predictions = post_processor(predictions, self.num_classes)
 
         extra_args = dict(
             box_only=box_only,
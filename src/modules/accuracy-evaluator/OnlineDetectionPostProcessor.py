@@ -1,9 +1,4 @@
 from mrcnn_modified.modeling.roi_heads.box_head.inference import PostProcessor
-import torch
-
-from maskrcnn_benchmark.structures.bounding_box import BoxList
-from maskrcnn_benchmark.structures.boxlist_ops import boxlist_nms
-from maskrcnn_benchmark.structures.boxlist_ops import cat_boxlist
 
 from py_od_utils import decode_boxes_detector
 
@@ -26,9 +21,10 @@ class OnlineDetectionPostProcessor(PostProcessor):
 
         refined_boxes = decode_boxes_detector(proposals, bbox_pred)
 
-        boxlist = self.prepare_boxlist(refined_boxes, cls_scores, proposals.size)
-        boxlist = boxlist.clip_to_image(remove_empty=False)
-        boxlist = self.filter_results(boxlist, num_classes)
+        if num_classes < 2:
+            return None
+        # Boxes are clipped to the image by filter_results_batch
+        boxlist = self.filter_results_batch([refined_boxes], [cls_scores], [proposals.size], num_classes)[0]
 
         return boxlist
 
@@ -36,44 +32,6 @@ class OnlineDetectionPostProcessor(PostProcessor):
         """Returns bounding-box detection results by thresholding on scores and
         applying non-maximum suppression (NMS).
         """
-        # unwrap the boxlist to avoid additional overhead.
-        # if we had multi-class NMS, we could perform this directly on the boxlist
-        boxes = boxlist.bbox.reshape(-1, num_classes * 4)
-        scores = boxlist.get_field("scores").reshape(-1, num_classes)
-
-        device = scores.device
-        result = []
-        # Apply threshold on detection probabilities and apply NMS
-        # Skip j = 0, because it's the background class
-        inds_all = scores > self.score_thresh
-        for j in range(1, num_classes):
-            inds = inds_all[:, j].nonzero().squeeze(1)
-            scores_j = scores[inds, j]
-            boxes_j = boxes[inds, j * 4: (j + 1) * 4]
-            boxlist_for_class = BoxList(boxes_j.to('cuda'), boxlist.size, mode="xyxy")
-            boxlist_for_class.add_field("scores", scores_j.to('cuda'))
-            boxlist_for_class = boxlist_nms(
-                boxlist_for_class, self.nms
-            )
-            num_labels = len(boxlist_for_class)
-            boxlist_for_class.add_field(
-                "labels", torch.full((num_labels,), j, dtype=torch.int64, device=device)
-            )
-            result.append(boxlist_for_class)
-
-        if not result:
+        if num_classes < 2:
             return None
-
-        result = cat_boxlist(result)
-        number_of_detections = len(result)
-
-        # Limit to max_per_image detections **over all classes**
-        if number_of_detections > self.detections_per_img > 0:
-            cls_scores = result.get_field("scores")
-            image_thresh, _ = torch.kthvalue(
-                cls_scores.cpu(), number_of_detections - self.detections_per_img + 1
-            )
-            keep = cls_scores >= image_thresh.item()
-            keep = torch.nonzero(keep).squeeze(1)
-            result = result[keep]
-        return result
+        return self.filter_results_batch([boxlist.bbox], [boxlist.get_field("scores")], [boxlist.size], num_classes)[0]
@@ -0,0 +1,37 @@
+import functools
+
+from mrcnn_modified.data.datasets.evaluation.detection_eval import StreamingDetectionEvaluator
+
+
+class StreamingTestPipeline():
+    """
+    Test pipeline that classifies, refines, post-processes and evaluates the proposals of each test image as
+    soon as their features are extracted (see ROIBoxHead.forward_test), instead of collecting the features of
+    the whole test set first. Features never leave the gpu and only the matches of the detections are kept,
+    so memory does not grow with the number of test images.
+    After the extraction, evaluator can be given to AccuracyEvaluator.evaluate in place of the predictions.
+    """
+
+    def __init__(self, region_classifier, classifier_models, region_refiner, regressor_models, accuracy_evaluator, dataset,
+                 normalize_features_regressor=False, stats=None, device='cuda'):
+        self.region_classifier = region_classifier
+        self.classifier_models = classifier_models
+        self.region_classifier.prepareTesting(self.classifier_models, device)
+        self.region_predictor = region_refiner.getPredictor(regressor_models)
+        self.normalize_features_regressor = normalize_features_regressor
+        self.stats = stats
+        self.num_classes = accuracy_evaluator.num_classes
+        # Boxes are refined for each class, so the post-processor is not class agnostic
+        self.post_processor = accuracy_evaluator.make_post_processor(cls_agnostic_bbox_reg=False)
+        get_groundtruth = None
+        if type(dataset).__name__ == 'YCBVideoDataset':
+            # Masks are not needed to evaluate the detections
+            get_groundtruth = functools.partial(dataset.get_groundtruth, with_masks=False)
+        self.evaluator = StreamingDetectionEvaluator(dataset, get_groundtruth=get_groundtruth)
+
+    def __call__(self, boxes, features, img_size):
+        # boxes (N x 4) and features (N x D) of the proposals of the next image of the dataset, gts excluded
+        scores = self.region_classifier.scoreFeatures(self.classifier_models, features)
+        refined_boxes = self.region_predictor.refine(boxes, features, img_size, normalize_features=self.normalize_features_regressor, stats=self.stats)
+        prediction = self.post_processor.filter_results_batch([refined_boxes], [scores], [tuple(img_size)], self.num_classes)[0]
+        self.evaluator.update(self.evaluator.num_images, prediction)
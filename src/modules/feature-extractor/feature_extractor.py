@@ -20,16 +20,35 @@ class FeatureExtractor(FeatureExtractorAbstract):
         self.stats_detector = None
         self.regions_post_nms = None
         self.train_in_cpu = train_in_cpu
+        # Statistics of the last extracted training features (FeatureStatistics)
+        self.feature_stats_rpn = None
+        self.feature_stats_detector = None
+        self.feature_stats_segmentation = None
+        # Cache of the backbone features of the training images, shared by the RPN and detector extractions
+        self.backbone_cache = None
+
+    def enableBackboneCache(self, path=None, max_bytes=None):
+        # Backbone features are kept in RAM, or in a memory-mapped file if path is given, up to max_bytes
+        from mrcnn_modified.utils.backbone_cache import BackboneFeatureCache
+        self.backbone_cache = BackboneFeatureCache(path=path, max_bytes=max_bytes)
+
+    def releaseBackboneCache(self):
+        if self.backbone_cache is not None:
+            self.backbone_cache.close()
+            self.backbone_cache = None
 
     def extractRPNFeatures(self, is_train, output_dir=None, save_features=False):
         from feature_extractor_RPN import FeatureExtractorRPN
         # call class to extract rpn features:
         feature_extractor = FeatureExtractorRPN(self.cfg_path_RPN)
+        feature_extractor.backbone_cache = self.backbone_cache
         features = feature_extractor(is_train, output_dir=output_dir, train_in_cpu=self.train_in_cpu, save_features=save_features)
+        if is_train:
+            self.feature_stats_rpn = feature_extractor.feature_stats
 
         return features
 
-    def extractFeatures(self, is_train, output_dir=None, save_features=False, extract_features_segmentation=False, use_only_gt_positives_detection=True):
+    def extractFeatures(self, is_train, output_dir=None, save_features=False, extract_features_segmentation=False, use_only_gt_positives_detection=True, test_pipeline=None):
         from feature_extractor_detector import FeatureExtractorDetector
         # call class to extract detector features:
         feature_extractor = FeatureExtractorDetector(self.cfg_path_target_task)
@@ -39,9 +58,14 @@ class FeatureExtractor(FeatureExtractorAbstract):
         feature_extractor.falkon_detector_models = self.falkon_detector_models
         feature_extractor.regressors_detector_models = self.regressors_detector_models
         feature_extractor.stats_detector = self.stats_detector
+        feature_extractor.test_pipeline = test_pipeline
+        feature_extractor.backbone_cache = self.backbone_cache
         if self.regions_post_nms is not None:
             feature_extractor.cfg.MODEL.RPN.POST_NMS_TOP_N_TEST = self.regions_post_nms
         features = feature_extractor(is_train, output_dir=output_dir, train_in_cpu=self.train_in_cpu, save_features=save_features, extract_features_segmentation=extract_features_segmentation, use_only_gt_positives_detection=use_only_gt_positives_detection)
+        if is_train:
+            self.feature_stats_detector = feature_extractor.feature_stats_detector
+            self.feature_stats_segmentation = feature_extractor.feature_stats_segmentation
 
         return features
 
@@ -22,7 +22,9 @@ from maskrcnn_benchmark.utils.logger import setup_logger
 from maskrcnn_benchmark.utils.miscellaneous import mkdir
 
 from mrcnn_modified.engine.feature_proposal_extractor import inference
-import copy
+from mrcnn_modified.utils.feature_statistics import STATS_FILE
+from mrcnn_modified.utils.regression_statistics import REGRESSION_STATS_FILE
+from mrcnn_modified.utils.backbone_cache import BackboneFeatureCache
 import logging
 # See if we can use apex.DistributedDataParallel instead of the torch default,
 # and enable mixed-precision via apex.amp
@@ -42,6 +44,11 @@ class FeatureExtractorRPN:
         self.cfg = cfg.clone()
         self.load_parameters()
 
+        # Statistics of the extracted features, available after the extraction of the training set
+        self.feature_stats = None
+        # Cache of the backbone features of the training images, shared with other extractors if set
+        self.backbone_cache = None
+
     def __call__(self, is_train, output_dir=None, train_in_cpu=False, save_features=False):
         self.cfg.TRAIN_FALKON_REGRESSORS_DEVICE = 'cpu' if train_in_cpu else 'cuda'
         self.cfg.SAVE_FEATURES_RPN = save_features
@@ -138,6 +145,11 @@ class FeatureExtractorRPN:
 
         data_loaders = make_data_loader(self.cfg, is_train=is_train, is_distributed=self.distributed, is_final_test=True, is_target_task=self.is_target_task, icwt_21_objs=self.icwt_21_objs)
 
+        # Backbone features are cached only for the training images
+        backbone_cache = self.backbone_cache if is_train else None
+        if backbone_cache is not None:
+            backbone_cache.bind(BackboneFeatureCache.make_key(self.cfg, is_train))
+
         for output_folder, dataset_name, data_loader in zip(output_folders, dataset_names, data_loaders):
             feat_extraction_time = inference(self.cfg,
                                              model,
@@ -150,6 +162,7 @@ class FeatureExtractorRPN:
                                              icwt_21_objs=self.icwt_21_objs,
                                              is_train = is_train,
                                              result_dir=result_dir,
+                                             backbone_cache=backbone_cache,
                                             )
 
             if result_dir and is_train:
@@ -159,42 +172,32 @@ class FeatureExtractorRPN:
             synchronize()
         logger = logging.getLogger("maskrcnn_benchmark")
         logger.handlers=[]
+        self.feature_stats = model.rpn.feature_stats
         if self.cfg.SAVE_FEATURES_RPN:
             # Save features still not saved
             for clss in model.rpn.anchors_ids:
                 # Save negatives batches
-                for batch in range(len(model.rpn.negatives[clss])):
-                    if model.rpn.negatives[clss][batch].size()[0] > 0:
-                        path_to_save = os.path.join(result_dir, 'features_RPN', 'negatives_cl_{}_batch_{}'.format(clss, batch))
-                        torch.save(model.rpn.negatives[clss][batch], path_to_save)
+                model.rpn.negatives.save_remaining(clss, os.path.join(result_dir, 'features_RPN', 'negatives_cl_{clss}_batch_{batch}'))
                 # If a class does not have positive examples, save an empty tensor
-                if model.rpn.positives[clss][0].size()[0] == 0 and len(model.rpn.positives[clss]) == 1:
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(clss, 0))
-                    torch.save(torch.empty((0, model.rpn.feat_size), device=model.rpn.negatives[clss][0].device), path_to_save)
-                else:
-                    for batch in range(len(model.rpn.positives[clss])):
-                        if model.rpn.positives[clss][batch].size()[0] > 0:
-                            path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(clss, batch))
-                            torch.save(model.rpn.positives[clss][batch], path_to_save)
-
-            for i in range(len(model.rpn.X)):
-                if model.rpn.X[i].size()[0] > 0:
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'reg_x_batch_{}'.format(i))
-                    torch.save(model.rpn.X[i], path_to_save)
-
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'reg_c_batch_{}'.format(i))
-                    torch.save(model.rpn.C[i], path_to_save)
-
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'reg_y_batch_{}'.format(i))
-                    torch.save(model.rpn.Y[i], path_to_save)
+                model.rpn.positives.save_remaining(clss, os.path.join(result_dir, 'features_RPN', 'positives_cl_{clss}_batch_{batch}'), save_empty=True)
+
+            for name, store in (('x', model.rpn.X), ('c', model.rpn.C), ('y', model.rpn.Y)):
+                store.save_remaining(0, os.path.join(result_dir, 'features_RPN', 'reg_' + name + '_batch_{batch}'))
+            # Wait for the batches still being written in background
+            model.rpn.feature_writer.close()
+            model.rpn.feature_stats.save(os.path.join(result_dir, 'features_RPN', STATS_FILE))
+            model.rpn.regression_stats.save(os.path.join(result_dir, 'features_RPN', REGRESSION_STATS_FILE))
             return
         else:
-            COXY = {'C': torch.cat(model.rpn.C),
-                    'O': model.rpn.O,
-                    'X': torch.cat(model.rpn.X),
-                    'Y': torch.cat(model.rpn.Y)
-                    }
-            for i in range(self.cfg.MINIBOOTSTRAP.RPN.NUM_CLASSES):
-                model.rpn.positives[i] = torch.cat(model.rpn.positives[i])
-
-            return copy.deepcopy(model.rpn.negatives), copy.deepcopy(model.rpn.positives), copy.deepcopy(COXY)
+            if model.rpn.keep_regression_examples:
+                COXY = {'C': model.rpn.C.cat(0),
+                        'O': model.rpn.O,
+                        'X': model.rpn.X.cat(0),
+                        'Y': model.rpn.Y.cat(0)
+                        }
+            else:
+                # The region refiner is trained from the statistics of the regression examples
+                COXY = model.rpn.regression_stats
+            positives = [model.rpn.positives.cat(i) for i in range(self.cfg.MINIBOOTSTRAP.RPN.NUM_CLASSES)]
+
+            return model.rpn.negatives.to_list(), positives, COXY
@@ -22,6 +22,9 @@ from maskrcnn_benchmark.utils.logger import setup_logger
 from maskrcnn_benchmark.utils.miscellaneous import mkdir
 
 from mrcnn_modified.engine.feature_proposal_extractor import inference
+from mrcnn_modified.utils.feature_statistics import STATS_FILE
+from mrcnn_modified.utils.regression_statistics import REGRESSION_STATS_FILE
+from mrcnn_modified.utils.backbone_cache import BackboneFeatureCache
 import copy
 import logging
 # See if we can use apex.DistributedDataParallel instead of the torch default,
@@ -45,6 +48,14 @@ class FeatureExtractorDetector:
         self.falkon_rpn_models = None
         self.regressors_rpn_models = None
         self.stats_rpn = None
+        # Pipeline that evaluates the test proposals as they are extracted, if set (see StreamingTestPipeline)
+        self.test_pipeline = None
+        # Cache of the backbone features of the training images, shared with other extractors if set
+        self.backbone_cache = None
+
+        # Statistics of the extracted features, available after the extraction of the training set
+        self.feature_stats_detector = None
+        self.feature_stats_segmentation = None
 
     def __call__(self, is_train, output_dir=None, train_in_cpu=False, save_features=False, extract_features_segmentation=False, use_only_gt_positives_detection=True):
         self.cfg.TRAIN_FALKON_REGRESSORS_DEVICE = 'cpu' if train_in_cpu else 'cuda'
@@ -137,6 +148,9 @@ class FeatureExtractorDetector:
         if self.stats_detector is not None:
             model.roi_heads.box.predictor.stats = self.stats_detector
 
+        if not is_train:
+            model.roi_heads.box.test_pipeline = self.test_pipeline
+
         if self.distributed:
             model = model.module
 
@@ -157,6 +171,11 @@ class FeatureExtractorDetector:
 
         data_loaders = make_data_loader(self.cfg, is_train=is_train, is_distributed=self.distributed, is_final_test=True, is_target_task=self.is_target_task, icwt_21_objs=self.icwt_21_objs)
 
+        # Backbone features are cached only for the training images
+        backbone_cache = self.backbone_cache if is_train else None
+        if backbone_cache is not None:
+            backbone_cache.bind(BackboneFeatureCache.make_key(self.cfg, is_train))
+
         for output_folder, dataset_name, data_loader in zip(output_folders, dataset_names, data_loaders):
             feat_extraction_time = inference(self.cfg,
                                              model,
@@ -169,6 +188,7 @@ class FeatureExtractorDetector:
                                              icwt_21_objs=self.icwt_21_objs,
                                              is_train = is_train,
                                              result_dir=result_dir,
+                                             backbone_cache=backbone_cache,
                                              extract_features_segmentation=extract_features_segmentation
                                             )
 
@@ -180,95 +200,57 @@ class FeatureExtractorDetector:
             if is_train:
                 logger = logging.getLogger("maskrcnn_benchmark")
                 logger.handlers=[]
+                self.feature_stats_detector = model.roi_heads.box.feature_stats
+                if extract_features_segmentation:
+                    self.feature_stats_segmentation = model.roi_heads.mask.feature_stats
 
                 if self.cfg.SAVE_FEATURES_DETECTOR:
                     # Save features still not saved
                     for clss in range(len(model.roi_heads.box.negatives)):
-                        for batch in range(len(model.roi_heads.box.negatives[clss])):
-                            if model.roi_heads.box.negatives[clss][batch].size()[0] > 0:
-                                path_to_save = os.path.join(result_dir, 'features_detector', 'negatives_cl_{}_batch_{}'.format(clss, batch))
-                                torch.save(model.roi_heads.box.negatives[clss][batch], path_to_save)
+                        model.roi_heads.box.negatives.save_remaining(clss, os.path.join(result_dir, 'features_detector', 'negatives_cl_{clss}_batch_{batch}'))
                         if use_only_gt_positives_detection:
                             # If a class does not have positive examples, save an empty tensor
-                            if model.roi_heads.box.positives[clss][0].size()[0] == 0 and len(model.roi_heads.box.positives[clss]) == 1:
-                                path_to_save = os.path.join(result_dir, 'features_detector', 'positives_cl_{}_batch_{}'.format(clss, 0))
-                                torch.save(torch.empty((0, model.roi_heads.box.feat_size), device=model.roi_heads.box.negatives[clss][0].device), path_to_save)
-                            else:
-                                for batch in range(len(model.roi_heads.box.positives[clss])):
-                                    if model.roi_heads.box.positives[clss][batch].size()[0] > 0:
-                                        path_to_save = os.path.join(result_dir, 'features_detector', 'positives_cl_{}_batch_{}'.format(clss, batch))
-                                        torch.save(model.roi_heads.box.positives[clss][batch], path_to_save)
+                            model.roi_heads.box.positives.save_remaining(clss, os.path.join(result_dir, 'features_detector', 'positives_cl_{clss}_batch_{batch}'), save_empty=True)
 
                         if extract_features_segmentation:
-                            # If a class does not have positive examples, save an empty tensor
-                            if model.roi_heads.mask.positives[clss][0].size()[0] == 0 and len(
-                                    model.roi_heads.mask.positives[clss]) == 1:
-                                path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                            'positives_cl_{}_batch_{}'.format(clss, 0))
-                                torch.save(torch.empty((0, model.roi_heads.mask.feat_size),
-                                                       device=model.roi_heads.mask.negatives[clss][0].device),
-                                           path_to_save)
-                            else:
-                                for batch in range(len(model.roi_heads.mask.positives[clss])):
-                                    if model.roi_heads.mask.positives[clss][batch].size()[0] > 0:
-                                        path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                                    'positives_cl_{}_batch_{}'.format(clss, batch))
-                                        torch.save(model.roi_heads.mask.positives[clss][batch], path_to_save)
-
-                            # If a class does not have positive examples, save an empty tensor
-                            if model.roi_heads.mask.negatives[clss][0].size()[0] == 0 and len(
-                                    model.roi_heads.mask.negatives[clss]) == 1:
-                                path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                            'negatives_cl_{}_batch_{}'.format(clss, 0))
-                                torch.save(torch.empty((0, model.roi_heads.mask.feat_size),
-                                                       device=model.roi_heads.mask.negatives[clss][0].device),
-                                           path_to_save)
-                            else:
-                                for batch in range(len(model.roi_heads.mask.negatives[clss])):
-                                    if model.roi_heads.mask.negatives[clss][batch].size()[0] > 0:
-                                        path_to_save = os.path.join(result_dir, 'features_segmentation',
-                                                                    'negatives_cl_{}_batch_{}'.format(clss, batch))
-                                        torch.save(model.roi_heads.mask.negatives[clss][batch], path_to_save)
-
-                    for i in range(len(model.roi_heads.box.X)):
-                        if model.roi_heads.box.X[i].size()[0] > 0:
-                            path_to_save = os.path.join(result_dir, 'features_detector', 'reg_x_batch_{}'.format(i))
-                            torch.save(model.roi_heads.box.X[i], path_to_save)
-
-                            path_to_save = os.path.join(result_dir, 'features_detector', 'reg_c_batch_{}'.format(i))
-                            torch.save(model.roi_heads.box.C[i], path_to_save)
-
-                            path_to_save = os.path.join(result_dir, 'features_detector', 'reg_y_batch_{}'.format(i))
-                            torch.save(model.roi_heads.box.Y[i], path_to_save)
+                            # If a class does not have positive or negative examples, save an empty tensor
+                            model.roi_heads.mask.positives.save_remaining(clss, os.path.join(result_dir, 'features_segmentation', 'positives_cl_{clss}_batch_{batch}'), save_empty=True)
+                            model.roi_heads.mask.negatives.save_remaining(clss, os.path.join(result_dir, 'features_segmentation', 'negatives_cl_{clss}_batch_{batch}'), save_empty=True)
+
+                    for name, store in (('x', model.roi_heads.box.X), ('c', model.roi_heads.box.C), ('y', model.roi_heads.box.Y)):
+                        store.save_remaining(0, os.path.join(result_dir, 'features_detector', 'reg_' + name + '_batch_{batch}'))
+                    # Wait for the batches still being written in background
+                    model.roi_heads.box.feature_writer.close()
+                    model.roi_heads.box.feature_stats.save(os.path.join(result_dir, 'features_detector', STATS_FILE))
+                    model.roi_heads.box.regression_stats.save(os.path.join(result_dir, 'features_detector', REGRESSION_STATS_FILE))
+                    if extract_features_segmentation:
+                        model.roi_heads.mask.feature_writer.close()
+                        model.roi_heads.mask.feature_stats.save(os.path.join(result_dir, 'features_segmentation', STATS_FILE))
                     return
                 else:
-                    COXY = {'C': torch.cat(model.roi_heads.box.C),
-                            'O': model.roi_heads.box.O,
-                            'X': torch.cat(model.roi_heads.box.X),
-                            'Y': torch.cat(model.roi_heads.box.Y)
-                            }
-                    for i in range(self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES):
-                        if use_only_gt_positives_detection:
-                            model.roi_heads.box.positives[i] = torch.cat(model.roi_heads.box.positives[i])
-                        if extract_features_segmentation:
-                            if self.cfg.SEGMENTATION.FEATURES_DEVICE == 'cpu':
-                                model.roi_heads.mask.negatives[i][len(model.roi_heads.mask.negatives[i])-1] = model.roi_heads.mask.negatives[i][len(model.roi_heads.mask.negatives[i])-1].to('cpu')
-                            model.roi_heads.mask.negatives[i] = torch.cat(model.roi_heads.mask.negatives[i])
-                            if self.cfg.SEGMENTATION.FEATURES_DEVICE == 'cpu':
-                                model.roi_heads.mask.positives[i][len(model.roi_heads.mask.positives[i])-1] = model.roi_heads.mask.positives[i][len(model.roi_heads.mask.positives[i])-1].to('cpu')
-                            model.roi_heads.mask.positives[i] = torch.cat(model.roi_heads.mask.positives[i])
+                    if model.roi_heads.box.keep_regression_examples:
+                        COXY = {'C': model.roi_heads.box.C.cat(0),
+                                'O': model.roi_heads.box.O,
+                                'X': model.roi_heads.box.X.cat(0),
+                                'Y': model.roi_heads.box.Y.cat(0)
+                                }
+                    else:
+                        # The region refiner is trained from the statistics of the regression examples
+                        COXY = model.roi_heads.box.regression_stats
+                    negatives = model.roi_heads.box.negatives.to_list()
+                    positives = None
+                    if use_only_gt_positives_detection:
+                        positives = [model.roi_heads.box.positives.cat(i) for i in range(self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES)]
                     if extract_features_segmentation:
-                        if use_only_gt_positives_detection:
-                            return copy.deepcopy(model.roi_heads.box.negatives), copy.deepcopy(model.roi_heads.box.positives), copy.deepcopy(COXY), copy.deepcopy(model.roi_heads.mask.negatives), copy.deepcopy(model.roi_heads.mask.positives)
-                        else:
-                            return copy.deepcopy(model.roi_heads.box.negatives), None, copy.deepcopy(COXY), copy.deepcopy(model.roi_heads.mask.negatives), copy.deepcopy(model.roi_heads.mask.positives)
-
+                        negatives_segmentation = [model.roi_heads.mask.negatives.cat(i) for i in range(self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES)]
+                        positives_segmentation = [model.roi_heads.mask.positives.cat(i) for i in range(self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES)]
+                        return negatives, positives, COXY, negatives_segmentation, positives_segmentation
                     else:
-                        if use_only_gt_positives_detection:
-                            return copy.deepcopy(model.roi_heads.box.negatives), copy.deepcopy(model.roi_heads.box.positives), copy.deepcopy(COXY)
-                        else:
-                            return copy.deepcopy(model.roi_heads.box.negatives), None, copy.deepcopy(COXY)
+                        return negatives, positives, COXY
             else:
                 logger = logging.getLogger("maskrcnn_benchmark")
                 logger.handlers=[]
+                if self.test_pipeline is not None:
+                    # Test proposals have already been evaluated
+                    return None
                 return copy.deepcopy(model.roi_heads.box.test_boxes)
@@ -238,6 +238,9 @@ _C.MODEL.ROI_MASK_HEAD.SHARE_BOX_FEATURE_EXTRACTOR = True
 # Whether or not resize and translate masks to the input image.
 _C.MODEL.ROI_MASK_HEAD.POSTPROCESS_MASKS = False
 _C.MODEL.ROI_MASK_HEAD.POSTPROCESS_MASKS_THRESHOLD = 0.5
+# Masks are predicted with the online classifiers only for the detections with a score greater or equal than this
+# threshold (e.g. the confidence threshold of the demos). The masks of the other detections are empty. 0 keeps all
+_C.MODEL.ROI_MASK_HEAD.SCORE_THRESHOLD = 0.0
 # Dilation
 _C.MODEL.ROI_MASK_HEAD.DILATION = 1
 # GN
@@ -497,6 +500,9 @@ _C.MINIBOOTSTRAP.DETECTOR.EXTRACT_ONLY_GT_POSITIVES = True
 # ---------------------------------------------------------------------------- #
 _C.REGRESSORS = CN()
 _C.REGRESSORS.MIN_OVERLAP = 0.6
+# Keep the regression examples (X, C and Y). If False, only their sufficient statistics are accumulated, which is
+# enough to train the region refiner, but positives cannot be taken from the regression examples
+_C.REGRESSORS.KEEP_EXAMPLES = True
 
 # ---------------------------------------------------------------------------- #
 # Segmentation parameters
@@ -506,6 +512,13 @@ _C.SEGMENTATION.BATCH_SIZE = 20000
 _C.SEGMENTATION.SAMPLING_FACTOR = 0.3
 _C.SEGMENTATION.FEATURES_DEVICE = 'cuda'
 
+# ---------------------------------------------------------------------------- #
+# Saved features parameters
+# ---------------------------------------------------------------------------- #
+_C.FEATURE_CACHE = CN()
+# Type used to store features on disk ('float32' or 'float16')
+_C.FEATURE_CACHE.DTYPE = 'float32'
+
 # ---------------------------------------------------------------------------- #
 # Evaluation parameters
 # ---------------------------------------------------------------------------- #
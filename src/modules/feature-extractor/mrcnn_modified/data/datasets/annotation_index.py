@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+
+# Increase when the content of the indices changes, so that old files are rebuilt
+INDEX_VERSION = 2
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return np.array([INDEX_VERSION, stat.st_size, int(stat.st_mtime)], dtype=np.int64)
+
+
+def load_or_build_index(index_path, source_path, build_index):
+    """
+    Load the annotation index of a split from index_path, building it with build_index (a function returning
+    a dict of numpy arrays) if it does not exist or if the split file source_path changed since it was built.
+    Delete the index file to rebuild it after changing the annotations.
+    """
+    stamp = _source_stamp(source_path)
+    if os.path.exists(index_path):
+        with np.load(index_path, allow_pickle=False) as f:
+            index = {k: f[k] for k in f.files}
+        if np.array_equal(index.get('stamp'), stamp):
+            return index
+    index = build_index()
+    index['stamp'] = stamp
+    try:
+        with open(index_path, 'wb') as f:
+            np.savez(f, **index)
+    except OSError:
+        # The index is only cached if the data directory is writable
+        print('Unable to save the annotation index in {}'.format(index_path))
+    return index
+
+
+def ragged_offsets(lengths):
+    # Offsets of the elements of each image in the flattened per-object arrays
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
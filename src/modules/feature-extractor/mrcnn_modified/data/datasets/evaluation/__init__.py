@@ -11,7 +11,8 @@ def evaluate(dataset, predictions, output_folder, **kwargs):
     Args:
         dataset: Dataset object
         predictions(list[BoxList]): each item in the list represents the
-            prediction results for one image.
+            prediction results for one image. For iCubWorld and YCB-Video, it can also
+            be a StreamingDetectionEvaluator already updated with the predictions.
         output_folder: output folder, to save evaluation files or results.
         **kwargs: other args.
     Returns:
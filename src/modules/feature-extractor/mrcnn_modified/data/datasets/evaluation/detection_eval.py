@@ -0,0 +1,145 @@
+import numpy as np
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou
+
+
+class _Buffer():
+    # Preallocated array whose capacity is doubled when it is full
+    def __init__(self, item_shape, dtype, capacity=1024):
+        self.data = np.empty((capacity,) + tuple(item_shape), dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        n = len(values)
+        if self.size + n > len(self.data):
+            data = np.empty((max(2 * len(self.data), self.size + n),) + self.data.shape[1:], dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:self.size + n] = values
+        self.size += n
+
+    def view(self):
+        return self.data[:self.size]
+
+
+class StreamingDetectionEvaluator():
+    """
+    Incremental version of the PASCAL VOC precision and recall computation of calc_detection_icw_prec_rec
+    and calc_detection_ycbv_prec_rec. Predictions are added one image at a time with update and only the
+    score, the class and the match (1 true positive, 0 false positive, -1 difficult) of each detection,
+    for each IoU threshold, are kept, so predictions can be discarded as soon as they are evaluated.
+    Precision and recall of the images seen so far are given by prec_rec.
+    Ground truths are read with get_groundtruth (by default dataset.get_groundtruth).
+    """
+
+    def __init__(self, dataset, iou_thresholds=(0.5,), get_groundtruth=None):
+        self.dataset = dataset
+        self.iou_thresholds = tuple(iou_thresholds)
+        self.get_groundtruth = dataset.get_groundtruth if get_groundtruth is None else get_groundtruth
+        self.num_images = 0
+        # Number of non-difficult ground truths of each class and classes seen in predictions or ground truths
+        self.n_pos = np.zeros(0, dtype=np.int64)
+        self.seen = np.zeros(0, dtype=bool)
+        self.labels = _Buffer((), np.int64)
+        self.scores = _Buffer((), np.float32)
+        self.matches = _Buffer((len(self.iou_thresholds),), np.int8)
+
+    def _add_classes(self, num_classes):
+        if num_classes > len(self.n_pos):
+            self.n_pos = np.concatenate((self.n_pos, np.zeros(num_classes - len(self.n_pos), dtype=np.int64)))
+            self.seen = np.concatenate((self.seen, np.zeros(num_classes - len(self.seen), dtype=bool)))
+
+    def update(self, image_id, prediction):
+        """
+        Evaluate the prediction of an image. Returns the prediction, resized to the image, and the ground truth.
+        """
+        if isinstance(prediction, list):
+            if len(prediction) == 1:
+                prediction = prediction[0]
+        img_info = self.dataset.get_img_info(image_id)
+        prediction = prediction.resize((img_info["width"], img_info["height"]))
+        gt_boxlist = self.get_groundtruth(image_id)
+        self.num_images += 1
+
+        pred_bbox = prediction.bbox.to('cpu').numpy()
+        pred_label = prediction.get_field("labels").to('cpu').numpy().astype(np.int64)
+        pred_score = prediction.get_field("scores").to('cpu').numpy()
+        gt_bbox = gt_boxlist.bbox.to('cpu').numpy()
+        gt_label = gt_boxlist.get_field("labels").to('cpu').numpy().astype(np.int64)
+        gt_difficult = gt_boxlist.get_field("difficult").to('cpu').numpy().astype(bool)
+
+        labels = np.concatenate((pred_label, gt_label))
+        if len(labels) == 0:
+            return prediction, gt_boxlist
+        self._add_classes(labels.max() + 1)
+        self.seen[labels] = True
+        self.n_pos += np.bincount(gt_label[np.logical_not(gt_difficult)], minlength=len(self.n_pos))
+        if len(pred_bbox) == 0:
+            return prediction, gt_boxlist
+
+        # Predictions grouped by class and sorted by score, as done class by class in calc_detection_icw_prec_rec
+        order = np.lexsort((pred_score, pred_label))[::-1]
+        pred_bbox, pred_label, pred_score = pred_bbox[order], pred_label[order], pred_score[order]
+
+        matches = np.zeros((len(pred_bbox), len(self.iou_thresholds)), dtype=np.int8)
+        if len(gt_bbox) > 0:
+            # VOC evaluation follows integer typed bounding boxes.
+            pred_bbox = pred_bbox.copy()
+            pred_bbox[:, 2:] += 1
+            gt_bbox = gt_bbox.copy()
+            gt_bbox[:, 2:] += 1
+            iou = boxlist_iou(
+                BoxList(pred_bbox, gt_boxlist.size),
+                BoxList(gt_bbox, gt_boxlist.size),
+            ).numpy()
+            # Predictions can only be assigned to ground truths of their class
+            iou[pred_label[:, None] != gt_label[None, :]] = -1
+            best = iou.argmax(axis=1)
+            # -1 if there is no matching ground truth, for each threshold
+            gt_index = np.where(iou.max(axis=1)[:, None] >= np.array(self.iou_thresholds)[None, :], best[:, None], -1)
+
+            # Only the first prediction assigned to a ground truth is a true positive. Ground truths of different
+            # thresholds are made distinct, so that the first assignments of all the thresholds are found at once
+            keys = (gt_index + np.arange(len(self.iou_thresholds)) * len(gt_bbox)).T.ravel()
+            assigned = gt_index.T.ravel() >= 0
+            first = np.zeros(len(keys), dtype=bool)
+            _, first_pos = np.unique(keys[assigned], return_index=True)
+            first[np.flatnonzero(assigned)[first_pos]] = True
+            matches[first.reshape(len(self.iou_thresholds), -1).T] = 1
+            matches[(gt_index >= 0) & gt_difficult[np.maximum(gt_index, 0)]] = -1
+
+        self.labels.extend(pred_label)
+        self.scores.extend(pred_score)
+        self.matches.extend(matches)
+        return prediction, gt_boxlist
+
+    def prec_rec(self):
+        """
+        Precision and recall of each class, as returned by calc_detection_icw_prec_rec, for each IoU threshold.
+        """
+        classes = np.flatnonzero(self.seen)
+        if len(classes) == 0:
+            print("Returning precision and recall = 0")
+            return [([None], [None]) for _ in self.iou_thresholds]
+
+        n_fg_class = classes.max() + 1
+        results = [([None] * n_fg_class, [None] * n_fg_class) for _ in self.iou_thresholds]
+        labels = self.labels.view()
+        scores = self.scores.view()
+        matches = self.matches.view()
+        for l in classes:
+            index_l = np.flatnonzero(labels == l)
+            order = scores[index_l].argsort()[::-1]
+            for t, (prec, rec) in enumerate(results):
+                match_l = matches[index_l[order], t]
+
+                tp = np.cumsum(match_l == 1)
+                fp = np.cumsum(match_l == 0)
+
+                # If an element of fp + tp is 0,
+                # the corresponding element of prec[l] is nan.
+                prec[l] = tp / (fp + tp)
+                # If n_pos[l] is 0, rec[l] is None.
+                if self.n_pos[l] > 0:
+                    rec[l] = tp / self.n_pos[l]
+        return results
@@ -7,6 +7,7 @@ from collections import defaultdict
 import numpy as np
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou
+from ..detection_eval import StreamingDetectionEvaluator
 
 import cv2
 import torch
@@ -148,38 +149,26 @@ def draw_preds_icw(dataset, image_id, pred, gt, output_folder):
 
 def do_icw_evaluation(dataset, predictions, output_folder, draw_preds, logger, iou_thresholds=(0.5,), use_07_metric=True, is_target_task=False, icwt_21_objs=False):
 
-    pred_boxlists = []
-    gt_boxlists = []
-    for image_id, prediction in enumerate(predictions):
-
-        img_info = dataset.get_img_info(image_id)
-
-        if len(prediction) == 0:
-            logger.info("No predictions for image: {}".format(image_id))
-            #continue
+    if isinstance(predictions, StreamingDetectionEvaluator):
+        # Predictions have already been evaluated image by image
+        evaluator = predictions
+    else:
+        evaluator = StreamingDetectionEvaluator(dataset, iou_thresholds=iou_thresholds)
+        for image_id, prediction in enumerate(predictions):
 
-        image_width = img_info["width"]
-        image_height = img_info["height"]
-        if isinstance(prediction, list):
-            if len(prediction) == 1:
-                prediction = prediction[0]
-        prediction = prediction.resize((image_width, image_height))
-        pred_boxlists.append(prediction)
+            if len(prediction) == 0:
+                logger.info("No predictions for image: {}".format(image_id))
+                #continue
 
-        gt_boxlist = dataset.get_groundtruth(image_id)
-        gt_boxlists.append(gt_boxlist)
+            prediction, gt_boxlist = evaluator.update(image_id, prediction)
 
-        if draw_preds:
-            draw_preds_icw(dataset, image_id, prediction, gt_boxlist, output_folder)
+            if draw_preds:
+                draw_preds_icw(dataset, image_id, prediction, gt_boxlist, output_folder)
 
-    for iou_thresh in iou_thresholds:
+    for iou_thresh, (prec, rec) in zip(evaluator.iou_thresholds, evaluator.prec_rec()):
 
-        result = eval_detection_icw(
-            pred_boxlists=pred_boxlists,
-            gt_boxlists=gt_boxlists,
-            iou_thresh=iou_thresh,
-            use_07_metric=use_07_metric,
-        )
+        ap = calc_detection_icw_ap(prec, rec, use_07_metric=use_07_metric)
+        result = {"ap": ap, "map": np.nanmean(ap)}
 
         result_str = "Detection mAP{}: {:.4f}\n\n".format(int(iou_thresh*100), result["map"])
         for i, ap in enumerate(result["ap"]):
@@ -3,6 +3,7 @@
 from __future__ import division
 
 import os
+import functools
 from collections import defaultdict
 import numpy as np
 from maskrcnn_benchmark.structures.bounding_box import BoxList
@@ -10,6 +11,7 @@ from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou
 from maskrcnn_benchmark.structures.segmentation_mask import SegmentationMask
 from mrcnn_modified.modeling.roi_heads.mask_head.inference import Masker
 from py_od_utils import mask_iou
+from ..detection_eval import StreamingDetectionEvaluator
 
 from PIL import Image
 import cv2
@@ -154,34 +156,32 @@ def do_ycbv_evaluation(dataset, predictions, output_folder, draw_preds, logger,
 
     pred_boxlists = []
     gt_boxlists = []
-    for image_id, prediction in enumerate(predictions):
-
-        img_info = dataset.get_img_info(image_id)
-
-        if len(prediction) == 0:
-            logger.info("No predictions for image: {}".format(image_id))
+    if isinstance(predictions, StreamingDetectionEvaluator):
+        # Predictions have already been evaluated image by image and they are not available for segmentation
+        evaluator = predictions
+        if evaluate_segmentation:
+            logger.warning("Segmentation can't be evaluated on streamed predictions, ignored.")
+            evaluate_segmentation = False
+    else:
+        # Masks are loaded only if they are evaluated
+        get_groundtruth = dataset.get_groundtruth if evaluate_segmentation else functools.partial(dataset.get_groundtruth, with_masks=False)
+        evaluator = StreamingDetectionEvaluator(dataset, iou_thresholds=iou_thresholds, get_groundtruth=get_groundtruth)
+        for image_id, prediction in enumerate(predictions):
 
-        image_width = img_info["width"]
-        image_height = img_info["height"]
-        if isinstance(prediction, list):
-            if len(prediction) == 1:
-                prediction = prediction[0]
-        prediction = prediction.resize((image_width, image_height))
-        pred_boxlists.append(prediction)
+            if len(prediction) == 0:
+                logger.info("No predictions for image: {}".format(image_id))
 
-        gt_boxlist = dataset.get_groundtruth(image_id)
-        gt_boxlists.append(gt_boxlist)
+            prediction, gt_boxlist = evaluator.update(image_id, prediction)
+            if evaluate_segmentation:
+                pred_boxlists.append(prediction)
+                gt_boxlists.append(gt_boxlist)
 
-        if draw_preds:
-            draw_preds_ycbv(dataset, image_id, prediction, gt_boxlist, output_folder)
+            if draw_preds:
+                draw_preds_ycbv(dataset, image_id, prediction, gt_boxlist, output_folder)
 
-    for iou_thresh in iou_thresholds:
-        result = eval_detection_ycbv(
-            pred_boxlists=pred_boxlists,
-            gt_boxlists=gt_boxlists,
-            iou_thresh=iou_thresh,
-            use_07_metric=use_07_metric,
-        )
+    for iou_thresh, (prec, rec) in zip(evaluator.iou_thresholds, evaluator.prec_rec()):
+        ap = calc_detection_ycbv_ap(prec, rec, use_07_metric=use_07_metric)
+        result = {"ap": ap, "map": np.nanmean(ap)}
 
         result_str = "Detection mAP{}: {:.4f}\n\n".format(int(iou_thresh*100), result["map"])
         for i, ap in enumerate(result["ap"]):
@@ -450,39 +450,43 @@ def calc_segmentation_voc_prec_rec(gt_boxlists, pred_boxlists, iou_thresh=0.5):
             # in the image, as defined by the bounding boxes
             masks = pred_boxlist.get_field("mask")
             # always single image is passed at a time
-            pred_masks = masker([masks], [pred_boxlist])[0].numpy().squeeze(1)
+            pred_masks = masker([masks], [pred_boxlist])[0].cpu().numpy().squeeze(1)
         else:
             pred_masks = np.asarray([])
 
+        # IoUs between all the predicted and ground truth masks of the image, computed once for all the classes
+        if len(pred_masks) > 0 and len(gt_masks) > 0:
+            iou_all = mask_iou(pred_masks, gt_masks)
+
         for l in np.unique(np.concatenate((pred_label, gt_label)).astype(int)):
             pred_mask_l = pred_label == l
-            pred_masks_l = pred_masks[pred_mask_l]
+            pred_index_l = np.flatnonzero(pred_mask_l)
 
             pred_score_l = pred_score[pred_mask_l]
             # sort by score
             order = pred_score_l.argsort()[::-1]
-            pred_masks_l = pred_masks_l[order]
+            pred_index_l = pred_index_l[order]
             pred_score_l = pred_score_l[order]
 
             gt_keep_l = gt_label == l
-            gt_masks_l = gt_masks[gt_keep_l]
+            gt_index_l = np.flatnonzero(gt_keep_l)
 
             n_pos[l] += gt_keep_l.sum()
             score[l].extend(pred_score_l)
 
-            if len(pred_masks_l) == 0:
+            if len(pred_index_l) == 0:
                 continue
-            if len(gt_masks_l) == 0:
-                match[l].extend((0,) * pred_masks_l.shape[0])
+            if len(gt_index_l) == 0:
+                match[l].extend((0,) * pred_index_l.shape[0])
                 continue
 
-            iou = mask_iou(pred_masks_l, gt_masks_l)
+            iou = iou_all[np.ix_(pred_index_l, gt_index_l)]
             gt_index = iou.argmax(axis=1)
             # set -1 if there is no matching ground truth
             gt_index[iou.max(axis=1) < iou_thresh] = -1
             del iou
 
-            selec = np.zeros(gt_masks_l.shape[0], dtype=bool)
+            selec = np.zeros(gt_index_l.shape[0], dtype=bool)
             for gt_idx in gt_index:
                 if gt_idx >= 0:
                     if not selec[gt_idx]:
@@ -1,5 +1,6 @@
 import os
 
+import numpy as np
 import torch
 import torch.utils.data
 from PIL import Image
@@ -13,6 +14,8 @@ else:
 
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 
+from .annotation_index import load_or_build_index, ragged_offsets
+
 
 def _has_only_empty_bbox(anno):
     try:
@@ -135,9 +138,12 @@ class iCubWorldDataset(torch.utils.data.Dataset):
                 
         self._imgsetpath = os.path.join(self.root, "ImageSets", self.image_set, self.split + ".txt")
 
-        with open(self._imgsetpath) as f:
-            self.ids = f.readlines()
-        self.ids = [x.strip("\n") for x in self.ids]
+        # Annotations of all the images of the split, parsed once and saved next to the split file
+        self.annotation_index = load_or_build_index(os.path.join(self.root, "ImageSets", self.image_set, self.split + "_index.npz"),
+                                                    self._imgsetpath, self._build_annotation_index)
+        self.ids = [str(img_id) for img_id in self.annotation_index['ids']]
+        # Position of each image in the annotation index
+        self.index_pos = list(range(len(self.ids)))
 
         if 'ycbv' in data_dir:
             cls = iCubWorldDataset.CLASSES_YCBV_IN_HAND
@@ -157,14 +163,16 @@ class iCubWorldDataset(torch.utils.data.Dataset):
         remove_images_without_annotations = True
         if remove_images_without_annotations:
             ids = []
-            for img_id in self.ids:
-                anno = ET.parse(self._annopath % img_id).getroot()
-                anno = self._preprocess_annotation(anno)
+            index_pos = []
+            for pos, img_id in enumerate(self.ids):
+                anno = self._preprocess_annotation(pos)
                 if has_valid_annotation(anno):
                     ids.append(img_id)
+                    index_pos.append(pos)
                 else:
                     print("Image id {} doesn't have annotations!".format(img_id))
             self.ids = ids
+            self.index_pos = index_pos
 
         self.id_to_img_map = {k: v for k, v in enumerate(self.ids)}
 
@@ -187,9 +195,7 @@ class iCubWorldDataset(torch.utils.data.Dataset):
         return len(self.ids)
 
     def get_groundtruth(self, index):
-        img_id = self.ids[index]
-        anno = ET.parse(self._annopath % img_id).getroot()
-        anno = self._preprocess_annotation(anno)
+        anno = self._preprocess_annotation(self.index_pos[index])
 
         height, width = anno["im_info"]
 
@@ -198,55 +204,80 @@ class iCubWorldDataset(torch.utils.data.Dataset):
         target.add_field("difficult", anno["difficult"])
         return target
 
-    def _preprocess_annotation(self, target):
+    def _build_annotation_index(self):
+        with open(self._imgsetpath) as f:
+            ids = [x.strip("\n") for x in f.readlines()]
+        heights = []
+        widths = []
+        has_mask = []
+        num_objects = []
+        names = []
         boxes = []
-        gt_classes = []
-        difficult_boxes = []
-        masks = []
+        difficult = []
+        for img_id in ids:
+            anno = ET.parse(self._annopath % img_id).getroot()
+            size = anno.find("size")
+            heights.append(int(size.find("height").text))
+            widths.append(int(size.find("width").text))
+            has_mask.append(os.path.exists(self._maskpath % img_id))
+            objects = list(anno.iter("object"))
+            num_objects.append(len(objects))
+            for obj in objects:
+                # Objects without name or difficult flag are kept in the index (with an empty name and -1 as
+                # difficult flag), since they are handled differently by the dataset and by the engines
+                name = obj.find("name")
+                names.append(name.text if name is not None and name.text is not None else "")
+                try:
+                    difficult.append(int(int(obj.find("difficult").text) == 1))
+                except:
+                    difficult.append(-1)
+                bb = obj.find("bndbox")
+                boxes.append([float(bb.find(k).text) for k in ("xmin", "ymin", "xmax", "ymax")])
+
+        return {
+            "ids": np.array(ids, dtype=np.str_),
+            "heights": np.array(heights, dtype=np.int32),
+            "widths": np.array(widths, dtype=np.int32),
+            "has_mask": np.array(has_mask, dtype=np.bool_),
+            "offsets": ragged_offsets(num_objects),
+            "names": np.array(names, dtype=np.str_),
+            "boxes": np.array(boxes, dtype=np.float32).reshape(-1, 4),
+            "difficult": np.array(difficult, dtype=np.int8),
+        }
+
+    def get_objects(self, index):
+        # Names, boxes (as in the annotation file) and difficult flags (-1 if missing) of all the objects of an image
+        pos = self.index_pos[index]
+        start, end = self.annotation_index["offsets"][pos], self.annotation_index["offsets"][pos + 1]
+        return self.annotation_index["names"][start:end], self.annotation_index["boxes"][start:end], self.annotation_index["difficult"][start:end]
+
+    def has_mask(self, index):
+        return bool(self.annotation_index["has_mask"][self.index_pos[index]])
+
+    def _preprocess_annotation(self, pos):
         TO_REMOVE = 1
-        
-        for obj in target.iter("object"):
-            try:
-                difficult = int(obj.find("difficult").text) == 1
-            except:
-                continue
-            if not self.keep_difficult and difficult:
-                continue
-            name = obj.find("name").text.lower().strip()
-            bb = obj.find("bndbox")
-            # Make pixel indexes 0-based
-            # Refer to "https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/datasets/pascal_voc.py#L208-L211"
-            box = [
-                bb.find("xmin").text, 
-                bb.find("ymin").text, 
-                bb.find("xmax").text, 
-                bb.find("ymax").text,
-            ]
-            bndbox = tuple(
-                map(lambda x: x - TO_REMOVE, list(map(int, box)))          
-            )
-
-            boxes.append(bndbox)
-            gt_classes.append(self.class_to_ind[name])
-            difficult_boxes.append(difficult)
-
-        size = target.find("size")
-        im_info = tuple(map(int, (size.find("height").text, size.find("width").text)))
+        start, end = self.annotation_index["offsets"][pos], self.annotation_index["offsets"][pos + 1]
+        difficult = self.annotation_index["difficult"][start:end]
+        # Objects without the difficult flag are skipped
+        keep = difficult >= 0
+        if not self.keep_difficult:
+            keep &= difficult != 1
+        names = self.annotation_index["names"][start:end][keep]
+        # Make pixel indexes 0-based
+        # Refer to "https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/datasets/pascal_voc.py#L208-L211"
+        boxes = self.annotation_index["boxes"][start:end][keep] - TO_REMOVE
 
         res = {
-            "boxes": torch.tensor(boxes, dtype=torch.float32),
-            "labels": torch.tensor(gt_classes),
-            "difficult": torch.tensor(difficult_boxes),
-            "im_info": im_info,
+            "boxes": torch.from_numpy(boxes),
+            "labels": torch.tensor([self.class_to_ind[name.lower().strip()] for name in names], dtype=torch.int64),
+            "difficult": torch.from_numpy(difficult[keep] == 1),
+            "im_info": (int(self.annotation_index["heights"][pos]), int(self.annotation_index["widths"][pos])),
         }
         return res
 
     def get_img_info(self, index):
-        img_id = self.ids[index]
-        anno = ET.parse(self._annopath % img_id).getroot()
-        size = anno.find("size")
-        im_info = tuple(map(int, (size.find("height").text, size.find("width").text)))
-        return {"height": im_info[0], "width": im_info[1]}
+        pos = self.index_pos[index]
+        return {"height": int(self.annotation_index["heights"][pos]), "width": int(self.annotation_index["widths"][pos])}
 
     def map_class_id_to_class_name(self, class_id, is_target_task=False, icwt_21_objs=False):
         if is_target_task is False:
@@ -1,5 +1,6 @@
 import os
 
+import numpy as np
 import torch
 import torch.utils.data
 from PIL import Image
@@ -13,6 +14,8 @@ from maskrcnn_benchmark.structures.segmentation_mask import SegmentationMask
 
 import glob
 
+from .annotation_index import load_or_build_index, ragged_offsets
+
 def _has_only_empty_bbox(anno):
     try:
         v = anno["boxes"][:, 2:] <= 1
@@ -89,6 +92,12 @@ class YCBVideoDataset(torch.utils.data.Dataset):
 
         self._imgsetpath = os.path.join(self.root, self.split + ".txt")
 
+        # Annotations of all the images of the split, parsed once and saved next to the split file
+        self.annotation_index = load_or_build_index(os.path.join(self.root, self.split + "_index.npz"),
+                                                    self._imgsetpath, self._build_annotation_index)
+        self.ids = [str(img_id) for img_id in self.annotation_index['ids']]
+
+    def _build_annotation_index(self):
         imset = open(self._imgsetpath, "r")
         folder_list = []
         folder_list_int = []
@@ -99,21 +108,50 @@ class YCBVideoDataset(torch.utils.data.Dataset):
                 folder_list_int.append(int(folder_num))
         folder_list = sorted(folder_list)
 
-        self.scene_gts = [None] * (max(folder_list_int)+1)
-        self.scene_gt_infos = [None] * (max(folder_list_int)+1)
+        scene_gts = [None] * (max(folder_list_int)+1)
+        scene_gt_infos = [None] * (max(folder_list_int)+1)
         for i in range(len(folder_list)):
             f = open(self._scene_gt_path % folder_list[i])
             scene_gt = json.load(f)
             f.close()
-            self.scene_gts[int(folder_list[i])] = scene_gt
+            scene_gts[int(folder_list[i])] = scene_gt
             f = open(self._scene_gt_info_path % folder_list[i])
             scene_gt_info = json.load(f)
             f.close()
-            self.scene_gt_infos[int(folder_list[i])] = scene_gt_info
+            scene_gt_infos[int(folder_list[i])] = scene_gt_info
 
         with open(self._imgsetpath) as f:
-            self.ids = f.readlines()
-        self.ids = [x.strip("\n") for x in self.ids]
+            ids = [x.strip("\n") for x in f.readlines()]
+
+        widths = []
+        heights = []
+        num_objects = []
+        bboxes = []
+        obj_ids = []
+        masks_paths = []
+        for img_id in ids:
+            img_path = img_id.split()
+            # Only the header of the image is read to get its size
+            width, height = Image.open(self._imgpath % (img_path[0], img_path[1])).size
+            widths.append(width)
+            heights.append(height)
+            img_masks_paths = sorted(glob.glob(self._maskpath % (img_path[0], img_path[1] + '*')))
+            num_objects.append(len(img_masks_paths))
+            for j in range(len(img_masks_paths)):
+                bboxes.append(scene_gt_infos[int(img_path[0])][str(int(img_path[1]))][j]["bbox_visib"])
+                obj_ids.append(scene_gts[int(img_path[0])][str(int(img_path[1]))][j]["obj_id"])
+                # Paths are relative to the root, so that the index stays valid if the dataset is moved
+                masks_paths.append(os.path.relpath(img_masks_paths[j], self.root))
+
+        return {
+            "ids": np.array(ids, dtype=np.str_),
+            "widths": np.array(widths, dtype=np.int32),
+            "heights": np.array(heights, dtype=np.int32),
+            "offsets": ragged_offsets(num_objects),
+            "bboxes": np.array(bboxes, dtype=np.int64).reshape(-1, 4),
+            "obj_ids": np.array(obj_ids, dtype=np.int64),
+            "masks_paths": np.array(masks_paths, dtype=np.str_),
+        }
 
     def __getitem__(self, index):
 
@@ -132,30 +170,19 @@ class YCBVideoDataset(torch.utils.data.Dataset):
         return img, target, index
 
     def __len__(self):
-        with open(self._imgsetpath) as f:
-            self.ids = f.readlines()
         return len(self.ids)
 
-    def get_groundtruth(self, index):
-
-        img_dir = self._imgpath
-        imgset_path = self._imgsetpath
-        mask_dir = self._maskpath
-
-        imset = open(imgset_path, "r")
-
-        img_path = imset.readlines()[index].strip('\n').split()
-
-        filename_path = img_dir % (img_path[0], img_path[1])
-        scene_gt_path = self._scene_gt_path % img_path[0]
-
-        scene_gt = self.scene_gts[int(img_path[0])]
-        scene_gt_info = self.scene_gt_infos[int(img_path[0])]
+    def get_objects(self, index):
+        # Visible boxes (x, y, w, h), object ids and mask paths of all the objects of an image. Mask paths are
+        # stored relative to the root in the index
+        start, end = self.annotation_index["offsets"][index], self.annotation_index["offsets"][index + 1]
+        masks_paths = [os.path.join(self.root, p) for p in self.annotation_index["masks_paths"][start:end]]
+        return self.annotation_index["bboxes"][start:end], self.annotation_index["obj_ids"][start:end], masks_paths
 
-        img_RGB = Image.open(filename_path)
+    def get_groundtruth(self, index, with_masks=True):
         # get image size such that later the boxes can be resized to the correct size
-        width, height = img_RGB.size
-        masks_paths = sorted(glob.glob(mask_dir % (img_path[0], img_path[1] + '*')))
+        width, height = int(self.annotation_index["widths"][index]), int(self.annotation_index["heights"][index])
+        bboxes, obj_ids, masks_paths = self.get_objects(index)
 
         gt_labels = []
         gt_bboxes_list = []
@@ -163,24 +190,25 @@ class YCBVideoDataset(torch.utils.data.Dataset):
         difficult_boxes = []
 
         for j in range(len(masks_paths)):
-            bbox = scene_gt_info[str(int(img_path[1]))][j]["bbox_visib"]
+            bbox = bboxes[j].tolist()
             if bbox == [-1, -1, -1, -1]:
                 continue
             gt_bboxes_list.append([bbox[0], bbox[1], bbox[0] + bbox[2] -1, bbox[1] + bbox[3] -1])
-            gt_labels.append(scene_gt[str(int(img_path[1]))][j]["obj_id"])
-            masks.append(T.ToTensor()(Image.open(masks_paths[j])))
+            gt_labels.append(int(obj_ids[j]))
+            if with_masks:
+                masks.append(T.ToTensor()(Image.open(masks_paths[j])))
             difficult_boxes.append(False)
 
         target = BoxList(torch.tensor(gt_bboxes_list), (width, height), mode="xyxy")
-        masks = SegmentationMask(torch.cat(masks), (width, height), mode="mask")
         target.add_field("labels", torch.tensor(gt_labels))
-        target.add_field("masks", masks)
+        if with_masks:
+            target.add_field("masks", SegmentationMask(torch.cat(masks), (width, height), mode="mask"))
         target.add_field("difficult", torch.tensor(difficult_boxes))
 
         return target
 
     def get_img_info(self, index):
-        return {"height": 480, "width": 640}
+        return {"height": int(self.annotation_index["heights"][index]), "width": int(self.annotation_index["widths"][index])}
 
     def map_class_id_to_class_name(self, class_id):
         return YCBVideoDataset.CLASSES[class_id]
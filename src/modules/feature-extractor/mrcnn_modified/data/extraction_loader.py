@@ -0,0 +1,91 @@
+import torch
+import torch.utils.data
+
+
+class ExtractionDataset(torch.utils.data.Dataset):
+    """
+    Dataset used by the extraction and inference engines. Each item contains the pre-processed image and its
+    ground truth, as returned by compute_gts (e.g. compute_gts_icwt or compute_gts_ycbv), on the cpu, so that
+    images can be decoded by the workers of a DataLoader.
+    """
+
+    def __init__(self, dataset, compute_gts, transforms):
+        self.dataset = dataset
+        self.compute_gts = compute_gts
+        self.transforms = transforms
+
+    def __getitem__(self, index):
+        image, gt_bboxes_list, masks, gt_labels, img_sizes = self.compute_gts(self.dataset, index, device='cpu')
+        masks = torch.cat(masks) if len(masks) > 0 else None
+        return self.transforms(image), torch.tensor(gt_bboxes_list), masks, gt_labels, img_sizes
+
+    def __len__(self):
+        return len(self.dataset.ids)
+
+
+def collate_single(batch):
+    return batch[0]
+
+
+def to_device(item, device):
+    if torch.is_tensor(item):
+        return item.to(device, non_blocking=True)
+    if isinstance(item, (list, tuple)):
+        return type(item)(to_device(i, device) for i in item)
+    return item
+
+
+def record_stream(item, stream):
+    if torch.is_tensor(item):
+        item.record_stream(stream)
+    elif isinstance(item, (list, tuple)):
+        for i in item:
+            record_stream(i, stream)
+
+
+class CUDAPrefetcher():
+    """
+    Iterator over a DataLoader that copies the next item to the gpu on a side stream, while the current one
+    is processed.
+    """
+
+    def __init__(self, loader, device='cuda'):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            item = next(self.loader)
+        except StopIteration:
+            self.next_item = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_item = to_device(item, self.device)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_item is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        item = self.next_item
+        # The tensors, allocated on the side stream, are used on the current one
+        record_stream(item, torch.cuda.current_stream())
+        self.preload()
+        return item
+
+
+def make_extraction_loader(cfg, dataset, compute_gts, transforms, device='cuda'):
+    # Images are decoded and pre-processed by the workers and returned in pinned memory
+    data_loader = torch.utils.data.DataLoader(
+        ExtractionDataset(dataset, compute_gts, transforms),
+        batch_size=1,
+        shuffle=False,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        collate_fn=collate_single,
+        pin_memory=True,
+    )
+    return CUDAPrefetcher(data_loader, device=device)
@@ -6,7 +6,7 @@ from torchvision.transforms import functional as F
 from mrcnn_modified.modeling.detector.detectors import build_detection_model
 from maskrcnn_benchmark.utils.checkpoint import DetectronCheckpointer
 from maskrcnn_benchmark.structures.image_list import to_image_list
-from maskrcnn_benchmark.modeling.roi_heads.mask_head.inference import Masker
+from mrcnn_modified.modeling.roi_heads.mask_head.inference import Masker
 from maskrcnn_benchmark import layers as L
 from maskrcnn_benchmark.utils import cv2_util
 
@@ -213,7 +213,6 @@ class OnlineSegmentationDemo(object):
             return None
         if not type(predictions) is list:
             predictions = [predictions]
-        predictions = [o.to(self.cpu_device) for o in predictions]
 
         try:
             # always single image is passed at a time
@@ -227,12 +226,13 @@ class OnlineSegmentationDemo(object):
 
         if prediction.has_field("mask"):
             # if we have masks, paste the masks in the right position
-            # in the image, as defined by the bounding boxes
+            # in the image, as defined by the bounding boxes.
+            # Masks are pasted on the device of the model, before moving the prediction to the cpu
             masks = prediction.get_field("mask")
             # always single image is passed at a time
             masks = self.masker([masks], [prediction])[0]
             prediction.add_field("mask", masks)
-        return prediction
+        return prediction.to(self.cpu_device)
 
     def select_top_predictions(self, predictions):
         """
@@ -353,6 +353,8 @@ class OnlineSegmentationDemo(object):
         if models_segmentation:
             self.model.roi_heads.mask.predictor.classifiers = models_segmentation['classifiers']
             self.model.roi_heads.mask.predictor.stats = models_segmentation['stats']
+            # Masks of the detections that are not displayed are not predicted
+            self.model.roi_heads.mask.predictor.score_threshold = self.confidence_threshold
 
         if categories:
             self.CATEGORIES = categories
\ No newline at end of file
@@ -2,6 +2,7 @@
 import logging
 import time
 import os
+import functools
 
 import torch
 from tqdm import tqdm
@@ -36,14 +37,12 @@ import numpy as np
 
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 
-import glob
 import argparse
 
-# To parse the annotation .xml files
-import xml.etree.ElementTree as ET
-
 from torchvision import transforms as T
 from maskrcnn_benchmark.structures.image_list import to_image_list
+from mrcnn_modified.data.extraction_loader import make_extraction_loader
+from mrcnn_modified.data.datasets.evaluation.detection_eval import StreamingDetectionEvaluator
 
 
 OBJECTNAME_TO_ID = {
@@ -127,15 +126,12 @@ def build_transform(cfg):
     )
     return transform
 
-def compute_gts_icwt(dataset, i, icwt_21_objs = None):
+def compute_gts_icwt(dataset, i, icwt_21_objs = None, device='cuda'):
     img_dir = dataset._imgpath
     anno_dir = dataset._annopath
-    imgset_path = dataset._imgsetpath
     mask_dir = dataset._maskpath
 
-    imset = open(imgset_path, "r")
-
-    img_path = imset.readlines()[i].strip('\n')
+    img_path = dataset.ids[i]
 
     filename_path = img_dir % img_path
     print(filename_path)
@@ -151,20 +147,15 @@ def compute_gts_icwt(dataset, i, icwt_21_objs = None):
     mask_path = (mask_dir % img_path)
 
     mask = None
-    if os.path.exists(mask_path):
-        mask = T.ToTensor()(Image.open(mask_path)).to('cuda')
-    # Read in annotation file
-    anno_file = anno_dir % img_path
-    tree = ET.parse(anno_file, ET.XMLParser(encoding='utf-8'))
-    root = tree.getroot()
-    # Read label
+    if dataset.has_mask(i):
+        mask = T.ToTensor()(Image.open(mask_path)).to(device)
+    # Read the annotations from the dataset index
+    names, boxes, _ = dataset.get_objects(i)
     gt_labels = []
     gt_bboxes_list = []
     masks = []
-    for object in root.findall('object'):
-        try:
-            name = object.find('name').text
-        except:
+    for name, box in zip(names, boxes):
+        if name == '':
             continue
 
         if not icwt_21_objs:
@@ -177,34 +168,20 @@ def compute_gts_icwt(dataset, i, icwt_21_objs = None):
 
         gt_labels.append(gt_label)
 
-        xmin = object.find('bndbox').find('xmin').text
-        ymin = object.find('bndbox').find('ymin').text
-        xmax = object.find('bndbox').find('xmax').text
-        ymax = object.find('bndbox').find('ymax').text
-
-        gt_bboxes_list.append([float(xmin) - 1, float(ymin) - 1, float(xmax) - 1, float(ymax) - 1])
+        gt_bboxes_list.append([float(box[0]) - 1, float(box[1]) - 1, float(box[2]) - 1, float(box[3]) - 1])
         # Please note that that masks gts works only with the modified version of iCWT in which there is only an object per image
         # In the case that on-line segmentation will be necessary on a different extension of iCWT with possibly more than an object per image,
         # this function will be extended according to annotations' format
         if mask is not None:
             masks.append(mask)
-    imset.close()
     return image, gt_bboxes_list, masks, gt_labels, img_sizes
 
-def compute_gts_ycbv(dataset, i, evaluate_segmentation=True):
+def compute_gts_ycbv(dataset, i, evaluate_segmentation=True, device='cuda'):
     img_dir = dataset._imgpath
-    imgset_path = dataset._imgsetpath
-    mask_dir = dataset._maskpath
-
-    imset = open(imgset_path, "r")
 
-    img_path = imset.readlines()[i].strip('\n').split()
+    img_path = dataset.ids[i].split()
 
     filename_path = img_dir%(img_path[0], img_path[1])
-    scene_gt_path = dataset._scene_gt_path%img_path[0]
-
-    scene_gt = dataset.scene_gts[int(img_path[0])]
-    scene_gt_info = dataset.scene_gt_infos[int(img_path[0])]
 
     print(filename_path)
     img_RGB = Image.open(filename_path)
@@ -216,19 +193,20 @@ def compute_gts_ycbv(dataset, i, evaluate_segmentation=True):
         image = np.array(img_RGB)[:, :, [2, 1, 0]]
     except:
         image = np.array(img_RGB.convert('RGB'))[:, :, [2, 1, 0]]
-    masks_paths = sorted(glob.glob(mask_dir%(img_path[0], img_path[1]+'*')))
+    # Read the annotations from the dataset index
+    bboxes, obj_ids, masks_paths = dataset.get_objects(i)
 
     gt_labels = []
     gt_bboxes_list = []
     masks = []
     for j in range(len(masks_paths)):
-        bbox = scene_gt_info[str(int(img_path[1]))][j]["bbox_visib"]
+        bbox = bboxes[j].tolist()
         if bbox == [-1, -1, -1, -1] or bbox[2] == 0 or bbox[3] == 0:
             continue
         gt_bboxes_list.append([bbox[0], bbox[1], bbox[0]+bbox[2]-1, bbox[1]+bbox[3]-1])
-        gt_labels.append(scene_gt[str(int(img_path[1]))][j]["obj_id"])
+        gt_labels.append(int(obj_ids[j]))
         if evaluate_segmentation:
-            masks.append(T.ToTensor()(Image.open(masks_paths[j])).to('cuda'))
+            masks.append(T.ToTensor()(Image.open(masks_paths[j])).to(device))
 
     return image, gt_bboxes_list, masks, gt_labels, img_sizes
 
@@ -246,19 +224,54 @@ def compute_predictions(cfg, dataset, model, transforms, icwt_21_objs=False, com
         average_recall_RPN = 0
 
     predictions = []
+    # Detections are evaluated as soon as they are predicted, so that they are not kept in memory,
+    # unless they are needed to evaluate segmentation
+    evaluator = None
+    if type(dataset).__name__ == 'iCubWorldDataset':
+        evaluator = StreamingDetectionEvaluator(dataset, iou_thresholds=model.roi_heads.box.cfg.EVALUATION.IOU_THRESHOLDS)
+    elif type(dataset).__name__ == 'YCBVideoDataset' and not evaluate_segmentation:
+        evaluator = StreamingDetectionEvaluator(dataset, iou_thresholds=model.roi_heads.box.cfg.EVALUATION.IOU_THRESHOLDS,
+                                                get_groundtruth=functools.partial(dataset.get_groundtruth, with_masks=False))
+
+    def collect(batch_predictions):
+        if evaluator is None:
+            predictions.extend(batch_predictions)
+            return
+        for prediction in batch_predictions:
+            evaluator.update(evaluator.num_images, prediction)
+
+    # Images processed by the backbone with a single forward
+    ims_per_batch = max(1, cfg.TEST.IMS_PER_BATCH)
+    batch_images = []
+    batch_targets = []
+
+    def predict_batch():
+        # convert to an ImageList
+        image_list = to_image_list(batch_images, 1)
+        image_list = image_list.to("cuda")
+        # compute predictions
+        with torch.no_grad():
+            if len(batch_images) == 1:
+                AR, predicted_boxes = model(image_list, compute_average_recall_RPN=compute_average_recall_RPN, is_train=is_train, result_dir=result_dir, evaluate_segmentation=evaluate_segmentation, eval_segm_with_gt_bboxes=eval_segm_with_gt_bboxes, **batch_targets[0])
+                ARs, batch_predictions = [AR], [predicted_boxes]
+            else:
+                ARs, batch_predictions = model.forward_batch(image_list, batch_targets, compute_average_recall_RPN=compute_average_recall_RPN, is_train=is_train, result_dir=result_dir, evaluate_segmentation=evaluate_segmentation, eval_segm_with_gt_bboxes=eval_segm_with_gt_bboxes)
+        del batch_images[:]
+        del batch_targets[:]
+        return ARs, batch_predictions
 
-    for i in range(num_img):
-        if type(dataset).__name__ is 'iCubWorldDataset':
-            image, gt_bboxes_list, masks, gt_labels, img_sizes = compute_gts_icwt(dataset, i, icwt_21_objs)
-        elif type(dataset).__name__ is 'YCBVideoDataset':
-            image, gt_bboxes_list, masks, gt_labels, img_sizes = compute_gts_ycbv(dataset, i, evaluate_segmentation=evaluate_segmentation)
+    if type(dataset).__name__ is 'iCubWorldDataset':
+        compute_gts = functools.partial(compute_gts_icwt, icwt_21_objs=icwt_21_objs)
+    elif type(dataset).__name__ is 'YCBVideoDataset':
+        compute_gts = functools.partial(compute_gts_ycbv, evaluate_segmentation=evaluate_segmentation)
+    # Images and annotations are loaded by background workers, pre-processed and copied to the gpu in advance
+    data_loader = make_extraction_loader(cfg, dataset, compute_gts, transforms)
 
-        # Save list of boxes as tensor
-        gt_bbox_tensor = torch.tensor(gt_bboxes_list, device="cuda")
+    for i, (image, gt_bbox_tensor, masks, gt_labels, img_sizes) in enumerate(data_loader):
         gt_labels_torch = torch.tensor(gt_labels, device="cuda", dtype=torch.uint8).reshape((len(gt_labels), 1))
 
-        if len(masks) > 0:
-            mask_lists = SegmentationMask(torch.cat(masks), img_sizes, mode='mask')
+        if masks is not None:
+            mask_lists = SegmentationMask(masks, img_sizes, mode='mask')
 
         # create box list containing the ground truth bounding boxes
         try:
@@ -271,17 +284,19 @@ def compute_predictions(cfg, dataset, model, transforms, icwt_21_objs=False, com
         except:
             gt_bbox_boxlist = BoxList(torch.empty((0,4), device="cuda"), image_size=img_sizes, mode='xyxy')
 
-        # apply pre-processing to image
-        image = transforms(image)
-        # convert to an ImageList
-        image_list = to_image_list(image, 1)
-        image_list = image_list.to("cuda")
-        # compute predictions
-        with torch.no_grad():
-            AR, predicted_boxes = model(image_list, gt_bbox=gt_bbox_boxlist, gt_label=gt_labels_torch, img_size=img_sizes, compute_average_recall_RPN=compute_average_recall_RPN, gt_labels_list=gt_labels, is_train=is_train, result_dir=result_dir, evaluate_segmentation=evaluate_segmentation, eval_segm_with_gt_bboxes=eval_segm_with_gt_bboxes)
+        # Images of different sizes are not batched together, so that they are not padded
+        if len(batch_images) > 0 and image.size() != batch_images[0].size():
+            ARs, batch_predictions = predict_batch()
+            if compute_average_recall_RPN:
+                average_recall_RPN += sum(ARs)
+            collect(batch_predictions)
+        batch_images.append(image)
+        batch_targets.append({'gt_bbox': gt_bbox_boxlist, 'gt_label': gt_labels_torch, 'img_size': img_sizes, 'gt_labels_list': gt_labels})
+        if len(batch_images) == ims_per_batch or i == num_img - 1:
+            ARs, batch_predictions = predict_batch()
             if compute_average_recall_RPN:
-                average_recall_RPN += AR
-            predictions.append(predicted_boxes)
+                average_recall_RPN += sum(ARs)
+            collect(batch_predictions)
 
     if compute_average_recall_RPN:
         AR = average_recall_RPN / num_img
@@ -315,7 +330,7 @@ def compute_predictions(cfg, dataset, model, transforms, icwt_21_objs=False, com
         )
 
     return evaluate(dataset=dataset,
-                    predictions=predictions,
+                    predictions=evaluator if evaluator is not None else predictions,
                     output_folder=result_dir,
                     **extra_args)
 
@@ -6,7 +6,7 @@ Implements the Generalized R-CNN framework
 import torch
 from torch import nn
 
-from maskrcnn_benchmark.structures.image_list import to_image_list
+from maskrcnn_benchmark.structures.image_list import to_image_list, ImageList
 
 from maskrcnn_benchmark.modeling.backbone import build_backbone
 from mrcnn_modified.modeling.rpn.rpn import build_rpn
@@ -51,15 +51,61 @@ class GeneralizedRCNN(nn.Module):
         else:
             proposals, proposal_losses, average_recall_RPN = self.rpn(images, features, gt_bbox, compute_average_recall_RPN=compute_average_recall_RPN)
         if gt_bbox is not None and is_train:
-            # Resize the ground truth boxes to the correct format
-            width, height = proposals[0].size
-            gt_bbox = gt_bbox.resize((width, height))
-            # Add the ground truth proposals to the proposal vector
-            proposals[0].bbox = torch.cat((gt_bbox.bbox, proposals[0].bbox), 0)
-            proposals[0].extra_fields['objectness'] = torch.cat((1.0 * torch.ones(gt_bbox.bbox.size()[0], device="cuda"), proposals[0].extra_fields['objectness']), 0)
+            gt_bbox = self.add_gt_proposals(proposals, gt_bbox)
 
         if self.roi_heads:
             x, result, detector_losses = self.roi_heads(features, proposals, gt_bbox = gt_bbox, gt_label= gt_label, img_size=img_size, gt_labels_list = gt_labels_list, is_train = is_train, result_dir = result_dir, evaluate_segmentation=evaluate_segmentation, eval_segm_with_gt_bboxes=eval_segm_with_gt_bboxes)
 
         return average_recall_RPN, result
 
+    def forward_batch(self, images, targets, compute_average_recall_RPN=False, is_train = True, result_dir = None, evaluate_segmentation=True, eval_segm_with_gt_bboxes=False):
+        """
+        Batched version of forward, for images of the same size. The backbone and the box feature extractor
+        process all the images at once, while the RPN and the heads are run image by image.
+
+        Arguments:
+            images (ImageList): images to be processed
+            targets (list[dict]): for each image, the gt_bbox, gt_label, img_size and gt_labels_list arguments of forward
+
+        Returns:
+            average_recall_RPN (list): the average recall of the RPN for each image
+            results (list): the output of forward for each image
+        """
+        features = self.backbone(images.tensors)
+        images_features = []
+        proposals = []
+        gt_bboxes = []
+        average_recall_RPN = []
+        for j, target in enumerate(targets):
+            image = ImageList(images.tensors[j:j+1], [images.image_sizes[j]])
+            features_j = [f[j:j+1] for f in features]
+            gt_bbox = target['gt_bbox']
+            if gt_bbox is not None:
+                proposals_j, proposal_losses, average_recall_RPN_j = self.rpn(image, features_j, gt_bbox.resize((image.image_sizes[0][1], image.image_sizes[0][0])), compute_average_recall_RPN=compute_average_recall_RPN)
+            else:
+                proposals_j, proposal_losses, average_recall_RPN_j = self.rpn(image, features_j, gt_bbox, compute_average_recall_RPN=compute_average_recall_RPN)
+            if gt_bbox is not None and is_train:
+                gt_bbox = self.add_gt_proposals(proposals_j, gt_bbox)
+            gt_bboxes.append(gt_bbox)
+            images_features.append(features_j)
+            proposals.append(proposals_j[0])
+            average_recall_RPN.append(average_recall_RPN_j)
+
+        results = [None] * len(targets)
+        if self.roi_heads:
+            # Extract the features of the proposals of all the images and split them back
+            box_features = self.roi_heads.box.feature_extractor(features, proposals).split([len(p) for p in proposals])
+            for j, target in enumerate(targets):
+                x, results[j], detector_losses = self.roi_heads(images_features[j], [proposals[j]], gt_bbox = gt_bboxes[j], gt_label= target['gt_label'], img_size=target['img_size'], gt_labels_list = target['gt_labels_list'], is_train = is_train, result_dir = result_dir, evaluate_segmentation=evaluate_segmentation, eval_segm_with_gt_bboxes=eval_segm_with_gt_bboxes, box_features=box_features[j])
+
+        return average_recall_RPN, results
+
+    def add_gt_proposals(self, proposals, gt_bbox):
+        # Resize the ground truth boxes to the correct format
+        width, height = proposals[0].size
+        gt_bbox = gt_bbox.resize((width, height))
+        # Add the ground truth proposals to the proposal vector
+        proposals[0].bbox = torch.cat((gt_bbox.bbox, proposals[0].bbox), 0)
+        proposals[0].extra_fields['objectness'] = torch.cat((1.0 * torch.ones(gt_bbox.bbox.size()[0], device="cuda"), proposals[0].extra_fields['objectness']), 0)
+        return gt_bbox
+
@@ -6,7 +6,7 @@ Implements the Generalized R-CNN framework
 import torch
 from torch import nn
 
-from maskrcnn_benchmark.structures.image_list import to_image_list
+from maskrcnn_benchmark.structures.image_list import to_image_list, ImageList
 
 from maskrcnn_benchmark.modeling.backbone import build_backbone
 from mrcnn_modified.modeling.rpn.rpn import build_rpn
@@ -31,7 +31,7 @@ class GeneralizedRCNN(nn.Module):
         self.rpn = build_rpn(cfg, self.backbone.out_channels)
         self.roi_heads = build_roi_heads(cfg, self.backbone.out_channels)
 
-    def forward(self, images, gt_bbox = None, gt_label = None, img_size = [0,0], compute_average_recall_RPN=False, gt_labels_list = None, is_train = True, result_dir = None, extract_features_segmentation=False):
+    def forward(self, images, gt_bbox = None, gt_label = None, img_size = [0,0], compute_average_recall_RPN=False, gt_labels_list = None, is_train = True, result_dir = None, extract_features_segmentation=False, backbone_features=None):
         """
         Arguments:
             images (list[Tensor] or ImageList): images to be processed
@@ -45,8 +45,50 @@ class GeneralizedRCNN(nn.Module):
 
         """
         images = to_image_list(images)
-        features = self.backbone(images.tensors)
+        # The backbone is skipped if its features are given, e.g. from a BackboneFeatureCache
+        features = self.backbone(images.tensors) if backbone_features is None else backbone_features
         proposals, proposal_losses, average_recall_RPN = self.rpn(images, features, gt_bbox.resize((images.image_sizes[0][1], images.image_sizes[0][0])), compute_average_recall_RPN=compute_average_recall_RPN)
+        gt_bbox = self.add_gt_proposals(proposals, gt_bbox)
+
+        if self.roi_heads:
+            x, result, detector_losses = self.roi_heads(features, proposals, gt_bbox = gt_bbox, gt_label= gt_label, img_size=img_size, gt_labels_list = gt_labels_list, is_train = is_train, result_dir = result_dir, extract_features_segmentation=extract_features_segmentation)
+        return average_recall_RPN
+
+    def forward_batch(self, images, targets, compute_average_recall_RPN=False, is_train = True, result_dir = None, extract_features_segmentation=False, backbone_features=None):
+        """
+        Batched version of forward, for images of the same size. The backbone and the box feature extractor
+        process all the images at once, while the RPN and the heads, which collect features for minibootstrap,
+        are run image by image.
+
+        Arguments:
+            images (ImageList): images to be processed
+            targets (list[dict]): for each image, the gt_bbox, gt_label, img_size and gt_labels_list arguments of forward
+
+        Returns:
+            average_recall_RPN (list): the average recall of the RPN for each image
+        """
+        features = self.backbone(images.tensors) if backbone_features is None else backbone_features
+        images_features = []
+        proposals = []
+        gt_bboxes = []
+        average_recall_RPN = []
+        for j, target in enumerate(targets):
+            image = ImageList(images.tensors[j:j+1], [images.image_sizes[j]])
+            features_j = [f[j:j+1] for f in features]
+            proposals_j, proposal_losses, average_recall_RPN_j = self.rpn(image, features_j, target['gt_bbox'].resize((image.image_sizes[0][1], image.image_sizes[0][0])), compute_average_recall_RPN=compute_average_recall_RPN)
+            gt_bboxes.append(self.add_gt_proposals(proposals_j, target['gt_bbox']))
+            images_features.append(features_j)
+            proposals.append(proposals_j[0])
+            average_recall_RPN.append(average_recall_RPN_j)
+
+        if self.roi_heads:
+            # Extract the features of the proposals of all the images and split them back
+            box_features = self.roi_heads.box.feature_extractor(features, proposals).split([len(p) for p in proposals])
+            for j, target in enumerate(targets):
+                x, result, detector_losses = self.roi_heads(images_features[j], [proposals[j]], gt_bbox = gt_bboxes[j], gt_label= target['gt_label'], img_size=target['img_size'], gt_labels_list = target['gt_labels_list'], is_train = is_train, result_dir = result_dir, extract_features_segmentation=extract_features_segmentation, box_features=box_features[j])
+        return average_recall_RPN
+
+    def add_gt_proposals(self, proposals, gt_bbox):
         if gt_bbox is not None:
             # Resize the ground truth boxes to the correct format
             width, height = proposals[0].size
@@ -54,8 +96,5 @@ class GeneralizedRCNN(nn.Module):
             # Add the ground truth proposals to the proposal vector
             proposals[0].bbox = torch.cat((gt_bbox.bbox, proposals[0].bbox), 0)
             proposals[0].extra_fields['objectness'] = torch.cat((1.0 * torch.ones(gt_bbox.bbox.size()[0], device="cuda"), proposals[0].extra_fields['objectness']), 0)
-
-        if self.roi_heads:
-            x, result, detector_losses = self.roi_heads(features, proposals, gt_bbox = gt_bbox, gt_label= gt_label, img_size=img_size, gt_labels_list = gt_labels_list, is_train = is_train, result_dir = result_dir, extract_features_segmentation=extract_features_segmentation)
-        return average_recall_RPN
+        return gt_bbox
 
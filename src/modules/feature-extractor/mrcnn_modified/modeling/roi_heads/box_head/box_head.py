@@ -31,13 +31,14 @@ class ROIBoxHead(torch.nn.Module):
 
         self.cfg = cfg
 
-    def forward(self, features, proposals, gt_bbox=None, gt_label=None, img_size=None, gt_labels_list=None, is_train=True, result_dir=None, targets=None):
+    def forward(self, features, proposals, gt_bbox=None, gt_label=None, img_size=None, gt_labels_list=None, is_train=True, result_dir=None, targets=None, box_features=None):
 
         """
         Arguments:
             features (list[Tensor]): feature-maps from possibly several levels
             proposals (list[BoxList]): proposal boxes
             targets (list[BoxList], optional): the ground-truth targets.
+            box_features (Tensor, optional): features of the proposals, if already extracted
 
         Returns:
             x (Tensor): the result of the feature extractor
@@ -49,7 +50,7 @@ class ROIBoxHead(torch.nn.Module):
 
         # extract features that will be fed to the final classifier. The
         # feature_extractor generally corresponds to the pooler + heads
-        x = self.feature_extractor(features, proposals)
+        x = self.feature_extractor(features, proposals) if box_features is None else box_features
 
         if hasattr(self.predictor, 'classifiers'):
             if self.post_processor is None:
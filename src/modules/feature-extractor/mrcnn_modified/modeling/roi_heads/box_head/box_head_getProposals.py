@@ -12,7 +12,12 @@ import numpy as np
 
 import time
 
-from mrcnn_modified.utils.evaluations import compute_overlap_torch
+from mrcnn_modified.utils.evaluations import compute_overlaps_torch
+from mrcnn_modified.utils.feature_store import FeatureStore
+from mrcnn_modified.utils.feature_writer import FeatureWriter
+from mrcnn_modified.utils.feature_cache import FeatureCacheWriter
+from mrcnn_modified.utils.feature_statistics import FeatureStatistics
+from mrcnn_modified.utils.regression_statistics import RegressionStatistics
 import math
 
 class ROIBoxHead(torch.nn.Module):
@@ -40,6 +45,8 @@ class ROIBoxHead(torch.nn.Module):
             self.save_features = self.cfg.SAVE_FEATURES_DETECTOR
         except:
             self.save_features = False
+        # Full batches are written in background to the feature cache while the extraction goes on
+        self.feature_writer = FeatureWriter(sink=FeatureCacheWriter(dtype=self.cfg.FEATURE_CACHE.DTYPE, device=self.training_device)) if self.save_features else None
 
         self.initialize_online_detection_params()
 
@@ -48,19 +55,13 @@ class ROIBoxHead(torch.nn.Module):
         self.iterations = self.cfg.MINIBOOTSTRAP.DETECTOR.ITERATIONS
         self.batch_size = self.cfg.MINIBOOTSTRAP.DETECTOR.BATCH_SIZE
         self.compute_gt_positives = self.cfg.MINIBOOTSTRAP.DETECTOR.EXTRACT_ONLY_GT_POSITIVES
+        # Statistics of the positives and negatives, updated as they are added to the batches
+        self.feature_stats = FeatureStatistics()
+        # Preallocated batches for minibootstrap
         if self.compute_gt_positives:
-            self.positives = []
-        self.negatives = []
-        self.current_batch = []
-        self.current_batch_size = []
-        for i in range(self.num_classes):
-            self.negatives.append([])
-            self.current_batch.append(0)
-            self.current_batch_size.append(0)
-            if self.compute_gt_positives:
-                self.positives.append([torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)])
-            for j in range(self.iterations):
-                self.negatives[i].append(torch.empty((0, self.feature_extractor.out_channels), device=self.training_device))
+            self.positives = FeatureStore(self.num_classes, self.feature_extractor.out_channels, self.batch_size, device=self.training_device, writer=self.feature_writer, stats=self.feature_stats.positives)
+        self.negatives = FeatureStore(self.num_classes, self.feature_extractor.out_channels, self.batch_size, num_batches=self.iterations, device=self.training_device, writer=self.feature_writer, stats=self.feature_stats.negatives)
+        self.current_batch = [0] * self.num_classes
 
         self.negatives_to_pick = None
 
@@ -71,44 +72,50 @@ class ROIBoxHead(torch.nn.Module):
         self.still_to_complete = list(range(self.num_classes))
 
         self.reg_min_overlap = self.cfg.REGRESSORS.MIN_OVERLAP
+        # Positives are taken from the regression examples if they are not extracted from the gts
+        self.keep_regression_examples = self.cfg.REGRESSORS.KEEP_EXAMPLES or not self.compute_gt_positives
+        # Statistics are needed only if the examples are not kept, or to be saved with the features
+        self.accumulate_regression_stats = not self.keep_regression_examples or self.save_features
+        # Sufficient statistics of the regression examples of each class
+        self.regression_stats = RegressionStatistics()
 
         # Regressor features
-        self.X = [torch.empty((0, self.feature_extractor.out_channels), dtype=torch.float32, device=self.training_device)]
+        self.X = FeatureStore(1, self.feature_extractor.out_channels, self.batch_size, device=self.training_device, writer=self.feature_writer)
         # Regressor target values
-        self.Y = [torch.empty((0, 4), dtype=torch.float32, device=self.training_device)]
+        self.Y = FeatureStore(1, 4, self.batch_size, device=self.training_device, writer=self.feature_writer)
         # Regressor overlap amounts
         self.O = None
         # Regressor classes
-        self.C = [torch.empty((0), dtype=torch.float32, device=self.training_device)]
+        self.C = FeatureStore(1, 1, self.batch_size, device=self.training_device, writer=self.feature_writer)
 
         self.test_boxes = []
+        # If set (e.g. to a StreamingTestPipeline), test proposals are given to it image by image, instead of
+        # being collected in test_boxes
+        self.test_pipeline = None
 
     def add_new_class(self):
         self.still_to_complete.append(self.num_classes)
         self.num_classes += 1
-        self.negatives.append([])
+        self.negatives.add_class()
         self.current_batch.append(0)
-        self.current_batch_size.append(0)
         if self.compute_gt_positives:
-            self.positives.append([torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)])
-        for j in range(self.iterations):
-            self.negatives[len(self.negatives)-1].append(torch.empty((0, self.feature_extractor.out_channels), device=self.training_device))
+            self.positives.add_class()
 
 
 
-    def forward(self, features, proposals, gt_bbox = None, gt_label = None, img_size= None, gt_labels_list=None, is_train = True, result_dir = None):
+    def forward(self, features, proposals, gt_bbox = None, gt_label = None, img_size= None, gt_labels_list=None, is_train = True, result_dir = None, box_features=None):
         if is_train:
-            return self.forward_train(features, proposals, gt_bbox=gt_bbox, gt_label=gt_label, img_size=img_size, gt_labels_list=gt_labels_list, result_dir=result_dir)
+            return self.forward_train(features, proposals, gt_bbox=gt_bbox, gt_label=gt_label, img_size=img_size, gt_labels_list=gt_labels_list, result_dir=result_dir, box_features=box_features)
         else:
-            return self.forward_test(features, proposals, gt_bbox=gt_bbox, gt_label=gt_label, img_size=img_size, gt_labels_list=gt_labels_list)
+            return self.forward_test(features, proposals, gt_bbox=gt_bbox, gt_label=gt_label, img_size=img_size, gt_labels_list=gt_labels_list, box_features=box_features)
 
-    def forward_train(self, features, proposals, gt_bbox=None, gt_label=None, img_size=None, gt_labels_list=None, result_dir=None):
+    def forward_train(self, features, proposals, gt_bbox=None, gt_label=None, img_size=None, gt_labels_list=None, result_dir=None, box_features=None):
 
         if self.negatives_to_pick is None:
             self.negatives_to_pick = math.ceil((self.batch_size*self.iterations)/self.cfg.NUM_IMAGES)
 
-        # Extract features that will be fed to the final classifier.
-        feat = self.feature_extractor(features, proposals)
+        # Extract features that will be fed to the final classifier, if not already extracted for a batch of images
+        feat = self.feature_extractor(features, proposals) if box_features is None else box_features
         x = self.avgpool(feat)
         x = x.view(x.size(0), -1)
         proposals[0] = proposals[0].resize((img_size[0], img_size[1]))
@@ -142,87 +149,74 @@ class ROIBoxHead(torch.nn.Module):
             arr_class = torch.zeros((num_proposals,1), device='cuda')
         # Initialize overlaps with gts to 0
         overlap = torch.zeros((arr_proposals.size()[0], self.num_classes), dtype=torch.float, device='cuda')
-        # Initialize tensors to keep track of the gt with max overlap for each proposal
-        associated_gt_id = torch.full((arr_proposals.size()[0],), -1, dtype=torch.int, device='cuda')
+        # Gt with max overlap for each proposal (-1 if it does not overlap any gt)
+        associated_gt_id = torch.full((arr_proposals.size()[0],), -1, dtype=torch.long, device='cuda')
         max_iou_gt = torch.zeros((arr_proposals.size()[0],), dtype=torch.float, device='cuda')
-        # Compute max overlap of each proposal with each class
-        for j in range(arr_gt_bbox.size()[0]):
-            overlap_j = compute_overlap_torch(arr_gt_bbox[j], arr_proposals)
-            overlap[:, gt_labels_list[j]-1] = torch.max(overlap[:, gt_labels_list[j]-1], overlap_j)
-            ids_to_update = torch.where(overlap_j > max_iou_gt)
-            associated_gt_id[ids_to_update] = j
-            max_iou_gt[ids_to_update] = overlap_j[ids_to_update]
-            
-
-        # Loop on all the gt boxes
-        for i in range(len(gt_labels_list)):
-            if self.compute_gt_positives:
-                # Concatenate each gt to the positive tensor for its corresponding class
-                if self.training_device is 'cpu':
-                    self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.cat((self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], x[i].view(-1, self.feature_extractor.out_channels).cpu()))
-                else:
-                    self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.cat((self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], x[i].view(-1, self.feature_extractor.out_channels)))
-                if self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].size()[0] >= self.batch_size:
+        gt_classes = torch.as_tensor(gt_labels_list, dtype=torch.long, device='cuda').view(-1) - 1
+        if len(gt_labels_list) > 0:
+            # Compute the overlaps of all the gts with all the proposals at once, then the max overlap of each
+            # proposal with each class
+            overlaps = compute_overlaps_torch(arr_gt_bbox[:len(gt_labels_list)], arr_proposals)
+            overlap.scatter_reduce_(1, gt_classes.view(1, -1).expand(arr_proposals.size()[0], -1), torch.t(overlaps), reduce='amax')
+            max_iou_gt, associated_gt_id = torch.max(overlaps, dim=0)
+            associated_gt_id[max_iou_gt <= 0] = -1
+
+        if self.compute_gt_positives:
+            # Add each gt to the positives of its corresponding class
+            for clss in torch.unique(gt_classes).tolist():
+                for batch in self.positives.extend(clss, x[:len(gt_labels_list)][gt_classes == clss].view(-1, self.feature_extractor.out_channels)):
                     if self.save_features:
-                        path_to_save = os.path.join(result_dir, 'features_detector', 'positives_cl_{}_batch_{}'.format(gt_labels_list[i]-1, len(self.positives[gt_labels_list[i]-1]) - 1))
-                        torch.save(self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], path_to_save)
-                        self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)
-                    self.positives[gt_labels_list[i]-1].append(torch.empty((0, self.feature_extractor.out_channels), device=self.training_device))
-
-            # Extract regressor positives, i.e. with overlap > self.reg_min_overlap and with proposed boxes associated to that gt
-            pos_ids = overlap[:,gt_labels_list[i]-1] > self.reg_min_overlap
-            pos_ids = pos_ids & torch.eq(associated_gt_id, i)
-            regr_positives_i = x[pos_ids].view(-1, self.feature_extractor.out_channels)
-
-            # Compute targets
-            ex_boxes = arr_proposals[pos_ids].view(-1, 4)
-            gt_boxes = torch.ones(ex_boxes.size(), device='cuda') * arr_proposals[i].view(-1, 4)
-
-            src_w = ex_boxes[:,2] - ex_boxes[:,0] + 1
-            src_h = ex_boxes[:,3] - ex_boxes[:,1] + 1
-            src_ctr_x = ex_boxes[:,0] + 0.5 * src_w
-            src_ctr_y = ex_boxes[:,1] + 0.5 * src_h
-
-            gt_w = gt_boxes[:,2] - gt_boxes[:,0] + 1
-            gt_h = gt_boxes[:,3] - gt_boxes[:,1] + 1
-            gt_ctr_x = gt_boxes[:,0] + 0.5 * gt_w
-            gt_ctr_y = gt_boxes[:,1] + 0.5 * gt_h
-
-            dst_ctr_x = (gt_ctr_x - src_ctr_x) / src_w
-            dst_ctr_y = (gt_ctr_y - src_ctr_y) / src_h
-            dst_scl_w = torch.log(gt_w / src_w)
-            dst_scl_h = torch.log(gt_h / src_h)
-
-            target = torch.stack((dst_ctr_x, dst_ctr_y, dst_scl_w, dst_scl_h), dim=1)
-
-            if self.training_device is 'cpu':
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target.cpu()), dim=0)
-                # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((torch.sum(pos_ids), 1), gt_labels_list[i])))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], regr_positives_i.cpu()))
-            else:
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target), dim=0)
-                # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((torch.sum(pos_ids), 1), gt_labels_list[i], device='cuda')))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], regr_positives_i))
-            if self.X[len(self.X)-1].size()[0] >= self.batch_size:
+                        path_to_save = os.path.join(result_dir, 'features_detector', 'positives_cl_{}_batch_{}'.format(clss, batch))
+                        self.positives.save_batch(clss, batch, path_to_save)
+                        self.positives.release(clss, batch)
+
+        # Extract regressor positives, i.e. with overlap > self.reg_min_overlap with the gt they are associated to.
+        # The overlap of a proposal with the class of its associated gt is the one with that gt.
+        # Positives are sorted by gt, as they were added one gt at a time
+        pos_ids = torch.where((max_iou_gt > self.reg_min_overlap) & (associated_gt_id >= 0))[0]
+        pos_gt_ids, order = torch.sort(associated_gt_id[pos_ids], stable=True)
+        pos_ids = pos_ids[order]
+        regr_positives = x[pos_ids].view(-1, self.feature_extractor.out_channels)
+        pos_classes = gt_classes[pos_gt_ids] + 1
+
+        # Compute targets, where the gt boxes are the first proposals
+        ex_boxes = arr_proposals[pos_ids].view(-1, 4)
+        gt_boxes = arr_proposals[pos_gt_ids].view(-1, 4)
+
+        src_w = ex_boxes[:,2] - ex_boxes[:,0] + 1
+        src_h = ex_boxes[:,3] - ex_boxes[:,1] + 1
+        src_ctr_x = ex_boxes[:,0] + 0.5 * src_w
+        src_ctr_y = ex_boxes[:,1] + 0.5 * src_h
+
+        gt_w = gt_boxes[:,2] - gt_boxes[:,0] + 1
+        gt_h = gt_boxes[:,3] - gt_boxes[:,1] + 1
+        gt_ctr_x = gt_boxes[:,0] + 0.5 * gt_w
+        gt_ctr_y = gt_boxes[:,1] + 0.5 * gt_h
+
+        dst_ctr_x = (gt_ctr_x - src_ctr_x) / src_w
+        dst_ctr_y = (gt_ctr_y - src_ctr_y) / src_h
+        dst_scl_w = torch.log(gt_w / src_w)
+        dst_scl_h = torch.log(gt_h / src_h)
+
+        target = torch.stack((dst_ctr_x, dst_ctr_y, dst_scl_w, dst_scl_h), dim=1)
+
+        if not self.compute_gt_positives:
+            # Positives are then taken from the regressor features (see load_positives_from_COXY)
+            for clss in torch.unique(pos_classes).tolist():
+                self.feature_stats.positives.update(clss-1, regr_positives[pos_classes == clss].to(self.training_device))
+        if self.accumulate_regression_stats:
+            self.regression_stats.update_batch(pos_classes, regr_positives.to(self.training_device), target)
+
+        if self.keep_regression_examples:
+            # Add targets, classes and features of all the positives of the image to Y, C and X
+            self.Y.extend(0, target)
+            self.C.extend(0, pos_classes.view(-1, 1).to(torch.float32))
+            for batch in self.X.extend(0, regr_positives):
                 if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_detector','reg_x_batch_{}'.format(len(self.X)-1))
-                    torch.save(self.X[len(self.X)-1], path_to_save)
-                    self.X[len(self.X)-1] = torch.empty((0, self.feature_extractor.out_channels), dtype=torch.float32, device=self.training_device)
-
-                    path_to_save = os.path.join(result_dir, 'features_detector','reg_c_batch_{}'.format(len(self.C)-1))
-                    torch.save(self.C[len(self.C)-1], path_to_save)
-                    self.C[len(self.C)-1] = torch.empty((0), dtype=torch.float32, device=self.training_device)
-
-                    path_to_save = os.path.join(result_dir, 'features_detector','reg_y_batch_{}'.format(len(self.Y)-1))
-                    torch.save(self.Y[len(self.Y)-1], path_to_save)
-                    self.Y[len(self.Y)-1] = torch.empty((0, 4), dtype=torch.float32, device=self.training_device)
-
-                self.X.append(torch.empty((0, self.feature_extractor.out_channels), dtype=torch.float32, device=self.training_device))
-                self.C.append(torch.empty((0), dtype=torch.float32, device=self.training_device))
-                self.Y.append(torch.empty((0, 4), dtype=torch.float32, device=self.training_device))
-
+                    for name, store in (('x', self.X), ('c', self.C), ('y', self.Y)):
+                        path_to_save = os.path.join(result_dir, 'features_detector', 'reg_{}_batch_{}'.format(name, batch))
+                        store.save_batch(0, batch, path_to_save)
+                        store.release(0, batch)
 
         # Fill batches for minibootstrap
         indices_to_remove = []
@@ -240,35 +234,30 @@ class ROIBoxHead(torch.nn.Module):
             neg_to_add = math.ceil(self.negatives_to_pick/self.iterations)
             ind_to_add = 0
             for b in range(self.current_batch[i], self.iterations):
-                if self.negatives[i][b].size()[0] >= self.batch_size:
-                    # If features must be saved, save full batches and replace the batch in gpu with an empty tensor
-                    if self.save_features:
-                        path_to_save = os.path.join(result_dir, 'features_detector', 'negatives_cl_{}_batch_{}'.format(i, b))
-                        torch.save(self.negatives[i][b], path_to_save)
-                        self.negatives[i][b] = torch.empty((0, self.feature_extractor.out_channels), device=self.training_device)
-                    self.current_batch[i] += 1
-                    if self.current_batch[i] >= self.iterations:
-                        indices_to_remove.append(i)
-                    continue
-                else:
-                    end_interval = int(ind_to_add + min(neg_to_add, self.batch_size - self.negatives[i][b].size()[0], self.negatives_to_pick - ind_to_add))
-                    if self.training_device is 'cpu':
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], neg_i[ind_to_add:end_interval].view(-1, self.feature_extractor.out_channels).cpu()))
-                    else:
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], neg_i[ind_to_add:end_interval].view(-1, self.feature_extractor.out_channels)))
-                    ind_to_add = end_interval
-                    if ind_to_add == self.negatives_to_pick:
-                        break
+                end_interval = min(ind_to_add + neg_to_add, self.negatives_to_pick, neg_i.size()[0])
+                ind_to_add += self.negatives.append(i, b, neg_i[ind_to_add:end_interval])
+                # If features must be saved, save full batches and release their memory
+                if self.save_features and self.negatives.is_full(i, b):
+                    path_to_save = os.path.join(result_dir, 'features_detector', 'negatives_cl_{}_batch_{}'.format(i, b))
+                    self.negatives.save_batch(i, b, path_to_save)
+                    self.negatives.release(i, b)
+                if ind_to_add >= min(self.negatives_to_pick, neg_i.size()[0]):
+                    break
+            # Skip the batches already completed
+            while self.current_batch[i] < self.iterations and self.negatives.is_closed(i, self.current_batch[i]):
+                self.current_batch[i] += 1
+            if self.current_batch[i] >= self.iterations:
+                indices_to_remove.append(i)
         for index in indices_to_remove:
             self.still_to_complete.remove(index)
         
         return feat, None, None
 
 
-    def forward_test(self, features, proposals, gt_bbox = None, gt_label = None, img_size= None, gt_labels_list=None):
+    def forward_test(self, features, proposals, gt_bbox = None, gt_label = None, img_size= None, gt_labels_list=None, box_features=None):
 
-        # Extract features that will be fed to the final classifier.
-        x = self.feature_extractor(features, proposals)
+        # Extract features that will be fed to the final classifier, if not already extracted for a batch of images
+        x = self.feature_extractor(features, proposals) if box_features is None else box_features
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
         proposals[0] = proposals[0].resize((img_size[0], img_size[1]))
@@ -293,6 +282,10 @@ class ROIBoxHead(torch.nn.Module):
             len_gt = gt_label.size()[0]
         else:
             len_gt = 0
+        if self.test_pipeline is not None:
+            # Classify, refine and evaluate the proposals right away, excluding the gts which come first
+            self.test_pipeline(arr_proposals[len_gt:], x[len_gt:], img_size)
+            return None, None, None
         # Count num of proposals
         num_proposals = arr_proposals.size()[0]- len_gt
         # Specify the classes of the ground truth boxes, then set the classes of the not-gt proposals to 0
@@ -1,4 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+import math
+
 import torch
 import torch.nn.functional as F
 from torch import nn
@@ -7,6 +9,7 @@ from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark.structures.boxlist_ops import boxlist_nms
 from maskrcnn_benchmark.structures.boxlist_ops import cat_boxlist
 from maskrcnn_benchmark.modeling.box_coder import BoxCoder
+from maskrcnn_benchmark.layers import nms as _box_nms
 
 
 class PostProcessor(nn.Module):
@@ -145,6 +148,66 @@ class PostProcessor(nn.Module):
             result = result[keep]
         return result
 
+    def filter_results_batch(self, boxes, scores, image_sizes, num_classes, device=None):
+        """Batched version of filter_results, for a list of images.
+        boxes[i] has shape (#detections, 4 * #classes) and scores[i] has shape (#detections, #classes),
+        as in prepare_boxlist, while image_sizes[i] is the (width, height) of the i-th image.
+        Boxes are clipped to their image and, to apply NMS once for all the images and classes,
+        each (image, class) group is shifted by a different offset, so that boxes of different
+        groups never overlap. The cap of detections_per_img is applied on the device with a sort,
+        keeping the highest scores of each image. Returns one BoxList for each image.
+        """
+        if len(scores) == 0:
+            return []
+        if device is None:
+            device = scores[0].device
+        num_images = len(scores)
+        scores_all = torch.cat([s.reshape(-1, num_classes) for s in scores]).to(device)
+        boxes_all = torch.cat([b.reshape(-1, num_classes, 4) for b in boxes]).to(device)
+        num_per_image = torch.tensor([s.numel() // num_classes for s in scores], device=device)
+        image_ids = torch.repeat_interleave(torch.arange(num_images, device=device), num_per_image)
+
+        # Clip the boxes to their image
+        max_xy = (torch.tensor(image_sizes, dtype=boxes_all.dtype, device=device) - 1)[image_ids]
+        boxes_all = torch.min(boxes_all.clamp(min=0), max_xy.repeat(1, 2).unsqueeze(1))
+
+        # Apply threshold on detection probabilities, skipping the background class
+        inds = (scores_all[:, 1:] > self.score_thresh).nonzero()
+        rows, labels = inds[:, 0], inds[:, 1] + 1
+        det_boxes = boxes_all[rows, labels]
+        det_scores = scores_all[rows, labels]
+        det_images = image_ids[rows]
+
+        if len(det_scores) > 0 and self.nms > 0:
+            groups = det_images * num_classes + labels
+            # Groups are laid out on a 2D grid, to keep the shifted coordinates small enough for float32
+            side = int(math.ceil(math.sqrt(num_images * num_classes)))
+            offsets = torch.stack((groups % side, groups // side), dim=1).to(det_boxes.dtype) * (det_boxes.max() + 1)
+            keep = _box_nms(det_boxes + offsets.repeat(1, 2), det_scores, self.nms)
+            det_boxes, det_scores, labels, det_images = det_boxes[keep], det_scores[keep], labels[keep], det_images[keep]
+
+        # Regroup the detections by image, sorted by decreasing score in each image, to split them below
+        if len(det_scores) > 0:
+            order = det_scores.argsort(descending=True)
+            order = order[(det_images[order] * len(order) + torch.arange(len(order), device=device)).argsort()]
+            det_boxes, det_scores, labels, det_images = det_boxes[order], det_scores[order], labels[order], det_images[order]
+
+        # Limit to max_per_image detections **over all classes**, keeping the highest scores of each image
+        if len(det_scores) > 0 and self.detections_per_img > 0:
+            counts = torch.bincount(det_images, minlength=num_images)
+            rank = torch.arange(len(det_images), device=device) - (counts.cumsum(0) - counts)[det_images]
+            keep = rank < self.detections_per_img
+            det_boxes, det_scores, labels, det_images = det_boxes[keep], det_scores[keep], labels[keep], det_images[keep]
+
+        counts = torch.bincount(det_images, minlength=num_images).tolist()
+        results = []
+        for boxes_i, scores_i, labels_i, image_size in zip(det_boxes.split(counts), det_scores.split(counts), labels.split(counts), image_sizes):
+            boxlist = BoxList(boxes_i, image_size, mode="xyxy")
+            boxlist.add_field("scores", scores_i)
+            boxlist.add_field("labels", labels_i)
+            results.append(boxlist)
+        return results
+
 
 def make_roi_box_post_processor(cfg):
     use_fpn = cfg.MODEL.ROI_HEADS.USE_FPN
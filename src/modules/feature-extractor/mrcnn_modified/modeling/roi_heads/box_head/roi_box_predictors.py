@@ -53,36 +53,25 @@ class FastRCNNPredictor(nn.Module):
             return cls_logit, bbox_pred
 
     def refine_boxes(self, features):
-        refined_boxes = torch.zeros((features.size()[0], 4), device='cuda')
-        for j in range(len(self.regressors)):
-            # Refine boxes with RLS regressors
-            if self.regressors[j]['Beta'] is not None:
-                weights = self.regressors[j]['Beta'][str(0)]['weights'].view(1, -1)
-                for k in range(1, 4):
-                    weights = torch.cat((weights, self.regressors[j]['Beta'][str(k)]['weights'].view(1, -1)))
-
-                weights = torch.t(weights)
-                Y = torch.matmul(features, weights[:-1])
-                Y += weights[-1]
-                Y = torch.matmul(Y, self.regressors[j]['T_inv'])
-                Y += self.regressors[j]['mu']
-            # If the regressor is not available, do not refine the boxes
-            else:
-                Y = torch.zeros((features.size()[0], 4), device='cuda')
-            refined_boxes = torch.cat((refined_boxes, Y), dim=1)
+        from region_predictor import StackedRegressors
+        # Stack the per-class RLS regressors, so that all the classes are refined with a single matrix product
+        if getattr(self, 'stacked_regressors_src', None) is not self.regressors or len(self.stacked_regressors) != len(self.regressors):
+            self.stacked_regressors = StackedRegressors.from_models(self.regressors, device=features.device)
+            self.stacked_regressors_src = self.regressors
+        # The background class and the classes without an available regressor are not refined
+        refined_boxes = torch.zeros((features.size()[0], 4 * (len(self.regressors) + 1)), device=features.device)
+        self.stacked_regressors.predict(features, out=refined_boxes[:, 4:])
         return refined_boxes
 
     def predict_clss_FALKON(self, features):
-        # Set background class to the default negative value -2
-        objectness_scores = torch.full((features.size()[0], 1), -2, device='cuda')
-        for classifier in self.classifiers:
-            # If the classifier is not available, set the objectness to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
-            if classifier is None:
-                predictions = torch.full((features.size()[0], 1), -2, device='cuda')
-            # Compute objectness with falkon classifier
-            else:
-                predictions = classifier.predict(features)
-            objectness_scores = torch.cat((objectness_scores, predictions), dim=1)
+        from FALKONMulticlassPredictor import FALKONMulticlassPredictor
+        # Stack the per-class FALKON models, so that the kernel with the Nystrom centers is computed only once
+        if getattr(self, 'fused_classifiers_src', None) is not self.classifiers or len(self.fused_classifiers) != len(self.classifiers):
+            self.fused_classifiers = FALKONMulticlassPredictor.from_models(self.classifiers, device=features.device)
+            self.fused_classifiers_src = self.classifiers
+        # Set background class to the default negative value -2. If a classifier is not available, its column is set to the default value -2 as well (which is smaller than all the other proposed values by trained FALKON classifiers)
+        objectness_scores = torch.full((features.size()[0], len(self.classifiers) + 1), -2, dtype=features.dtype, device=features.device)
+        self.fused_classifiers.predict(features, out=objectness_scores[:, 1:])
         return objectness_scores
 
 
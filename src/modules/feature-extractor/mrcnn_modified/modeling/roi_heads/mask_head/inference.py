@@ -2,6 +2,7 @@
 import numpy as np
 import torch
 from torch import nn
+from torch.nn import functional as F
 from maskrcnn_benchmark.layers.misc import interpolate
 
 from maskrcnn_benchmark.structures.bounding_box import BoxList
@@ -159,28 +160,83 @@ def paste_mask_in_image(mask, box, im_h, im_w, thresh=0.5, padding=1):
     return im_mask
 
 
+def paste_masks_in_image(masks, boxes, im_h, im_w, thresh=0.5, padding=1, crop=False, max_elements=2**26):
+    """
+    Batched version of paste_mask_in_image: all the (N x 1 x M x M) masks are resized and pasted at the location
+    of their boxes with grid_sample, on the device of the masks.
+    If crop is False, returns the (N x 1 x im_h x im_w) full image masks. Otherwise, returns only the region of
+    each box inside the image, as (N x 1 x H x W) masks, where H x W is the size of the largest region, and the
+    (N x 2) offsets (x, y) of the regions in the image. The pixels of each mask outside its region are False.
+    Masks are processed in chunks of at most max_elements pixels.
+    """
+    device = masks.device
+    N = masks.shape[0]
+    padded_masks, scale = expand_masks(masks.float(), padding=padding)
+    boxes = expand_boxes(boxes.to(device=device, dtype=torch.float32), scale).to(dtype=torch.int32)
+
+    TO_REMOVE = 1
+    w = torch.clamp(boxes[:, 2] - boxes[:, 0] + TO_REMOVE, min=1)
+    h = torch.clamp(boxes[:, 3] - boxes[:, 1] + TO_REMOVE, min=1)
+    # Region of each box inside the image, [x_0, x_1) x [y_0, y_1)
+    x_0 = torch.clamp(boxes[:, 0], min=0)
+    x_1 = torch.clamp(boxes[:, 2] + 1, max=im_w)
+    y_0 = torch.clamp(boxes[:, 1], min=0)
+    y_1 = torch.clamp(boxes[:, 3] + 1, max=im_h)
+
+    if crop:
+        out_w = max(int(torch.max(x_1 - x_0).item()), 1) if N > 0 else 1
+        out_h = max(int(torch.max(y_1 - y_0).item()), 1) if N > 0 else 1
+        xs = x_0[:, None] + torch.arange(out_w, device=device, dtype=torch.int32)[None, :]
+        ys = y_0[:, None] + torch.arange(out_h, device=device, dtype=torch.int32)[None, :]
+    else:
+        out_w, out_h = im_w, im_h
+        xs = torch.arange(im_w, device=device, dtype=torch.int32)[None, :].expand(N, -1)
+        ys = torch.arange(im_h, device=device, dtype=torch.int32)[None, :].expand(N, -1)
+    inside_x = (xs >= x_0[:, None]) & (xs < x_1[:, None])
+    inside_y = (ys >= y_0[:, None]) & (ys < y_1[:, None])
+    # Sampling coordinates in the padded masks, normalized as in a bilinear resize with align_corners=False
+    grid_x = (xs - boxes[:, 0:1] + 0.5).float() / w[:, None].float() * 2 - 1
+    grid_y = (ys - boxes[:, 1:2] + 0.5).float() / h[:, None].float() * 2 - 1
+
+    im_masks = torch.zeros((N, 1, out_h, out_w), dtype=torch.bool, device=device)
+    chunk_size = max(1, max_elements // (out_h * out_w))
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        n = end - start
+        grid = torch.stack((grid_x[start:end, None, :].expand(n, out_h, out_w),
+                            grid_y[start:end, :, None].expand(n, out_h, out_w)), dim=3)
+        resized = F.grid_sample(padded_masks[start:end], grid, mode='bilinear', padding_mode='border', align_corners=False)
+        if thresh >= 0:
+            resized = resized > thresh
+        else:
+            # for visualization and debugging, we also
+            # allow it to return an unmodified mask
+            resized = (resized * 255).to(torch.bool)
+        inside = inside_y[start:end, :, None] & inside_x[start:end, None, :]
+        im_masks[start:end] = resized & inside[:, None]
+
+    if crop:
+        return im_masks, torch.stack((x_0, y_0), dim=1)
+    return im_masks
+
+
 class Masker(object):
     """
     Projects a set of masks in an image on the locations
-    specified by the bounding boxes
+    specified by the bounding boxes.
+    All the masks of an image are pasted at once, on the device where they are. If crop is True, only the
+    region of each box is returned, together with its offset in the image (see paste_masks_in_image).
     """
 
-    def __init__(self, threshold=0.5, padding=1):
+    def __init__(self, threshold=0.5, padding=1, crop=False):
         self.threshold = threshold
         self.padding = padding
+        self.crop = crop
 
     def forward_single_image(self, masks, boxes):
         boxes = boxes.convert("xyxy")
         im_w, im_h = boxes.size
-        res = [
-            paste_mask_in_image(mask[0], box, im_h, im_w, self.threshold, self.padding)
-            for mask, box in zip(masks, boxes.bbox)
-        ]
-        if len(res) > 0:
-            res = torch.stack(res, dim=0)[:, None]
-        else:
-            res = masks.new_empty((0, 1, masks.shape[-2], masks.shape[-1]))
-        return res
+        return paste_masks_in_image(masks, boxes.bbox, im_h, im_w, self.threshold, self.padding, crop=self.crop)
 
     def __call__(self, masks, boxes):
         if isinstance(boxes, BoxList):
@@ -59,7 +59,7 @@ class ROIMaskHead(torch.nn.Module):
         """
 
         x = self.feature_extractor(features, [proposals])
-        mask_logits = self.predictor(x)
+        mask_logits = self.predictor(x, scores=proposals.get_field("scores") if proposals.has_field("scores") else None)
 
         result = self.post_processor(mask_logits, [proposals])
 
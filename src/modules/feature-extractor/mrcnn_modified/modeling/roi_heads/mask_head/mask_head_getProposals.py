@@ -4,7 +4,12 @@ from torch import nn
 from torch.nn import functional as F
 
 
+from maskrcnn_benchmark.layers import ROIAlign
 from maskrcnn_benchmark.structures.bounding_box import BoxList
+from mrcnn_modified.utils.feature_store import FeatureStore
+from mrcnn_modified.utils.feature_writer import FeatureWriter
+from mrcnn_modified.utils.feature_cache import FeatureCacheWriter
+from mrcnn_modified.utils.feature_statistics import FeatureStatistics
 
 from .roi_mask_feature_extractors import make_roi_mask_feature_extractor
 from .roi_mask_predictors import make_roi_mask_predictor
@@ -20,30 +25,44 @@ def project_masks_on_boxes(segmentation_masks, proposals, discretization_size):
     crops and resizes the masks in the position defined by the
     boxes. This prepares the masks for them to be fed to the
     loss computation as the targets.
+    All the masks are cropped and resized on the device of the boxes, with a single roi_align.
     Arguments:
-        segmentation_masks: an instance of SegmentationMask
-        proposals: an instance of BoxList
+        segmentation_masks: full image masks, as an instance of SegmentationMask or as a (N x H x W) tensor
+        proposals: an instance of BoxList, with a box for each mask
     """
-    masks = []
     M = discretization_size
     device = proposals.bbox.device
     proposals = proposals.convert("xyxy")
-    assert segmentation_masks.size == proposals.size, "{}, {}".format(
-        segmentation_masks, proposals
-    )
-
-    # FIXME: CPU computation bottleneck, this should be parallelized
-    proposals = proposals.bbox.to(torch.device("cpu"))
-    for segmentation_mask, proposal in zip(segmentation_masks, proposals):
-        # crop the masks, resize them to the desired resolution and
-        # then convert them to the tensor representation.
-        cropped_mask = segmentation_mask.crop(proposal)
-        scaled_mask = cropped_mask.resize((M, M))
-        mask = scaled_mask.get_mask_tensor()
-        masks.append(mask)
-    if len(masks) == 0:
-        return torch.empty(0, dtype=torch.float32, device=device)
-    return torch.stack(masks, dim=0).to(device, dtype=torch.float32)
+    if not torch.is_tensor(segmentation_masks):
+        assert segmentation_masks.size == proposals.size, "{}, {}".format(
+            segmentation_masks, proposals
+        )
+        width, height = segmentation_masks.size
+        segmentation_masks = segmentation_masks.get_mask_tensor().view(-1, height, width)
+    if len(proposals) == 0:
+        return torch.empty((0, M, M), dtype=torch.float32, device=device)
+
+    masks = segmentation_masks.to(device=device, dtype=torch.float32)
+    # Each box is pooled from its own mask
+    rois = torch.cat((torch.arange(len(proposals), device=device, dtype=torch.float32)[:, None], proposals.bbox.to(torch.float32)), dim=1)
+    return ROIAlign((M, M), spatial_scale=1.0, sampling_ratio=0)(masks[:, None], rois).squeeze(1)
+
+
+def sample_pixels(pixels_mask, sampling_factor):
+    """
+    Sample, from each row of pixels_mask (a ROIs x pixels boolean tensor), a fraction sampling_factor of the
+    pixels set to True. Returns the indices of the sampled pixels in the flattened tensor.
+    """
+    if sampling_factor >= 1.0:
+        return torch.nonzero(pixels_mask.view(-1)).squeeze(1)
+    num_rois, num_pixels = pixels_mask.size()
+    # Random permutation of each row, with the pixels not in the mask moved at the end
+    keys = torch.rand((num_rois, num_pixels), device=pixels_mask.device)
+    keys[~pixels_mask] = 2
+    order = torch.argsort(keys, dim=1)
+    num_sampled = torch.floor(pixels_mask.sum(dim=1).double() * sampling_factor).long()
+    sampled = torch.arange(num_pixels, device=pixels_mask.device)[None, :] < num_sampled[:, None]
+    return (order + torch.arange(num_rois, device=pixels_mask.device)[:, None] * num_pixels)[sampled]
 
 
 class ROIMaskHead(torch.nn.Module):
@@ -62,24 +81,25 @@ class ROIMaskHead(torch.nn.Module):
             self.save_features = False
 
         self.training_device = self.cfg.SEGMENTATION.FEATURES_DEVICE
+        # Full batches are written in background to the feature cache while the extraction goes on
+        self.feature_writer = FeatureWriter(sink=FeatureCacheWriter(dtype=self.cfg.FEATURE_CACHE.DTYPE, device=self.training_device)) if self.save_features else None
 
         self.initialize_online_segmentation_params()
 
     def initialize_online_segmentation_params(self, num_classes=0):
         self.num_classes = num_classes if num_classes else self.cfg.MINIBOOTSTRAP.DETECTOR.NUM_CLASSES
         self.batch_size = self.cfg.SEGMENTATION.BATCH_SIZE
-        self.positives = []
-        self.negatives = []
-        for i in range(self.num_classes):
-            self.positives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
-            self.negatives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
+        # Preallocated batches of pixel features for each class and their statistics
+        self.feature_stats = FeatureStatistics()
+        self.positives = FeatureStore(self.num_classes, self.predictor.mask_fcn_logits.in_channels, self.batch_size, device=self.training_device, writer=self.feature_writer, stats=self.feature_stats.positives)
+        self.negatives = FeatureStore(self.num_classes, self.predictor.mask_fcn_logits.in_channels, self.batch_size, device=self.training_device, writer=self.feature_writer, stats=self.feature_stats.negatives)
 
         self.sampling_factor = self.cfg.SEGMENTATION.SAMPLING_FACTOR
 
     def add_new_class(self):
         self.num_classes += 1
-        self.positives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
-        self.negatives.append([torch.empty((0, self.predictor.mask_fcn_logits.in_channels), device='cuda')])
+        self.positives.add_class()
+        self.negatives.add_class()
 
     def forward(self, features, proposals, gt_labels_list, gt_bbox, targets=None, result_dir=None):
         """
@@ -105,44 +125,35 @@ class ROIMaskHead(torch.nn.Module):
         if self.cfg.MODEL.ROI_MASK_HEAD['FEATURE_EXTRACTOR'] == 'ResNet50Conv5ROIFeatureExtractor':
             masks_features = F.relu(self.predictor.conv5_mask(x))
 
-        masks_gts = project_masks_on_boxes(gt_bbox.get_field('masks'), gt_bbox, masks_features.size()[2])
-        for i in range(len(masks_features)):
-            mask_features = masks_features[i].permute(1, 2, 0).view(-1, masks_features.size()[1])
-            masks_gt = masks_gts[i].view(mask_features.size()[0])
-            # Select pixels positives indices, i.e. where the gt mask value is >= 0.5
-            positives_indices = torch.where(masks_gt >= 0.5)[0]
-            # Sample the required fraction of indices
-            if self.sampling_factor < 1.0:
-                sampled_indices = torch.randperm(len(positives_indices))[:int(self.sampling_factor*len(positives_indices))]
-                positives_indices = positives_indices[sampled_indices]
-            # Add positives of the given mask to the positives list of the corresponding object class
-            self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.cat((self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], mask_features[positives_indices]))
-            # Manage full batches of features
-            if self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1].size()[0] >= self.batch_size:
-                if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_segmentation', 'positives_cl_{}_batch_{}'.format(gt_labels_list[i]-1, len(self.positives[gt_labels_list[i]-1]) - 1))
-                    torch.save(self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1], path_to_save)
-                    self.positives[gt_labels_list[i]-1][len(self.positives[gt_labels_list[i]-1]) - 1] = torch.empty((0, self.predictor.conv5_mask.out_channels), device=self.training_device)
-                if self.training_device == 'cpu':
-                    self.positives[gt_labels_list[i] - 1][len(self.positives[gt_labels_list[i] - 1]) - 1] = self.positives[gt_labels_list[i] - 1][len(self.positives[gt_labels_list[i] - 1]) - 1].to('cpu')
-                self.positives[gt_labels_list[i]-1].append(torch.empty((0, self.predictor.conv5_mask.out_channels), device='cuda'))
-            # Repeat the procedure done for positive features with the negatives
-            negatives_indices = torch.where(masks_gt < 0.5)[0]
-            if self.sampling_factor < 1.0:
-                sampled_indices = torch.randperm(len(negatives_indices))[:int(self.sampling_factor*len(negatives_indices))]
-                negatives_indices = negatives_indices[sampled_indices]
-            self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1] = torch.cat((self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1], mask_features[negatives_indices]))
-            if self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1].size()[0] >= self.batch_size:
-                if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_segmentation', 'negatives_cl_{}_batch_{}'.format(gt_labels_list[i]-1, len(self.negatives[gt_labels_list[i]-1]) - 1))
-                    torch.save(self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1], path_to_save)
-                    self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1]) - 1] = torch.empty((0, self.predictor.conv5_mask.out_channels), device=self.training_device)
-                if self.training_device == 'cpu':
-                    self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1])-1] = self.negatives[gt_labels_list[i]-1][len(self.negatives[gt_labels_list[i]-1])-1].to('cpu')
-                self.negatives[gt_labels_list[i]-1].append(torch.empty((0, self.predictor.conv5_mask.out_channels), device='cuda'))
+        num_pixels = masks_features.size()[2] * masks_features.size()[3]
+        masks_gts = project_masks_on_boxes(gt_bbox.get_field('masks'), gt_bbox, masks_features.size()[2]).view(-1, num_pixels)
+        # Features of the pixels of all the gt boxes, ordered by box, row and column
+        pixels_features = masks_features.permute(0, 2, 3, 1).reshape(-1, masks_features.size()[1])
+        labels = torch.as_tensor(gt_labels_list, device=masks_gts.device, dtype=torch.long) - 1
+        # Positive pixels are where the gt mask value is >= 0.5. The required fraction of positives and negatives is sampled from each box
+        positives_indices = sample_pixels(masks_gts >= 0.5, self.sampling_factor)
+        negatives_indices = sample_pixels(masks_gts < 0.5, self.sampling_factor)
+        # Add positives and negatives of each mask to the batches of the corresponding object class
+        self.add_pixels(self.positives, 'positives', pixels_features, positives_indices, labels[positives_indices // num_pixels], result_dir)
+        self.add_pixels(self.negatives, 'negatives', pixels_features, negatives_indices, labels[negatives_indices // num_pixels], result_dir)
 
         return None, None, None
 
+    def add_pixels(self, store, name, pixels_features, indices, classes, result_dir=None):
+        # Group the pixels by class, so that each class is added with a single copy
+        classes, order = torch.sort(classes)
+        counts = torch.bincount(classes, minlength=self.num_classes).tolist()
+        features_by_class = torch.split(pixels_features[indices[order]], counts)
+        for clss, features in enumerate(features_by_class):
+            if len(features) == 0:
+                continue
+            for batch in store.extend(clss, features):
+                # Manage full batches of features
+                if self.save_features:
+                    path_to_save = os.path.join(result_dir, 'features_segmentation', '{}_cl_{}_batch_{}'.format(name, clss, batch))
+                    store.save_batch(clss, batch, path_to_save)
+                    store.release(clss, batch)
+
 
 def build_roi_mask_head(cfg, in_channels):
     return ROIMaskHead(cfg, in_channels)
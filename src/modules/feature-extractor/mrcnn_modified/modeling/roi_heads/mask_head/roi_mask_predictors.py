@@ -19,6 +19,8 @@ class MaskRCNNC4Predictor(nn.Module):
 
         self.conv5_mask = ConvTranspose2d(num_inputs, dim_reduced, 2, 2, 0)
         self.mask_fcn_logits = Conv2d(dim_reduced, num_classes, 1, 1, 0)
+        # Pixels are classified with FALKON only for the detections with a score above this threshold
+        self.score_threshold = cfg.MODEL.ROI_MASK_HEAD.SCORE_THRESHOLD
 
         for name, param in self.named_parameters():
             if "bias" in name:
@@ -28,34 +30,43 @@ class MaskRCNNC4Predictor(nn.Module):
                 # corresponds to kaiming_normal_ in PyTorch
                 nn.init.kaiming_normal_(param, mode="fan_out", nonlinearity="relu")
 
-    def forward(self, x):
+    def forward(self, x, scores=None):
         x = F.relu(self.conv5_mask(x))
         feat_width = x.size()[2]
         if hasattr(self, 'classifiers'):
+            num_rois = x.size()[0]
+            # Skip the detections whose score is below the threshold
+            keep = None
+            if scores is not None and self.score_threshold > 0:
+                keep = scores >= self.score_threshold
+                x = x[keep]
             # Normalize features
             x = x.permute(0,2,3,1).reshape(-1,x.size()[1])
             x = x - self.stats['mean']
             x = x * (20 / self.stats['mean_norm'])
-            return self.predict_pixel_FALKON(x, feat_width)
+            return self.predict_pixel_FALKON(x, feat_width, num_rois=num_rois, keep=keep)
         else:
             return self.mask_fcn_logits(x)
 
-    def predict_pixel_FALKON(self, features, feat_width):
-        # Set background class to the default negative value -2
-        pixels_scores = torch.full((features.size()[0], 1), -2, device='cuda')
-        for classifier in self.classifiers:
-            # If the classifier is not available, set the pixel value to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
-            if classifier is None:
-                predictions = torch.full((features.size()[0], 1), -2, device='cuda')
-            # Compute pixel predictions with falkon classifier
-            else:
-                predictions = classifier.predict(features)
-            pixels_scores = torch.cat((pixels_scores, predictions), dim=1)
-
-        to_return = torch.empty((0, len(self.classifiers)+1, feat_width, feat_width), device='cuda')    #TODO maybe the loop can be optimized
-        for i in range(int((len(predictions))/(feat_width**2))):
-            to_return = torch.cat((to_return, pixels_scores[i*(feat_width**2):(i+1)*(feat_width**2)].T.reshape(1, len(self.classifiers)+1, feat_width, feat_width)))
-        return to_return
+    def predict_pixel_FALKON(self, features, feat_width, num_rois=None, keep=None):
+        from FALKONMulticlassPredictor import FALKONMulticlassPredictor
+        # Stack the per-class FALKON models, so that the kernel with the Nystrom centers is computed only once for all the pixels
+        if getattr(self, 'fused_classifiers_src', None) is not self.classifiers or len(self.fused_classifiers) != len(self.classifiers):
+            self.fused_classifiers = FALKONMulticlassPredictor.from_models(self.classifiers, device=features.device)
+            self.fused_classifiers_src = self.classifiers
+        num_classes = len(self.classifiers) + 1
+        # Set background class to the default negative value -2. If a classifier is not available, its column is set to the default value -2 as well (which is smaller than all the other proposed values by trained FALKON classifiers)
+        pixels_scores = torch.full((features.size()[0], num_classes), -2, dtype=features.dtype, device=features.device)
+        if features.size()[0] > 0:
+            self.fused_classifiers.predict(features, out=pixels_scores[:, 1:])
+        # Pixels are ordered by ROI, row and column
+        pixels_scores = pixels_scores.view(-1, feat_width, feat_width, num_classes)
+        if keep is not None:
+            # The pixels of the skipped ROIs keep the default value -2 for all the classes
+            all_scores = torch.full((num_rois, feat_width, feat_width, num_classes), -2, dtype=features.dtype, device=features.device)
+            all_scores[keep] = pixels_scores
+            pixels_scores = all_scores
+        return pixels_scores.permute(0, 3, 1, 2)
 
 
 @registry.ROI_MASK_PREDICTOR.register("MaskRCNNConv1x1Predictor")
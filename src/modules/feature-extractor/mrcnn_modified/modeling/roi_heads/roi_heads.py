@@ -19,10 +19,10 @@ class CombinedROIHeads(torch.nn.ModuleDict):
         if cfg.MODEL.MASK_ON and cfg.MODEL.ROI_MASK_HEAD.SHARE_BOX_FEATURE_EXTRACTOR:
             self.mask.feature_extractor = self.box.feature_extractor
 
-    def forward(self, features, proposals, gt_bbox = None, gt_label=None, img_size=[0,0], gt_labels_list=None, is_train=True, result_dir=None, evaluate_segmentation=True, eval_segm_with_gt_bboxes=False):
+    def forward(self, features, proposals, gt_bbox = None, gt_label=None, img_size=[0,0], gt_labels_list=None, is_train=True, result_dir=None, evaluate_segmentation=True, eval_segm_with_gt_bboxes=False, box_features=None):
         losses = {}
         width, height = proposals[0].size
-        x, detections, loss_box = self.box(features, proposals, gt_bbox=gt_bbox, gt_label=gt_label, img_size=img_size, gt_labels_list=gt_labels_list, is_train=is_train, result_dir=result_dir)
+        x, detections, loss_box = self.box(features, proposals, gt_bbox=gt_bbox, gt_label=gt_label, img_size=img_size, gt_labels_list=gt_labels_list, is_train=is_train, result_dir=result_dir, box_features=box_features)
         if type(detections) is list:
             detections = detections[0]
         if detections is None:
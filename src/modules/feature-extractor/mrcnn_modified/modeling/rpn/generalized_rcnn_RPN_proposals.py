@@ -6,7 +6,7 @@ Implements the Generalized R-CNN framework
 import torch
 from torch import nn
 
-from maskrcnn_benchmark.structures.image_list import to_image_list
+from maskrcnn_benchmark.structures.image_list import to_image_list, ImageList
 
 from maskrcnn_benchmark.modeling.backbone import build_backbone
 from .rpn_getProposals import build_rpn
@@ -27,7 +27,7 @@ class GeneralizedRCNN(nn.Module):
         self.backbone = build_backbone(cfg)
         self.rpn = build_rpn(cfg, self.backbone.out_channels)
 
-    def forward(self, images, gt_bbox = None, gt_label = None, img_size = [0,0], compute_average_recall_RPN=False, gt_labels_list = None, is_train = True, result_dir = None, extract_features_segmentation=False):
+    def forward(self, images, gt_bbox = None, gt_label = None, img_size = [0,0], compute_average_recall_RPN=False, gt_labels_list = None, is_train = True, result_dir = None, extract_features_segmentation=False, backbone_features=None):
         """
         Arguments:
             images (list[Tensor] or ImageList): images to be processed
@@ -41,7 +41,28 @@ class GeneralizedRCNN(nn.Module):
 
         """
         images = to_image_list(images)
-        features = self.backbone(images.tensors)
+        # The backbone is skipped if its features are given, e.g. from a BackboneFeatureCache
+        features = self.backbone(images.tensors) if backbone_features is None else backbone_features
         proposals, proposal_losses, average_recall_RPN = self.rpn(images, features, gt_bbox=gt_bbox, img_size=img_size, compute_average_recall_RPN=compute_average_recall_RPN, is_train = is_train, result_dir = result_dir)
         return average_recall_RPN
 
+    def forward_batch(self, images, targets, compute_average_recall_RPN=False, is_train = True, result_dir = None, extract_features_segmentation=False, backbone_features=None):
+        """
+        Batched version of forward, for images of the same size. The backbone processes all the images at once,
+        while the RPN, which collects features for minibootstrap, is run image by image.
+
+        Arguments:
+            images (ImageList): images to be processed
+            targets (list[dict]): for each image, the gt_bbox and img_size arguments of forward
+
+        Returns:
+            average_recall_RPN (list): the average recall of the RPN for each image
+        """
+        features = self.backbone(images.tensors) if backbone_features is None else backbone_features
+        average_recall_RPN = []
+        for j, target in enumerate(targets):
+            image = ImageList(images.tensors[j:j+1], [images.image_sizes[j]])
+            proposals, proposal_losses, average_recall_RPN_j = self.rpn(image, [f[j:j+1] for f in features], gt_bbox=target['gt_bbox'], img_size=target['img_size'], compute_average_recall_RPN=compute_average_recall_RPN, is_train = is_train, result_dir = result_dir)
+            average_recall_RPN.append(average_recall_RPN_j)
+        return average_recall_RPN
+
@@ -12,9 +12,6 @@ from .inference import make_rpn_postprocessor
 
 from .average_recall import compute_average_recall
 
-from joblib import Parallel, delayed, parallel_backend
-import multiprocessing
-
 
 class RPNHeadConvRegressor(nn.Module):
     """
@@ -135,50 +132,27 @@ class RPNHead(nn.Module):
         return logits, bbox_reg
 
     def refine_boxes(self, features):
-        refined_boxes = torch.empty((1, 0, self.height, self.width), device='cuda')
-        for j in range(self.num_clss):
-            # Refine boxes with RLS regressors
-            if self.regressors[j]['Beta'] is not None:
-                weights = torch.empty((0,self.feat_size+1), device='cuda')
-                for k in range(0, 4):
-                    weights = torch.cat((weights, self.regressors[j]['Beta'][str(k)]['weights'].view(1,self.feat_size+1)))
-
-                weights = torch.t(weights)
-                Y = torch.matmul(features, weights[:-1])
-                Y += weights[-1]
-                Y = torch.matmul(Y, self.regressors[j]['T_inv'])
-                Y += self.regressors[j]['mu']
-            # If the regressor is not available, do not refine the boxes
-            else:
-                Y = torch.zeros((self.area, 4), device='cuda')
-            Y = torch.t(Y).reshape(1,4,self.height,self.width)
-            refined_boxes = torch.cat((refined_boxes, Y), dim=1)
+        from region_predictor import StackedRegressors
+        # Stack the anchors' RLS regressors, so that all the anchors are refined with a single matrix product
+        if getattr(self, 'stacked_regressors_src', None) is not self.regressors or len(self.stacked_regressors) != len(self.regressors):
+            self.stacked_regressors = StackedRegressors.from_models(self.regressors, device=features.device)
+            self.stacked_regressors_src = self.regressors
+        # If a regressor is not available, the boxes of its anchor are not refined
+        refined_boxes = torch.empty((1, 4 * self.num_clss, self.height, self.width), device=features.device)
+        # Write the (area x 4A) predictions directly in the (1, 4A, H, W) output
+        self.stacked_regressors.predict(features, out=torch.t(refined_boxes.view(4 * self.num_clss, self.area)))
         return refined_boxes
     
     def compute_objectness_FALKON(self, features):
-        objectness_scores = torch.empty((1, 0, self.height, self.width), device='cuda')
-        for classifier in self.classifiers:
-            # If the classifier is not available, set the objectness to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
-            if classifier is None:
-                predictions = torch.full((self.area, 1), -2, device='cuda')
-            # Compute objectness with falkon classifier
-            else:
-                predictions = classifier.predict(features)
-            objectness_scores = torch.cat((objectness_scores, torch.t(predictions).reshape(1,1,self.height,self.width)), dim=1)
-        return objectness_scores
-
-    def compute_objectness_FALKON_parallel(self, features):
-
-        def compute_score(classifier):
-            # If the classifier is not available, set the objectness to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
-            if classifier is None:
-                return torch.t(torch.full((self.area, 1), -2, device='cuda')).reshape(1,1,self.height,self.width)
-            # Compute objectness with falkon classifier
-            else:
-                return torch.t(classifier.predict(features)).reshape(1,1,self.height,self.width)
-
-        objectness_scores = torch.cat(Parallel(n_jobs=2, prefer="threads", verbose=1)(delayed(compute_score)(self.classifiers[i]) for i in range(len(self.classifiers))), dim=1)
-
+        from FALKONMulticlassPredictor import FALKONMulticlassPredictor
+        # Stack the anchors' FALKON models, so that the kernel with the Nystrom centers is computed only once
+        if getattr(self, 'fused_classifiers_src', None) is not self.classifiers or len(self.fused_classifiers) != len(self.classifiers):
+            self.fused_classifiers = FALKONMulticlassPredictor.from_models(self.classifiers, device=features.device)
+            self.fused_classifiers_src = self.classifiers
+        # If a classifier is not available, its objectness is set to the default value -2 (which is smaller than all the other proposed values by trained FALKON classifiers)
+        objectness_scores = torch.empty((1, len(self.classifiers), self.height, self.width), dtype=features.dtype, device=features.device)
+        # Write the (area x num_anchors) predictions directly in the (1, A, H, W) output
+        self.fused_classifiers.predict(features, out=torch.t(objectness_scores.view(len(self.classifiers), self.area)))
         return objectness_scores
 
 
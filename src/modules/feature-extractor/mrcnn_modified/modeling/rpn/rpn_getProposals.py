@@ -12,12 +12,22 @@ from .inference import make_rpn_postprocessor
 
 from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou, cat_boxlist
 from maskrcnn_benchmark.structures.bounding_box import BoxList
+from mrcnn_modified.utils.feature_store import FeatureStore
+from mrcnn_modified.utils.feature_writer import FeatureWriter
+from mrcnn_modified.utils.feature_cache import FeatureCacheWriter
+from mrcnn_modified.utils.feature_statistics import FeatureStatistics
+from mrcnn_modified.utils.regression_statistics import RegressionStatistics
 import time
 import os
 
 import math
 import copy
 
+# Visible anchors with their feature map position and classifier id, cached per image size, feature map size and anchor configuration.
+# The cache only lives as long as the process: it saves regenerating the anchors at each image of a run, and it is
+# not persisted with the features, since building the anchors of a new run takes a single generator call per size
+ANCHORS_CACHE = {}
+
 class RPNHeadConvRegressor(nn.Module):
     """
     A simple RPN Head for classification and bbox regression
@@ -154,24 +164,25 @@ class RPNModule(torch.nn.Module):
         self.num_classes = self.cfg.MINIBOOTSTRAP.RPN.NUM_CLASSES
         self.iterations = self.cfg.MINIBOOTSTRAP.RPN.ITERATIONS
         self.batch_size = self.cfg.MINIBOOTSTRAP.RPN.BATCH_SIZE
-        self.negatives = []
-        self.positives = []
-        self.current_batch = []
-        self.current_batch_size = []
+        self.negatives = None
+        self.positives = None
+        self.feature_stats = None
+        self.keep_regression_examples = self.cfg.REGRESSORS.KEEP_EXAMPLES
+        # Statistics are needed only if the examples are not kept, or to be saved with the features
+        self.accumulate_regression_stats = not self.keep_regression_examples or self.save_features
+        # Sufficient statistics of the regression examples of each anchor
+        self.regression_stats = RegressionStatistics()
+        self.current_batch = [0] * self.num_classes
         self.neg_iou_thresh = self.cfg.MINIBOOTSTRAP.RPN.NEG_IOU_THRESH
         self.pos_iou_thresh = self.cfg.MINIBOOTSTRAP.RPN.POS_IOU_THRESH
 
-        self.diag_list=[torch.empty(0, dtype=torch.long, device='cuda')]
-        for i in range(50):
-            if i == 0:
-                continue
-            else:
-                self.diag_list.append(torch.arange(0,i**2, i+1, dtype=torch.long, device='cuda'))
         self.negatives_to_pick = None
         try:
             self.training_device = self.cfg.TRAIN_FALKON_REGRESSORS_DEVICE
         except:
             self.training_device = 'cuda'
+        # Full batches are written in background to the feature cache while the extraction goes on
+        self.feature_writer = FeatureWriter(sink=FeatureCacheWriter(dtype=self.cfg.FEATURE_CACHE.DTYPE, device=self.training_device)) if self.save_features else None
 
     def forward(self, images, features, gt_bbox=None, img_size = None, compute_average_recall_RPN = False, is_train = None, result_dir = None):
 
@@ -188,21 +199,7 @@ class RPNModule(torch.nn.Module):
             self.width = features_map_size[2]
 
             # Generate anchors
-            self.anchors = self.anchor_generator(images, features)[0][0]
-
-            self.feature_ids = torch.empty((0, 2), dtype=torch.long, device='cuda')
-            self.classifiers = torch.empty(0, dtype=torch.uint8, device='cuda')
-            # Associate to each feature tensor an id, corresponding to its position and a classifier id corresponding to an anchor value
-            for ind in range(0, int(self.anchors.bbox.size()[0])):
-                feat_ij = [[int(int(ind/self.num_classes)/self.width), int(int(ind/self.num_classes)%self.width)]]
-                self.feature_ids = torch.cat((self.feature_ids, torch.tensor(feat_ij, dtype=torch.long, device='cuda')))
-                cls = [ind %self.num_classes]
-                self.classifiers = torch.cat((self.classifiers, torch.tensor(cls, dtype=torch.uint8, device='cuda')))
-            self.anchors.add_field('feature_id', self.feature_ids)
-            self.anchors.add_field('classifier', self.classifiers)
-            # Remove features with borders external to the image
-            self.visible_anchors = self.anchors.get_field('visibility')
-            self.anchors = self.anchors[self.visible_anchors]
+            self.anchors = self.compute_anchors(images, features)
             # Avoid computing unuseful regions
             self.still_to_complete = list(range(self.num_classes))
             for i in self.still_to_complete:
@@ -212,34 +209,33 @@ class RPNModule(torch.nn.Module):
                     if self.save_features:
                         # Saving empty tensors
                         path_to_save = os.path.join(result_dir, 'features_RPN', 'negatives_cl_{}_batch_{}'.format(i, 0))
-                        torch.save(torch.empty((0, self.feat_size), device=self.training_device), path_to_save)
+                        self.feature_writer.save(torch.empty((0, self.feat_size), device=self.training_device), path_to_save)
 
                         path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(i, 0))
-                        torch.save(torch.empty((0, self.feat_size), device=self.training_device), path_to_save)
+                        self.feature_writer.save(torch.empty((0, self.feat_size), device=self.training_device), path_to_save)
             self.anchors_ids = copy.deepcopy(self.still_to_complete)
 
-            # Initialize batches for minibootstrap
-            for i in range(self.num_classes):
-                self.negatives.append([])
-                self.current_batch.append(0)
-                self.current_batch_size.append(0)
-                self.positives.append([torch.empty((0, self.feat_size), device=self.training_device)])
-                for j in range(self.iterations):
-                    self.negatives[i].append(torch.empty((0, self.feat_size), device=self.training_device))
+            # Initialize preallocated batches for minibootstrap and the statistics of their features
+            self.feature_stats = FeatureStatistics()
+            self.negatives = FeatureStore(self.num_classes, self.feat_size, self.batch_size, num_batches=self.iterations, device=self.training_device, writer=self.feature_writer, stats=self.feature_stats.negatives)
+            self.positives = FeatureStore(self.num_classes, self.feat_size, self.batch_size, device=self.training_device, writer=self.feature_writer, stats=self.feature_stats.positives)
 
             # Initialize tensors for box regression
             # Regressor features
-            self.X = [torch.empty((0, self.feat_size), dtype=torch.float32, device=self.training_device)]
+            self.X = FeatureStore(1, self.feat_size, self.batch_size, device=self.training_device, writer=self.feature_writer)
             # Regressor target values
-            self.Y = [torch.empty((0, 4), dtype=torch.float32, device=self.training_device)]
+            self.Y = FeatureStore(1, 4, self.batch_size, device=self.training_device, writer=self.feature_writer)
             # Regressor overlap amounts
             self.O = None
             # Regressor classes
-            self.C = [torch.empty((0), dtype=torch.float32, device=self.training_device)]
+            self.C = FeatureStore(1, 1, self.batch_size, device=self.training_device, writer=self.feature_writer)
             
         else:
             features = features[0][0]
 
+        # Flatten the features map to (H*W, D), so that anchor features are gathered with linear indices
+        features = features.permute(1, 2, 0).reshape(self.height * self.width, self.feat_size)
+
         anchors_to_return = self.anchors.copy_with_fields(self.anchors.fields())
         # Resize ground truth boxes to anchors dimensions
         gt_bbox = gt_bbox.resize(anchors_to_return.size)
@@ -272,37 +268,22 @@ class RPNModule(torch.nn.Module):
             # Initialize index of chosen negatives among all the negatives to pick
             ind_to_add = 0
             for b in range(self.current_batch[i], self.iterations):
-                # If the batch is full, start from the subsequent
-                if self.negatives[i][b].size()[0] >= self.batch_size:
-                    # If features must be saved, save full batches and replace the batch in gpu with an empty tensor
-                    if self.save_features:
-                        path_to_save = os.path.join(result_dir, 'features_RPN', 'negatives_cl_{}_batch_{}'.format(i, b))
-                        torch.save(self.negatives[i][b], path_to_save)
-                        self.negatives[i][b] = torch.empty((0, self.feat_size), device=self.training_device)
-                    self.current_batch[i] += 1
-                    if self.current_batch[i] >= self.iterations:
-                        indices_to_remove.append(i)
-                    continue
-
-                else:
-                    # Compute the end index of negatives to add to the batch
-                    end_interval = int(ind_to_add + min(reg_to_add, self.batch_size - self.negatives[i][b].size()[0], self.negatives_to_pick - ind_to_add, ids_size -ind_to_add))
-                    # Extract features corresponding to the ids and add them to the ids
-                    # Diagonal choice done for computational efficiency
-                    feat = torch.index_select(features, 1, ids[ind_to_add:end_interval, 0])
-                    feat = torch.index_select(feat, 2, ids[ind_to_add:end_interval, 1]).permute(1,2,0).view((end_interval-ind_to_add)**2,self.feat_size)
-                    try:
-                        feat = feat[self.diag_list[end_interval-ind_to_add]]
-                    except:
-                        feat = feat[list(range(0,(end_interval-ind_to_add)**2+(end_interval-ind_to_add)-1, (end_interval-ind_to_add)+1))]
-                    if self.training_device is 'cpu':
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], feat.cpu()))
-                    else:
-                        self.negatives[i][b] = torch.cat((self.negatives[i][b], feat))
-                    # Update indices
-                    ind_to_add = end_interval
-                    if ind_to_add == self.negatives_to_pick:
-                        break
+                # Compute the end index of negatives to add to the batch
+                end_interval = min(ind_to_add + reg_to_add, self.negatives_to_pick, ids_size)
+                # Extract features corresponding to the ids and add them to the batch
+                ind_to_add += self.negatives.append(i, b, self.gather_features(features, ids[ind_to_add:end_interval]))
+                # If features must be saved, save full batches and release their memory
+                if self.save_features and self.negatives.is_full(i, b):
+                    path_to_save = os.path.join(result_dir, 'features_RPN', 'negatives_cl_{}_batch_{}'.format(i, b))
+                    self.negatives.save_batch(i, b, path_to_save)
+                    self.negatives.release(i, b)
+                if ind_to_add >= min(self.negatives_to_pick, ids_size):
+                    break
+            # Skip the batches already completed
+            while self.current_batch[i] < self.iterations and self.negatives.is_closed(i, self.current_batch[i]):
+                self.current_batch[i] += 1
+            if self.current_batch[i] >= self.iterations:
+                indices_to_remove.append(i)
         # Check to avoid unuseful computations
         for index in indices_to_remove:
             self.still_to_complete.remove(index)
@@ -328,27 +309,19 @@ class RPNModule(torch.nn.Module):
                 
         # Find anchors associated to the positives, to avoid unuseful computation
         pos_inds = torch.unique(positive_anchors.get_field('classifier'))
+        # Regression examples of all the anchors, added at once to the statistics
+        regression_examples = []
         for i in pos_inds:
             anchors_i = positive_anchors[positive_anchors.get_field('classifier')==i]
             ids = anchors_i.get_field('feature_id')
             ids_size = ids.size()[0]
-            feat = torch.index_select(features, 1, ids[:,0])
-            feat = torch.index_select(feat, 2, ids[:,1]).permute(1,2,0).view(ids_size**2,self.feat_size)
-            try:
-                feat = feat[self.diag_list[ids_size]]
-            except:
-                feat = feat[list(range(0,ids_size**2+ids_size-1, ids_size+1))]
+            feat = self.gather_features(features, ids)
             # Add positive features for the i-th anchor to the i-th positives list
-            if self.training_device is 'cpu':
-                self.positives[i][len(self.positives[i]) - 1] = torch.cat((self.positives[i][len(self.positives[i]) - 1], feat.cpu()))
-            else:
-                self.positives[i][len(self.positives[i]) - 1] = torch.cat((self.positives[i][len(self.positives[i]) - 1], feat))
-            if self.positives[i][len(self.positives[i]) - 1].size()[0] >= self.batch_size:
+            for batch in self.positives.extend(i, feat):
                 if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(i, len(self.positives[i]) - 1))
-                    torch.save(self.positives[i][len(self.positives[i]) - 1], path_to_save)
-                    self.positives[i][len(self.positives[i]) - 1] = torch.empty((0, self.feat_size), device=self.training_device)
-                self.positives[i].append(torch.empty((0, self.feat_size), device=self.training_device))
+                    path_to_save = os.path.join(result_dir, 'features_RPN', 'positives_cl_{}_batch_{}'.format(i, batch))
+                    self.positives.save_batch(i, batch, path_to_save)
+                    self.positives.release(i, batch)
 
             # COXY computation for regressors
             ex_boxes = anchors_i.bbox
@@ -370,35 +343,43 @@ class RPNModule(torch.nn.Module):
             dst_scl_h = torch.log(gt_h / src_h)
 
             target = torch.stack((dst_ctr_x, dst_ctr_y, dst_scl_w, dst_scl_h), dim=1)
-            if self.training_device is 'cpu':
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target.cpu()), dim=0)
-                # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((ids_size,1), i, dtype=torch.float32)))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], feat.cpu()))
-            else:
-                self.Y[len(self.Y)-1] = torch.cat((self.Y[len(self.Y)-1], target), dim=0)
-                # Add class and features to C and X
-                self.C[len(self.C)-1] = torch.cat((self.C[len(self.C)-1], torch.full((ids_size,1), i, dtype=torch.float32, device='cuda')))
-                self.X[len(self.X)-1] = torch.cat((self.X[len(self.X)-1], feat))
-            if self.X[len(self.X)-1].size()[0] >= self.batch_size:
+            if self.accumulate_regression_stats:
+                regression_examples.append((torch.full((ids_size,), int(i), dtype=torch.long, device=target.device), feat, target))
+            if not self.keep_regression_examples:
+                continue
+            # Add targets, classes and features to Y, C and X
+            self.Y.extend(0, target)
+            self.C.extend(0, torch.full((ids_size, 1), i, dtype=torch.float32, device=target.device))
+            for batch in self.X.extend(0, feat):
                 if self.save_features:
-                    path_to_save = os.path.join(result_dir, 'features_RPN','reg_x_batch_{}'.format(len(self.X)-1))
-                    torch.save(self.X[len(self.X)-1], path_to_save)
-                    self.X[len(self.X)-1] = torch.empty((0, self.feat_size), dtype=torch.float32, device=self.training_device)
+                    for name, store in (('x', self.X), ('c', self.C), ('y', self.Y)):
+                        path_to_save = os.path.join(result_dir, 'features_RPN', 'reg_{}_batch_{}'.format(name, batch))
+                        store.save_batch(0, batch, path_to_save)
+                        store.release(0, batch)
 
-                    path_to_save = os.path.join(result_dir, 'features_RPN','reg_c_batch_{}'.format(len(self.C)-1))
-                    torch.save(self.C[len(self.C)-1], path_to_save)
-                    self.C[len(self.C)-1] = torch.empty((0), dtype=torch.float32, device=self.training_device)
+        if regression_examples:
+            C, X, Y = zip(*regression_examples)
+            self.regression_stats.update_batch(torch.cat(C), torch.cat(X).to(self.training_device), torch.cat(Y))
 
-                    path_to_save = os.path.join(result_dir, 'features_RPN','reg_y_batch_{}'.format(len(self.Y)-1))
-                    torch.save(self.Y[len(self.Y)-1], path_to_save)
-                    self.Y[len(self.Y)-1] = torch.empty((0, 4), dtype=torch.float32, device=self.training_device)
+        return {}, {}, 0
 
-                self.X.append(torch.empty((0, self.feat_size), dtype=torch.float32, device=self.training_device))
-                self.C.append(torch.empty((0), dtype=torch.float32, device=self.training_device))
-                self.Y.append(torch.empty((0, 4), dtype=torch.float32, device=self.training_device))
+    def compute_anchors(self, images, features):
+        anchors_cfg = self.cfg.MODEL.RPN
+        key = (tuple(images.image_sizes[0]), self.height, self.width, self.num_classes, tuple(anchors_cfg.ANCHOR_SIZES),
+               tuple(anchors_cfg.ASPECT_RATIOS), tuple(anchors_cfg.ANCHOR_STRIDE), anchors_cfg.STRADDLE_THRESH)
+        if key not in ANCHORS_CACHE:
+            anchors = self.anchor_generator(images, features)[0][0]
+            # Associate to each anchor the linear id of its position in the features map and a classifier id corresponding to an anchor value
+            ind = torch.arange(anchors.bbox.size()[0], dtype=torch.long, device=anchors.bbox.device)
+            anchors.add_field('feature_id', ind // self.num_classes)
+            anchors.add_field('classifier', (ind % self.num_classes).to(torch.uint8))
+            # Remove features with borders external to the image
+            ANCHORS_CACHE[key] = anchors[anchors.get_field('visibility')]
+        return ANCHORS_CACHE[key]
 
-        return {}, {}, 0
+    def gather_features(self, features, ids):
+        # Extract the features at the linear ids of the flattened (H*W, D) features map
+        return torch.index_select(features, 0, ids)
 
 def build_rpn(cfg, in_channels):
     """
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import torch
+
+
+class BackboneFeatureCache():
+    """
+    Cache of the backbone feature maps (e.g. the C4 maps) of the images of a dataset, stored in float16, so
+    that a second extraction on the same images (e.g. the detector's features after the RPN's ones) does not
+    run the backbone again. Maps are kept in RAM or, if path is given, appended to a memory-mapped file.
+    At most max_bytes are cached: the maps of the images that do not fit are computed again.
+    The cache is bound to a key (see bind) describing the backbone and the input pipeline, and it is emptied
+    when it is bound to a different one.
+    """
+
+    def __init__(self, path=None, max_bytes=None, dtype='float16'):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.key = None
+        self.file = None
+        self.clear()
+
+    @staticmethod
+    def make_key(cfg, is_train):
+        # Features can be reused only with the same weights, backbone, input transforms and images
+        return (cfg.MODEL.WEIGHT, cfg.MODEL.BACKBONE.CONV_BODY, str(cfg.INPUT), tuple(cfg.DATASETS.TRAIN if is_train else cfg.DATASETS.TEST))
+
+    def bind(self, key):
+        if key != self.key:
+            self.clear()
+            self.key = key
+
+    def clear(self):
+        # For each image, the (offset, shape, dtype) of its maps in the file, or the maps themselves in RAM
+        self.entries = {}
+        self.num_bytes = 0
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None:
+            # Files of a previous run are overwritten
+            self.file = open(self.path, 'wb')
+
+    def close(self):
+        self.entries = {}
+        self.num_bytes = 0
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, index, features):
+        # Store the maps of an image, a list of (1 x C x H x W) tensors, one for each level of the backbone
+        size = sum(f.numel() for f in features) * self.dtype.itemsize
+        if index in self.entries or (self.max_bytes is not None and self.num_bytes + size > self.max_bytes):
+            return False
+        if self.file is None:
+            self.entries[index] = [(f.detach().to('cpu', dtype=torch.float16), f.dtype) for f in features]
+        else:
+            entry = []
+            for f in features:
+                array = np.ascontiguousarray(f.detach().to('cpu').numpy(), dtype=self.dtype)
+                entry.append((self.file.tell(), array.shape, f.dtype))
+                self.file.write(array.tobytes())
+            self.entries[index] = entry
+        self.num_bytes += size
+        return True
+
+    def get(self, index, device='cuda'):
+        # Maps of an image, in the type they were computed with, or None if they are not cached
+        if index not in self.entries:
+            return None
+        if self.file is None:
+            return [f.to(device, dtype=dtype) for f, dtype in self.entries[index]]
+        self.file.flush()
+        return [torch.from_numpy(np.array(np.memmap(self.path, dtype=self.dtype, mode='r', offset=offset, shape=shape))).to(device, dtype=dtype)
+                for offset, shape, dtype in self.entries[index]]
+
+    def put_batch(self, indices, features):
+        # Store the maps of a batch of images, given as a list of (N x C x H x W) tensors
+        for j, index in enumerate(indices):
+            self.put(index, [f[j:j+1] for f in features])
+
+    def get_batch(self, indices, device='cuda'):
+        # Maps of a batch of images of the same size, or None if any of them is not cached
+        if any(index not in self.entries for index in indices):
+            return None
+        features = [self.get(index, device=device) for index in indices]
+        return [torch.cat(level) for level in zip(*features)]
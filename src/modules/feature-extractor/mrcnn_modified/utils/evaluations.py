@@ -16,3 +16,20 @@ def compute_overlap_torch(gt, prop):
     overlap = torch.where((ymax - ymin + 1) > 0, overlap, torch.zeros(overlap.size(), device='cuda'))
 
     return overlap
+
+
+def compute_overlaps_torch(gts, props):
+    # Pairwise version of compute_overlap_torch: (G x P) overlaps of each gt with each proposal
+    xmin = torch.max(gts[:, None, 0], props[None, :, 0])
+    ymin = torch.max(gts[:, None, 1], props[None, :, 1])
+    xmax = torch.min(gts[:, None, 2], props[None, :, 2])
+    ymax = torch.min(gts[:, None, 3], props[None, :, 3])
+    inter_w = xmax - xmin + 1
+    inter_h = ymax - ymin + 1
+    intersection_area = inter_w * inter_h
+    gt_area = (gts[:, 2] - gts[:, 0] + 1) * (gts[:, 3] - gts[:, 1] + 1)
+    pred_area = (props[:, 2] - props[:, 0] + 1) * (props[:, 3] - props[:, 1] + 1)
+    overlap = intersection_area / (gt_area[:, None] + pred_area[None, :] - intersection_area)
+    overlap = torch.where((inter_w > 0) & (inter_h > 0), overlap, torch.zeros_like(overlap))
+
+    return overlap
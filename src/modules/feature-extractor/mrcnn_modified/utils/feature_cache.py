@@ -0,0 +1,137 @@
+import json
+import os
+import re
+import threading
+
+import numpy as np
+import torch
+
+INDEX_FILE = 'index.json'
+# Names of the batches saved by the heads, e.g. negatives_cl_3_batch_1 or reg_x_batch_0
+BATCH_NAME = re.compile(r'^(?P<entry>.+)_batch_(?P<batch>\d+)$')
+# Entries always stored in float32, since they contain classes and regression targets
+FULL_PRECISION_ENTRIES = ('reg_c', 'reg_y')
+
+
+class FeatureCacheWriter():
+    """
+    Writer of the feature cache, i.e. one contiguous binary file for each entry of a features directory
+    (e.g. positives_cl_3 or reg_x) plus a JSON index with the shape, dtype and position of each saved batch.
+    It has the same save(feats, path) interface of torch.save, so that it can replace it as a FeatureWriter sink.
+    The index of each features directory is written by close.
+    """
+
+    def __init__(self, dtype='float32', device='cuda'):
+        self.dtype = np.dtype(dtype)
+        # Device where the features are loaded back by default
+        self.device = device
+        self.lock = threading.Lock()
+        self.indices = {}
+
+    def save(self, feats, path):
+        features_dir, file_name = os.path.split(path)
+        match = BATCH_NAME.match(file_name)
+        if match is None:
+            raise ValueError('Cannot derive the cache entry from the file name {}'.format(file_name))
+        name, batch = match.group('entry'), match.group('batch')
+        dtype = np.dtype('float32') if name in FULL_PRECISION_ENTRIES else self.dtype
+        array = np.ascontiguousarray(feats.detach().to('cpu').numpy(), dtype=dtype)
+
+        with self.lock:
+            index = self.indices.setdefault(features_dir, {})
+            if name not in index:
+                # Files of a previous run are overwritten
+                open(os.path.join(features_dir, name + '.bin'), 'wb').close()
+                index[name] = {'file': name + '.bin',
+                               'dtype': dtype.name,
+                               'item_shape': list(array.shape[1:]),
+                               'device': str(self.device),
+                               'rows': 0,
+                               'batches': {}}
+            entry = index[name]
+            if list(array.shape[1:]) != entry['item_shape'] and array.shape[0] > 0:
+                raise ValueError('Batch {} of {} has shape {}, expected {}'.format(batch, name, list(array.shape), entry['item_shape']))
+            with open(os.path.join(features_dir, entry['file']), 'ab') as f:
+                f.write(array.tobytes())
+            entry['batches'][batch] = [entry['rows'], array.shape[0]]
+            entry['rows'] += array.shape[0]
+
+    def close(self):
+        with self.lock:
+            for features_dir, index in self.indices.items():
+                with open(os.path.join(features_dir, INDEX_FILE), 'w') as f:
+                    json.dump(index, f)
+
+
+class FeatureCache():
+    """
+    Reader of the feature cache written by FeatureCacheWriter. Entries are memory-mapped, so loading them
+    does not copy nor deserialize the features until they are moved to another device or type.
+    """
+
+    def __init__(self, features_dir):
+        self.features_dir = features_dir
+        with open(os.path.join(features_dir, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+
+    @staticmethod
+    def exists(features_dir):
+        return os.path.exists(os.path.join(features_dir, INDEX_FILE))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def num_classes(self):
+        # Number of classes with positives or negatives saved in the cache
+        ids = [int(name.rsplit('_', 1)[1]) for name in self.index if name.startswith(('positives_cl_', 'negatives_cl_'))]
+        return max(ids) + 1 if ids else 0
+
+    def device(self, name):
+        # Device the features of an entry were extracted on, where they are loaded by default
+        return self.index[name]['device']
+
+    def rows(self, name):
+        return self.index[name]['rows']
+
+    def _batches(self, entry):
+        # (start, rows) of the batches of an entry in its file, ordered by batch id
+        return [tuple(position) for _, position in sorted(entry['batches'].items(), key=lambda item: int(item[0]))]
+
+    def _map(self, entry):
+        # Copy-on-write mapping, so that the tensors are writable without touching the file
+        return np.memmap(os.path.join(self.features_dir, entry['file']), dtype=entry['dtype'], mode='c',
+                         shape=tuple([entry['rows']] + entry['item_shape']))
+
+    def map_batches(self, name):
+        # List of the batches of an entry, ordered by batch id, as cpu tensors mapped on the file in the stored
+        # dtype. Rows are only read when they are accessed, e.g. indexed or converted
+        entry = self.index[name]
+        if entry['rows'] == 0:
+            return [torch.empty(tuple([0] + entry['item_shape']), dtype=torch.float32) for _ in entry['batches']]
+        mapped = self._map(entry)
+        return [torch.from_numpy(mapped[start:start + rows]) for start, rows in self._batches(entry)]
+
+    def load_rows(self, name, ids, device=None):
+        # Rows ids of an entry, indexed as in load (i.e. by batch id), reading only those rows from the file
+        entry = self.index[name]
+        device = self.device(name) if device is None else device
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return torch.empty(tuple([0] + entry['item_shape']), dtype=torch.float32, device=device)
+        file_rows = np.concatenate([np.arange(start, start + rows) for start, rows in self._batches(entry)])
+        return torch.from_numpy(np.asarray(self._map(entry)[file_rows[ids]])).to(device=device, dtype=torch.float32)
+
+    def load_batches(self, name, device=None):
+        # List of the batches of an entry, ordered by batch id. If device is None, they are loaded on the device
+        # the features were extracted on
+        device = self.device(name) if device is None else device
+        return [batch.to(device=device, dtype=torch.float32) for batch in self.map_batches(name)]
+
+    def load(self, name, device=None):
+        # Whole entry, as a single (rows x item_shape) tensor. Batches are concatenated by batch id, since the
+        # threads of the FeatureWriter can append them to the file in a different order
+        batches = self.load_batches(name, device=device)
+        if len(batches) == 0:
+            entry = self.index[name]
+            return torch.empty(tuple([0] + entry['item_shape']), dtype=torch.float32, device=self.device(name) if device is None else device)
+        return batches[0] if len(batches) == 1 else torch.cat(batches)
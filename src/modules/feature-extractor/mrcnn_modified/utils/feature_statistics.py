@@ -0,0 +1,144 @@
+import torch
+
+# Name of the file where the statistics are saved, in the features directory
+STATS_FILE = 'feature_stats'
+
+
+class RunningStatistics():
+    """
+    Streaming mean and variance (Welford's algorithm, with the batch update of Chan et al.) of a set of
+    features, plus the mean of their norms. Features are accumulated in float64 on the device they come from,
+    so that updating the statistics does not synchronize with the gpu.
+    Two accumulators can be combined with merge, e.g. those of different workers.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.mean_norm = None
+
+    def update(self, feats):
+        n = feats.size()[0]
+        if n == 0:
+            return
+        feats = feats.reshape(n, -1).to(torch.float64)
+        batch_mean = feats.mean(dim=0)
+        batch_m2 = ((feats - batch_mean) ** 2).sum(dim=0)
+        batch_mean_norm = torch.norm(feats, dim=1).mean()
+        self._combine(n, batch_mean, batch_m2, batch_mean_norm)
+
+    def merge(self, other):
+        if other.count > 0:
+            device = other.mean.device if self.count == 0 else self.mean.device
+            self._combine(other.count, other.mean.to(device, copy=True), other.m2.to(device, copy=True), other.mean_norm.to(device, copy=True))
+        return self
+
+    def _combine(self, n, mean, m2, mean_norm):
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.mean_norm = n, mean, m2, mean_norm
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * n / total)
+        self.mean_norm = self.mean_norm + (mean_norm - self.mean_norm) * (n / total)
+        self.count = total
+
+    def var(self):
+        # Population variance of the features seen so far
+        return self.m2 / self.count
+
+    def state_dict(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.mean.cpu(), 'm2': self.m2.cpu(), 'mean_norm': self.mean_norm.cpu()}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        stats = cls()
+        if state['count'] > 0:
+            stats.count, stats.mean, stats.m2, stats.mean_norm = state['count'], state['mean'], state['m2'], state['mean_norm']
+        return stats
+
+
+class ClassStatistics():
+    """
+    RunningStatistics of each class. It can be given as stats to a FeatureStore, which updates it with the
+    features it stores.
+    """
+
+    def __init__(self):
+        self.classes = {}
+
+    def update(self, clss, feats):
+        self.classes.setdefault(int(clss), RunningStatistics()).update(feats)
+
+    def merge(self, other):
+        for clss, stats in other.classes.items():
+            self.classes.setdefault(clss, RunningStatistics()).merge(stats)
+        return self
+
+    def non_empty(self):
+        return [stats for _, stats in sorted(self.classes.items()) if stats.count > 0]
+
+    def state_dict(self):
+        return {clss: stats.state_dict() for clss, stats in self.classes.items()}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        class_stats = cls()
+        class_stats.classes = {int(clss): RunningStatistics.from_state_dict(s) for clss, s in state.items()}
+        return class_stats
+
+
+class FeatureStatistics():
+    """
+    Statistics of the positives and of the negatives extracted for each class, updated while the features are
+    produced, so that the normalization statistics do not require another pass over the features.
+    compute returns the same statistics of computeFeatStatistics_torch, which samples a fraction pos_fraction
+    of the features from the positives and the rest from the negatives, evenly from each class.
+    """
+
+    def __init__(self):
+        self.positives = ClassStatistics()
+        self.negatives = ClassStatistics()
+
+    def merge(self, other):
+        self.positives.merge(other.positives)
+        self.negatives.merge(other.negatives)
+        return self
+
+    def is_empty(self):
+        return not self.positives.non_empty() and not self.negatives.non_empty()
+
+    def compute(self, pos_fraction=None, device='cuda'):
+        if pos_fraction is None:
+            pos_fraction = 1/10
+        positives = self.positives.non_empty()
+        negatives = self.negatives.non_empty()
+        # Mixture of the statistics of each class, weighted as the samples taken from them
+        components = [(pos_fraction, s) for s in positives] + [(1 - pos_fraction, s) for s in negatives]
+        device = components[0][1].mean.device if device is None else device
+        total = sum(w for w, _ in components)
+        mean = sum(w * s.mean.to(device) for w, s in components) / total
+        var = sum(w * (s.var().to(device) + (s.mean.to(device) - mean) ** 2) for w, s in components) / total
+        mean_norm = sum(w * s.mean_norm.to(device) for w, s in components) / total
+        return {'mean': mean.float(), 'std': var.sqrt().float(), 'mean_norm': mean_norm.float()}
+
+    def state_dict(self):
+        return {'positives': self.positives.state_dict(), 'negatives': self.negatives.state_dict()}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        stats = cls()
+        stats.positives = ClassStatistics.from_state_dict(state['positives'])
+        stats.negatives = ClassStatistics.from_state_dict(state['negatives'])
+        return stats
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path):
+        return cls.from_state_dict(torch.load(path))
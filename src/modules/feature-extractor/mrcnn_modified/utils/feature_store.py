@@ -0,0 +1,128 @@
+import torch
+
+
+class FeatureStore():
+    """
+    Per-class storage of the feature batches collected for minibootstrap.
+    Each batch is a preallocated tensor with batch_size rows, filled through a cursor, so that appending
+    features never copies the ones already stored. Released batches (e.g. after being saved to disk) give
+    their memory back to a pool, from which the next batches are taken.
+    If num_batches is given, each class has that fixed number of batches, otherwise batches are added
+    to a class as the previous ones are filled.
+    If a writer (e.g. a FeatureWriter) is given, saved batches are handed to it instead of being written
+    synchronously.
+    If stats (e.g. a ClassStatistics) is given, it is updated with the features added to each class.
+    """
+
+    def __init__(self, num_classes, item_shape, batch_size, num_batches=None, device='cuda', dtype=torch.float32, writer=None, stats=None):
+        self.item_shape = tuple(item_shape) if isinstance(item_shape, (tuple, list)) else (item_shape,)
+        self.batch_size = batch_size
+        self.fixed_num_batches = num_batches
+        self.device = device
+        self.dtype = dtype
+        self.writer = writer
+        self.stats = stats
+        self.storage = []
+        self.sizes = []
+        # Released batches, which must not be filled again
+        self.released = []
+        self.pool = []
+        for i in range(num_classes):
+            self.add_class()
+
+    def add_class(self):
+        num_batches = self.fixed_num_batches if self.fixed_num_batches is not None else 1
+        self.storage.append([None] * num_batches)
+        self.sizes.append([0] * num_batches)
+        self.released.append([False] * num_batches)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, clss):
+        return [self.batch(clss, b) for b in range(self.num_batches(clss))]
+
+    def num_batches(self, clss):
+        return len(self.sizes[clss])
+
+    def size(self, clss, batch):
+        return self.sizes[clss][batch]
+
+    def is_full(self, clss, batch):
+        return self.sizes[clss][batch] >= self.batch_size
+
+    def is_empty(self, clss):
+        # True if no features have ever been added to the class
+        return not any(self.released[clss]) and sum(self.sizes[clss]) == 0
+
+    def is_closed(self, clss, batch):
+        # A batch is closed if it is full or if it has been released
+        return self.released[clss][batch] or self.is_full(clss, batch)
+
+    def batch(self, clss, batch):
+        # View of the filled part of the batch
+        if self.storage[clss][batch] is None:
+            return torch.empty((0,) + self.item_shape, dtype=self.dtype, device=self.device)
+        return self.storage[clss][batch][:self.sizes[clss][batch]]
+
+    def append(self, clss, batch, feats):
+        # Copy in the batch as many features as it can contain and return how many were added
+        to_add = min(feats.size()[0], self.batch_size - self.sizes[clss][batch])
+        if to_add <= 0 or self.released[clss][batch]:
+            return 0
+        if self.storage[clss][batch] is None:
+            self.storage[clss][batch] = self.pool.pop() if self.pool else torch.empty((self.batch_size,) + self.item_shape, dtype=self.dtype, device=self.device)
+        start = self.sizes[clss][batch]
+        self.storage[clss][batch][start:start + to_add].copy_(feats[:to_add].reshape((to_add,) + self.item_shape))
+        self.sizes[clss][batch] += to_add
+        if self.stats is not None:
+            self.stats.update(clss, feats[:to_add])
+        return to_add
+
+    def extend(self, clss, feats):
+        # Append features to the last batch of a class, adding new batches when needed.
+        # Return the ids of the batches that have been filled
+        filled = []
+        added = 0
+        while added < feats.size()[0]:
+            if self.is_closed(clss, -1):
+                self.storage[clss].append(None)
+                self.sizes[clss].append(0)
+                self.released[clss].append(False)
+            batch = self.num_batches(clss) - 1
+            added += self.append(clss, batch, feats[added:])
+            if self.is_full(clss, batch):
+                filled.append(batch)
+        return filled
+
+    def release(self, clss, batch):
+        # Free the batch (e.g. after saving it) and recycle its memory. The batch is kept as an empty one
+        if self.storage[clss][batch] is not None:
+            self.pool.append(self.storage[clss][batch])
+        self.storage[clss][batch] = None
+        self.sizes[clss][batch] = 0
+        self.released[clss][batch] = True
+
+    def save_batch(self, clss, batch, path):
+        feats = self.batch(clss, batch)
+        if self.writer is not None:
+            # The writer copies the features, so the batch can be released as soon as this returns
+            self.writer.save(feats, path)
+            return
+        # Partial batches are cloned, otherwise the whole preallocated tensor would be serialized
+        torch.save(feats if self.is_full(clss, batch) else feats.clone(), path)
+
+    def save_remaining(self, clss, path_format, save_empty=False):
+        # Save the batches of a class still in memory. path_format is formatted with the clss and batch keywords.
+        # If save_empty is True and the class never received features, an empty batch is saved
+        if save_empty and self.is_empty(clss):
+            self.save_batch(clss, 0, path_format.format(clss=clss, batch=0))
+        for batch in range(self.num_batches(clss)):
+            if self.size(clss, batch) > 0:
+                self.save_batch(clss, batch, path_format.format(clss=clss, batch=batch))
+
+    def cat(self, clss):
+        return torch.cat(self[clss])
+
+    def to_list(self):
+        return [self[clss] for clss in range(len(self))]
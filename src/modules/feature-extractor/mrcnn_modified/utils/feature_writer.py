@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class FeatureWriter():
+    """
+    Background writer for the feature batches saved during the extraction.
+    Each batch is copied to (pinned) host memory on the current stream and serialized with torch.save by a pool
+    of threads, so that the extraction loop does not wait for the disk. At most max_pending batches can be waiting
+    to be written: when the queue is full, save blocks until a write completes.
+    Batches are written with torch.save, unless a sink with save(feats, path) and close() methods
+    (e.g. a FeatureCacheWriter) is given.
+    """
+
+    def __init__(self, num_workers=2, max_pending=4, sink=None):
+        self.sink = sink
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def save(self, feats, path):
+        self.slots.acquire()
+        try:
+            if feats.is_cuda:
+                host_feats = torch.empty(feats.size(), dtype=feats.dtype, pin_memory=True)
+                host_feats.copy_(feats, non_blocking=True)
+                # The worker waits for the copy before writing, the extraction goes on in the meantime
+                copy_done = torch.cuda.Event()
+                copy_done.record()
+            else:
+                host_feats = feats.clone()
+                copy_done = None
+            future = self.executor.submit(self._write, host_feats, path, copy_done)
+        except:
+            self.slots.release()
+            raise
+        with self.lock:
+            # Completed writes are forgotten, failed ones are kept to be reported by flush
+            self.pending = [f for f in self.pending if not f.done() or f.exception() is not None]
+            self.pending.append(future)
+
+    def _write(self, feats, path, copy_done):
+        try:
+            if copy_done is not None:
+                copy_done.synchronize()
+            if self.sink is not None:
+                self.sink.save(feats, path)
+            else:
+                torch.save(feats, path)
+        finally:
+            self.slots.release()
+
+    def flush(self):
+        # Wait for all the pending writes, raising the first error encountered
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        if self.sink is not None:
+            self.sink.close()
@@ -0,0 +1,127 @@
+import torch
+
+# Name of the file where the statistics are saved, in the features directory
+REGRESSION_STATS_FILE = 'regression_stats'
+
+
+class RegressionStatistics():
+    """
+    Sufficient statistics of the ridge regressions of the region refiner, for each class: XᵀX and XᵀY, where X
+    are the regression features extended with a bias column and Y the regression targets, and YᵀY.
+    The number of examples and the sums of X and Y are in the bias row of XᵀX and XᵀY.
+    Statistics are accumulated in float64 while the examples are produced, so that the refiner can be trained
+    without keeping the examples (COXY), in O(classes x features^2) memory.
+    """
+
+    def __init__(self):
+        self.classes = {}
+
+    def __contains__(self, clss):
+        return int(clss) in self.classes
+
+    def __getitem__(self, clss):
+        return self.classes[int(clss)]
+
+    def update(self, clss, X, Y):
+        # Add the examples X (features) and Y (targets) of a class
+        if X.size()[0] == 0:
+            return
+        X = X.reshape(X.size()[0], -1).to(torch.float64)
+        Y = Y.reshape(Y.size()[0], -1).to(device=X.device, dtype=torch.float64)
+        X = torch.cat((X, torch.ones((X.size()[0], 1), dtype=torch.float64, device=X.device)), dim=1)
+        XX = torch.matmul(torch.t(X), X)
+        XY = torch.matmul(torch.t(X), Y)
+        YY = torch.matmul(torch.t(Y), Y)
+        clss = int(clss)
+        if clss not in self.classes:
+            self.classes[clss] = {'XX': XX, 'XY': XY, 'YY': YY}
+        else:
+            stats = self.classes[clss]
+            stats['XX'] += XX
+            stats['XY'] += XY
+            stats['YY'] += YY
+
+    def update_batch(self, C, X, Y):
+        # Add examples of several classes, given by C, with one batched product for all the classes: the examples
+        # of each class are padded with zero rows, which do not change the statistics
+        if X.size()[0] == 0:
+            return
+        C = C.reshape(-1).to(X.device).long()
+        X = X.reshape(X.size()[0], -1).to(torch.float64)
+        Y = Y.reshape(Y.size()[0], -1).to(device=X.device, dtype=torch.float64)
+        X = torch.cat((X, torch.ones((X.size()[0], 1), dtype=torch.float64, device=X.device)), dim=1)
+        C, order = torch.sort(C)
+        classes, counts = torch.unique_consecutive(C, return_counts=True)
+        group = torch.repeat_interleave(torch.arange(len(classes), device=X.device), counts)
+        position = torch.arange(len(C), device=X.device) - (torch.cumsum(counts, 0) - counts)[group]
+        max_count = int(counts.max().item())
+        X_pad = torch.zeros((len(classes), max_count, X.size()[1]), dtype=torch.float64, device=X.device)
+        Y_pad = torch.zeros((len(classes), max_count, Y.size()[1]), dtype=torch.float64, device=X.device)
+        X_pad[group, position] = X[order]
+        Y_pad[group, position] = Y[order]
+        X_pad_t = X_pad.transpose(1, 2)
+        XX = torch.bmm(X_pad_t, X_pad)
+        XY = torch.bmm(X_pad_t, Y_pad)
+        YY = torch.bmm(Y_pad.transpose(1, 2), Y_pad)
+        for k, clss in enumerate(classes.tolist()):
+            if clss not in self.classes:
+                self.classes[clss] = {'XX': XX[k].clone(), 'XY': XY[k].clone(), 'YY': YY[k].clone()}
+            else:
+                stats = self.classes[clss]
+                stats['XX'] += XX[k]
+                stats['XY'] += XY[k]
+                stats['YY'] += YY[k]
+
+    @classmethod
+    def from_COXY(cls, COXY, chunk_size=65536):
+        # Statistics of the examples in COXY, computed in chunks to bound the float64 copies
+        stats = cls()
+        C = COXY['C'].view(-1)
+        for clss in torch.unique(C).tolist():
+            ids = torch.where(C == clss)[0]
+            for start in range(0, len(ids), chunk_size):
+                ids_chunk = ids[start:start + chunk_size]
+                stats.update(clss, COXY['X'][ids_chunk], COXY['Y'][ids_chunk])
+        return stats
+
+    def merge(self, other):
+        for clss, other_stats in other.classes.items():
+            if clss not in self.classes:
+                self.classes[clss] = {k: v.clone() for k, v in other_stats.items()}
+            else:
+                for k, v in other_stats.items():
+                    self.classes[clss][k] += v.to(self.classes[clss][k].device)
+        return self
+
+    def count(self, clss):
+        return int(self.classes[int(clss)]['XX'][-1, -1].item()) if int(clss) in self.classes else 0
+
+    def normalize(self, stats, target_norm=20):
+        # Statistics of the features normalized as in normalize_COXY, i.e. (X - mean) * (target_norm / mean_norm).
+        # The normalization is an affine map of the extended features, X' = X A, so X'ᵀX' = Aᵀ XᵀX A and X'ᵀY = Aᵀ XᵀY
+        normalized = RegressionStatistics()
+        scale = target_norm / stats['mean_norm'].item()
+        for clss, s in self.classes.items():
+            XX, XY = s['XX'], s['XY']
+            mean = stats['mean'].to(device=XX.device, dtype=torch.float64).view(1, -1)
+            A = torch.eye(XX.size()[0], dtype=torch.float64, device=XX.device) * scale
+            A[-1, -1] = 1
+            A[-1, :-1] = -scale * mean
+            normalized.classes[clss] = {'XX': torch.matmul(torch.matmul(torch.t(A), XX), A),
+                                        'XY': torch.matmul(torch.t(A), XY),
+                                        'YY': s['YY'].clone()}
+        return normalized
+
+    def to(self, device):
+        for clss, s in self.classes.items():
+            self.classes[clss] = {k: v.to(device) for k, v in s.items()}
+        return self
+
+    def save(self, path):
+        torch.save({clss: {k: v.cpu() for k, v in s.items()} for clss, s in self.classes.items()}, path)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        stats = cls()
+        stats.classes = {int(clss): {k: v.to(device) for k, v in s.items()} for clss, s in torch.load(path).items()}
+        return stats
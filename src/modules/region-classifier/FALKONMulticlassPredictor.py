@@ -0,0 +1,91 @@
+import torch
+
+
+# Class used to evaluate several FALKON models with a single Gaussian kernel computation
+
+class FALKONMulticlassPredictor():
+    def __init__(self, centers, alpha, sigma, missing, missing_value=-2, max_kernel_elements=2**26):
+        # Nystrom centers of all the models, already divided by sigma (M x D)
+        self.centers = centers
+        # Stacked coefficients, one column per model (M x C)
+        self.alpha = alpha
+        self.sigma = sigma
+        # Columns whose model is not available
+        self.missing = missing
+        self.has_missing = bool(missing.any())
+        self.missing_value = missing_value
+        self.num_classes = len(missing)
+        self.centers_sq_norm = None
+        if self.centers is not None:
+            self.centers_sq_norm = torch.sum(self.centers * self.centers, dim=1)
+            # Rows of X processed at once, so that the kernel block does not exceed max_kernel_elements
+            self.chunk_size = max(1, max_kernel_elements // max(1, self.centers.size()[0]))
+
+    @classmethod
+    def from_models(cls, models, missing_value=-2, deduplicate=True, device=None, max_kernel_elements=2**26):
+        # Convert a list of FALKON models, as returned by OnlineRegionClassifier.trainWithMinibootstrap,
+        # into a single multi-class predictor. None models are mapped to columns filled with missing_value
+        if isinstance(models, cls):
+            return models.to(device) if device is not None else models
+        missing = torch.tensor([model is None for model in models], dtype=torch.bool)
+        trained = [model for model in models if model is not None]
+        if len(trained) == 0:
+            return cls(None, None, None, missing.to(device) if device is not None else missing, missing_value=missing_value, max_kernel_elements=max_kernel_elements)
+
+        if device is None:
+            device = trained[0].ny_points_.device
+        sigma = torch.as_tensor(trained[0].kernel.sigma).flatten().to(device)
+        for model in trained[1:]:
+            if not torch.equal(torch.as_tensor(model.kernel.sigma).flatten().to(device), sigma):
+                raise ValueError('All the FALKON models must share the same kernel to be stacked')
+
+        # Stack the centers and build a block diagonal coefficients matrix
+        centers = torch.cat([model.ny_points_.to(device) for model in trained], dim=0)
+        alpha = torch.zeros((centers.size()[0], len(models)), dtype=centers.dtype, device=device)
+        start = 0
+        for c, model in enumerate(models):
+            if model is None:
+                continue
+            num_centers = model.ny_points_.size()[0]
+            alpha[start:start + num_centers, c] = model.alpha_.to(device).view(-1)
+            start += num_centers
+
+        # Centers shared by several models are evaluated only once
+        if deduplicate:
+            centers, inverse = torch.unique(centers, dim=0, return_inverse=True)
+            alpha = torch.zeros((centers.size()[0], len(models)), dtype=alpha.dtype, device=device).index_add_(0, inverse, alpha)
+
+        return cls(centers / sigma.to(centers.dtype), alpha, sigma, missing.to(device), missing_value=missing_value, max_kernel_elements=max_kernel_elements)
+
+    def __len__(self):
+        return self.num_classes
+
+    def to(self, device):
+        if self.centers is not None:
+            self.centers = self.centers.to(device)
+            self.centers_sq_norm = self.centers_sq_norm.to(device)
+            self.alpha = self.alpha.to(device)
+            self.sigma = self.sigma.to(device)
+        self.missing = self.missing.to(device)
+        return self
+
+    def kernel(self, X):
+        # Gaussian kernel between the (already scaled) rows of X and the Nystrom centers
+        distances = torch.addmm(self.centers_sq_norm.view(1, -1), X, torch.t(self.centers), alpha=-2)
+        distances += torch.sum(X * X, dim=1, keepdim=True)
+        return distances.clamp_(min=0).mul_(-0.5).exp_()
+
+    def predict(self, X, out=None):
+        # Compute the (N x C) scores matrix. If out is given, scores are written in it (it can be a strided view)
+        if out is None:
+            out = torch.empty((X.size()[0], self.num_classes), dtype=X.dtype, device=X.device)
+        if self.centers is None:
+            out.fill_(self.missing_value)
+            return out
+        X = X.to(self.centers.dtype) / self.sigma.to(self.centers.dtype)
+        for start in range(0, X.size()[0], self.chunk_size):
+            end = min(start + self.chunk_size, X.size()[0])
+            out[start:end] = torch.matmul(self.kernel(X[start:end]), self.alpha)
+        if self.has_missing:
+            out[:, self.missing] = self.missing_value
+        return out
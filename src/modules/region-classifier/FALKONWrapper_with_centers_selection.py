@@ -7,11 +7,14 @@ import ClassifierAbstract as ca
 import torch
 import yaml
 
-import copy
+import inspect
 
-from MyCenterSelector import MyCenterSelector
+from MyCenterSelector import MyCenterSelector, FixedCenterSelector
 from falkon.options import *
 
+# Conjugate gradient can be warm-started only by recent versions of FALKON
+FIT_WARM_START = 'warm_start' in inspect.signature(Falkon.fit).parameters
+
 
 class FALKONWrapper(ca.ClassifierAbstract):
     def __init__(self, cfg_path=None, is_rpn=False, is_segmentation=False):
@@ -38,8 +41,14 @@ class FALKONWrapper(ca.ClassifierAbstract):
 
         self.kernel = None
         self.nyst_centers = opts['M']
+        # If True, models are refitted from the previous model of the class, keeping its Nystrom centers
+        # and starting conjugate gradient from its solution, with at most refit_maxiter iterations
+        self.incremental = opts.get('incremental', False)
+        self.refit_maxiter = opts.get('refit_maxiter', None)
+        # If True, FALKON never uses the gpu (e.g. in forked training processes)
+        self.use_cpu = False
 
-    def train(self, X, y, sigma=None, lam=None):
+    def train(self, X, y, sigma=None, lam=None, warm_model=None):
         # Set sigma and lambda
         if sigma is None:
             sigma = self.sigma
@@ -47,26 +56,43 @@ class FALKONWrapper(ca.ClassifierAbstract):
             lam = self.lam
         # Initialize kernel
         self.kernel = kernels.GaussianKernel(sigma=sigma)
-        # Compute indices of nystrom centers
-        indices = self.compute_indices_selection(y)
-        center_selector = MyCenterSelector(indices)
-        opt = FalkonOptions(min_cuda_iter_size_32=0, min_cuda_iter_size_64=0,  keops_active="no")
+        warm_start = None
+        falkon_args = {}
+        if self.incremental and warm_model is not None and len(warm_model.ny_points_) == self.nyst_centers:
+            # The new cache has enough samples for the same number of centers, so the previous ones are kept
+            center_selector = FixedCenterSelector(warm_model.ny_points_)
+            M = len(warm_model.ny_points_)
+            if FIT_WARM_START and getattr(warm_model, 'beta_', None) is not None:
+                warm_start = warm_model.beta_.to(X.device)
+                if self.refit_maxiter is not None:
+                    falkon_args['maxiter'] = self.refit_maxiter
+        else:
+            # Compute indices of nystrom centers
+            indices = self.compute_indices_selection(y)
+            center_selector = MyCenterSelector(indices)
+            M = len(indices)
+        opt = FalkonOptions(min_cuda_iter_size_32=0, min_cuda_iter_size_64=0,  keops_active="no", use_cpu=self.use_cpu)
         # Initialize FALKON model
         self.model = Falkon(
             kernel=self.kernel,
             penalty=lam,
-            M=len(indices),
+            M=M,
             center_selection = center_selector,
-            options=opt
+            options=opt,
+            **falkon_args
         )
         # Train FALKON model
         if self.model is not None:
-            self.model.fit(X, y)
+            if warm_start is not None:
+                self.model.fit(X, y, warm_start=warm_start)
+            else:
+                self.model.fit(X, y)
         else:
             print('Model is None in trainRegionClassifier function')
             sys.exit(0)
 
-        return copy.deepcopy(self.model)
+        # A new model is built at each call, so the fitted one can be returned without copying it
+        return self.model
 
     def predict(self, model, X_np, y=None):
         # Predict values
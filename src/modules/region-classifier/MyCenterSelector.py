@@ -12,3 +12,16 @@ class MyCenterSelector():
             return X[self.center_indices, :].squeeze()
         else:
             return X[self.center_indices, :].squeeze(), Y[self.center_indices, :]
+
+
+class FixedCenterSelector():
+    # Center selector returning the given Nystrom centers, e.g. the ones of a previous model
+    def __init__(self, centers):
+        self.centers = centers
+    def select(self, X, Y, M):
+        if M != len(self.centers):
+            raise ValueError("Predefined centers are not `M` (found %d expected %d)" %
+                             (len(self.centers), M))
+        if Y is not None:
+            raise ValueError("Labels of the predefined centers are not available")
+        return self.centers.to(X.device)
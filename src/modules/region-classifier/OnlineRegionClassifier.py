@@ -7,6 +7,7 @@ sys.path.append(os.path.abspath(os.path.join(basedir, os.path.pardir, os.path.pa
 
 import RegionClassifierAbstract as rcA
 from py_od_utils import computeFeatStatistics
+from FALKONMulticlassPredictor import FALKONMulticlassPredictor
 import numpy as np
 import torch
 from maskrcnn_benchmark.structures.bounding_box import BoxList
@@ -14,6 +15,28 @@ import time
 
 import yaml
 import copy
+import multiprocessing
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+# Classifier and features used by the training processes. They are inherited through fork, so that
+# the features are shared with the parent process instead of being pickled
+_pool_trainer = None
+_pool_features = None
+
+
+def _init_pool_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _train_class_in_pool(i):
+    positives, negatives = _pool_features
+    return i, _pool_trainer.trainClass(i, positives[i], negatives[i])
 
 
 class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
@@ -29,12 +52,17 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
                 self.sigma = self.cfg['ONLINE_REGION_CLASSIFIER']['CLASSIFIER']['sigma']
                 self.hard_tresh = self.cfg['ONLINE_REGION_CLASSIFIER']['MINIBOOTSTRAP']['HARD_THRESH']
                 self.easy_tresh = self.cfg['ONLINE_REGION_CLASSIFIER']['MINIBOOTSTRAP']['EASY_THRESH']
+                minibootstrap_cfg = self.cfg['ONLINE_REGION_CLASSIFIER']['MINIBOOTSTRAP']
             else:
                 self.classifier_options = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']
                 self.lam = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']['lambda']
                 self.sigma = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']['sigma']
                 self.hard_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['HARD_THRESH']
                 self.easy_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['EASY_THRESH']
+                minibootstrap_cfg = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']
+            # Number of processes training different classes in parallel. Processes can't use the gpu, so classes
+            # are trained in parallel by default only when FALKON would run on the cpu anyway
+            self.num_workers = minibootstrap_cfg.get('NUM_WORKERS', 1 if torch.cuda.is_available() else available_cores())
             self.mean = 0
             self.std = 0
             self.mean_norm = 0
@@ -76,9 +104,12 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
             self.lam = opts['lam']
         if 'sigma' in opts:
             self.sigma = opts['sigma']
+        if 'num_workers' in opts:
+            self.num_workers = opts['num_workers']
 
 
-    def updateModel(self, cache):
+    def updateModel(self, cache, warm_model=None):
+        # warm_model is the previous model of the class, used by the classifier for incremental refits
         X_neg = cache['neg']
         X_pos = cache['pos']
         num_neg = len(X_neg)
@@ -88,58 +119,84 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
 
         if self.sigma is not None and self.lam is not None:
             print('Updating model with lambda: {} and sigma: {}'.format(self.lam, self.sigma))
-            return self.classifier.train(X, y, sigma=self.sigma, lam=self.lam)
+            return self.classifier.train(X, y, sigma=self.sigma, lam=self.lam, warm_model=warm_model)
         else:
             print('Updating model with default lambda and sigma')
-            return self.classifier.train(X, y)
+            return self.classifier.train(X, y, warm_model=warm_model)
 
-    def trainWithMinibootstrap(self, negatives, positives, output_dir=None):
-        caches = []
-        model = []
+    def trainClass(self, i, positives, negatives):
+        # Train the classifier of the i-th class with minibootstrap over its batches of negatives.
+        # Returns the model and the training time
         t = time.time()
-        for i in range(self.num_classes-1):
-            if (len(positives[i]) != 0) & (len(negatives[i]) != 0):
-                print('---------------------- Training Class number {} ----------------------'.format(i))
-                first_time = True
-                for j in range(len(negatives[i])):
-                    t_iter = time.time()
-                    if first_time:
-                        dataset = {}
-                        dataset['pos'] = positives[i].cpu()
-                        dataset['neg'] = negatives[i][j].cpu()
-                        caches.append(dataset)
-                        model.append(None)
-                        first_time = False
-                    else:
-                        t_hard = time.time()
-                        neg_pred = self.classifier.predict(model[i], negatives[i][j].cpu())
-                        hard_idx = torch.where(neg_pred > self.hard_tresh)[0]
-                        caches[i]['neg'] = torch.cat((caches[i]['neg'], negatives[i][j][hard_idx].cpu()), 0)
-                        print('Hard negatives selected in {} seconds'.format(time.time() - t_hard))
-                        print('Chosen {} hard negatives from the {}th batch'.format(len(hard_idx), j))
-
-                    print('Traning with {} positives and {} negatives'.format(len(caches[i]['pos']), len(caches[i]['neg'])))
-                    t_update = time.time()
-                    model[i] = self.updateModel(caches[i])
-                    print('Model updated in {} seconds'.format(time.time() - t_update))
-
-                    t_easy = time.time()
-                    if len(caches[i]['neg']) != 0:
-                        neg_pred = self.classifier.predict(model[i], caches[i]['neg'])
-                        keep_idx = torch.where(neg_pred >= self.easy_tresh)[0]
-                        easy_idx = len(caches[i]['neg']) - len(keep_idx)
-                        caches[i]['neg'] = caches[i]['neg'][keep_idx]
-                        print('Easy negatives selected in {} seconds'.format(time.time() - t_easy))
-                        print('Removed {} easy negatives. {} Remaining'.format(easy_idx, len(caches[i]['neg'])))
-                        print('Iteration {}th done in {} seconds'.format(j, time.time() - t_iter))
-                    # Delete cache of the i-th classifier if it is the last iteration to free memory
-                    if j == len(negatives[i]) - 1:
-                        caches[i] = None
-                        torch.cuda.empty_cache()
+        print('---------------------- Training Class number {} ----------------------'.format(i))
+        model = None
+        for j in range(len(negatives)):
+            t_iter = time.time()
+            if j == 0:
+                cache = {}
+                cache['pos'] = positives.cpu()
+                cache['neg'] = negatives[j].cpu()
             else:
-                model.append(None)
-                dataset = {}
-                caches.append(dataset)
+                t_hard = time.time()
+                neg_pred = self.classifier.predict(model, negatives[j].cpu())
+                hard_idx = torch.where(neg_pred > self.hard_tresh)[0]
+                cache['neg'] = torch.cat((cache['neg'], negatives[j][hard_idx].cpu()), 0)
+                print('Hard negatives selected in {} seconds'.format(time.time() - t_hard))
+                print('Chosen {} hard negatives from the {}th batch'.format(len(hard_idx), j))
+
+            print('Traning with {} positives and {} negatives'.format(len(cache['pos']), len(cache['neg'])))
+            t_update = time.time()
+            model = self.updateModel(cache, warm_model=model)
+            print('Model updated in {} seconds'.format(time.time() - t_update))
+
+            t_easy = time.time()
+            if len(cache['neg']) != 0:
+                neg_pred = self.classifier.predict(model, cache['neg'])
+                keep_idx = torch.where(neg_pred >= self.easy_tresh)[0]
+                easy_idx = len(cache['neg']) - len(keep_idx)
+                cache['neg'] = cache['neg'][keep_idx]
+                print('Easy negatives selected in {} seconds'.format(time.time() - t_easy))
+                print('Removed {} easy negatives. {} Remaining'.format(easy_idx, len(cache['neg'])))
+                print('Iteration {}th done in {} seconds'.format(j, time.time() - t_iter))
+        # Delete the cache of the classifier to free memory
+        cache = None
+        torch.cuda.empty_cache()
+        return model, time.time() - t
+
+    def trainInPool(self, classes, negatives, positives, num_workers):
+        # Train the given classes with a pool of processes. Workers are forked, so that they access the
+        # features of the parent process without copying them, and they run FALKON on the cpu, since cuda
+        # can't be used in a forked process
+        global _pool_trainer, _pool_features
+        trainer = copy.copy(self)
+        trainer.positives = None
+        trainer.negatives = None
+        trainer.classifier = copy.copy(self.classifier)
+        trainer.classifier.use_cpu = True
+        _pool_trainer = trainer
+        # Features can be on the gpu, so the ones of the classes to train are moved to the cpu before forking
+        positives = {i: positives[i].cpu() for i in classes}
+        negatives = {i: [n.cpu() for n in negatives[i]] for i in classes}
+        _pool_features = (positives, negatives)
+        try:
+            num_threads = max(1, available_cores() // num_workers)
+            with multiprocessing.get_context('fork').Pool(num_workers, initializer=_init_pool_worker, initargs=(num_threads,)) as pool:
+                results = dict(pool.imap_unordered(_train_class_in_pool, classes))
+        finally:
+            _pool_trainer = None
+            _pool_features = None
+        return results
+
+    def trainWithMinibootstrap(self, negatives, positives, output_dir=None):
+        t = time.time()
+        classes = [i for i in range(self.num_classes-1) if (len(positives[i]) != 0) & (len(negatives[i]) != 0)]
+        num_workers = min(self.num_workers, len(classes))
+        if num_workers > 1:
+            print('Training {} classes with {} processes'.format(len(classes), num_workers))
+            results = self.trainInPool(classes, negatives, positives, num_workers)
+        else:
+            results = {i: self.trainClass(i, positives[i], negatives[i]) for i in classes}
+        model = [results[i][0] if i in results else None for i in range(self.num_classes-1)]
 
         training_time = time.time() - t
         print('Online Classifier trained in {} seconds'.format(training_time))
@@ -152,6 +209,10 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
         elif output_dir and not self.is_rpn and not self.is_segmentation:
             with open(os.path.join(output_dir, "result.txt"), "a") as fid:
                 fid.write("Detector's Online Classifier training time: {}min:{}s \n".format(int(training_time/60), round(training_time%60)))
+        if output_dir:
+            with open(os.path.join(output_dir, "result.txt"), "a") as fid:
+                for i in classes:
+                    fid.write("    Class {} training time: {}min:{}s \n".format(i, int(results[i][1]/60), round(results[i][1]%60)))
         return model
 
     def trainRegionClassifier(self, opts=None, output_dir=None):
@@ -179,40 +240,60 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
         model = self.trainWithMinibootstrap(negatives, positives, output_dir=output_dir)
         return model
 
-    def testRegionClassifier(self, model, test_boxes):
+    def prepareTesting(self, model, device='cuda'):
+        # Stack the models of all the classes on the device where the test features are, so that they are
+        # evaluated with a single kernel computation
+        self.fused_model = FALKONMulticlassPredictor.from_models(model, device=device)
+        self.fused_model_src = model
+
+        # Convert stats to gpu tensors for inference
+        self.mean = self.mean.to(device)
+        self.std = self.std.to(device)
+        self.mean_norm = self.mean_norm.to(device)
+
+    def scoreFeatures(self, model, X_test, out=None):
+        # Scores (N x num_classes) of the features of a set of proposals, computed on their device.
+        # The background column is set to -1
+        if getattr(self, 'fused_model_src', None) is not model:
+            self.prepareTesting(model, X_test.device)
+        if self.mean_norm != 0:
+           X_test = self.zScores(X_test)
+        if out is None:
+            out = torch.empty((X_test.size()[0], self.num_classes), dtype=X_test.dtype, device=X_test.device)
+        out[:, 0] = -1
+        self.fused_model.predict(X_test, out=out[:, 1:])
+        return out
+
+    def testRegionClassifier(self, model, test_boxes, block_size=2**16):
+        # The proposals of consecutive images are scored together, in blocks of at most block_size proposals
+        # (unless an image has more), and the scores are then split back into one BoxList for each image
         print('Online Region Classifier testing')
         predictions = []
         total_testing_time = 0
-        try:
-            for c in range(0, self.num_classes-1):
-                model[c].ny_points_ = model[c].ny_points_.to('cuda')
-                model[c].alpha_ = model[c].alpha_.to('cuda')
-        except:
-            pass
+        self.prepareTesting(model, 'cuda')
+        test_boxes_valid = [l for l in test_boxes if l is not None]
+        start = 0
+        while start < len(test_boxes_valid):
+            end = start + 1
+            num_proposals = len(test_boxes_valid[start]['feat'])
+            while end < len(test_boxes_valid) and num_proposals + len(test_boxes_valid[end]['feat']) <= block_size:
+                num_proposals += len(test_boxes_valid[end]['feat'])
+                end += 1
+            block = test_boxes_valid[start:end]
+            # Exclude ground-truth boxes
+            not_gt = [l['gt'].reshape(-1) == 0 for l in block]
+            X_test = np.concatenate([l['feat'][I] for l, I in zip(block, not_gt)])
 
-        # Convert stats to gpu tensors for inference
-        self.mean = self.mean.to('cuda')
-        self.std = self.std.to('cuda')
-        self.mean_norm = self.mean_norm.to('cuda')
-
-        for i in range(len(test_boxes)):
-            l = test_boxes[i]
-            if l is not None:
-                I = np.nonzero(l['gt'] == 0)
-                boxes = l['boxes'][I, :][0]
-                X_test = torch.tensor(l['feat'][I, :][0], device='cuda')
-                t0 = time.time()
-                if self.mean_norm != 0:
-                   X_test = self.zScores(X_test)
-                scores = - torch.ones((len(boxes), self.num_classes))
-                for c in range(0, self.num_classes-1):
-                    pred = self.classifier.predict(model[c], X_test)
-                    scores[:, c+1] = torch.squeeze(pred)
-
-                total_testing_time = total_testing_time + time.time() - t0
-                b = BoxList(torch.from_numpy(boxes), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
-                b.add_field("scores", scores.to('cpu'))
+            t0 = time.time()
+            X_test = torch.from_numpy(X_test).to('cuda')
+            scores = self.scoreFeatures(model, X_test).to('cpu')
+            total_testing_time = total_testing_time + time.time() - t0
+
+            for l, I, scores_i in zip(block, not_gt, scores.split([int(I.sum()) for I in not_gt])):
+                b = BoxList(torch.from_numpy(l['boxes'][I]), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
+                b.add_field("scores", scores_i)
                 predictions.append(b)
+            start = end
 
         avg_time = total_testing_time/len(test_boxes)
         print('Average image testing time: {} seconds.'.format(avg_time))
@@ -7,6 +7,7 @@ sys.path.append(os.path.abspath(os.path.join(basedir, os.path.pardir, os.path.pa
 
 import RegionClassifierAbstract as rcA
 from py_od_utils import computeFeatStatistics
+from FALKONMulticlassPredictor import FALKONMulticlassPredictor
 import numpy as np
 import torch
 from maskrcnn_benchmark.structures.bounding_box import BoxList
@@ -14,6 +15,8 @@ import time
 
 import yaml
 import copy
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 
 class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
@@ -29,12 +32,16 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
                 self.sigma = self.cfg['ONLINE_REGION_CLASSIFIER']['CLASSIFIER']['sigma']
                 self.hard_tresh = self.cfg['ONLINE_REGION_CLASSIFIER']['MINIBOOTSTRAP']['HARD_THRESH']
                 self.easy_tresh = self.cfg['ONLINE_REGION_CLASSIFIER']['MINIBOOTSTRAP']['EASY_THRESH']
+                minibootstrap_cfg = self.cfg['ONLINE_REGION_CLASSIFIER']['MINIBOOTSTRAP']
             else:
                 self.classifier_options = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']
                 self.lam = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']['lambda']
                 self.sigma = self.cfg['ONLINE_SEGMENTATION']['CLASSIFIER']['sigma']
                 self.hard_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['HARD_THRESH']
                 self.easy_tresh = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']['EASY_THRESH']
+                minibootstrap_cfg = self.cfg['ONLINE_SEGMENTATION']['MINIBOOTSTRAP']
+            # Maximum number of classes trained at the same time, each one on its own cuda stream
+            self.num_workers = minibootstrap_cfg.get('NUM_WORKERS', 1)
             self.mean = 0
             self.std = 0
             self.mean_norm = 0
@@ -83,9 +90,12 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
             self.return_caches = opts['return_caches']
         if 'normalized' in opts:
             self.normalized = opts['normalized']
+        if 'num_workers' in opts:
+            self.num_workers = opts['num_workers']
 
 
-    def updateModel(self, cache):
+    def updateModel(self, cache, warm_model=None):
+        # warm_model is the previous model of the class, used by the classifier for incremental refits
         X_neg = cache['neg']
         X_pos = cache['pos']
         num_neg = len(X_neg)
@@ -95,58 +105,98 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
 
         if self.sigma is not None and self.lam is not None:
             print('Updating model with lambda: {} and sigma: {}'.format(self.lam, self.sigma))
-            return self.classifier.train(X, y, sigma=self.sigma, lam=self.lam)
+            return self.classifier.train(X, y, sigma=self.sigma, lam=self.lam, warm_model=warm_model)
         else:
             print('Updating model with default lambda and sigma')
-            return self.classifier.train(X, y)
+            return self.classifier.train(X, y, warm_model=warm_model)
 
-    def trainWithMinibootstrap(self, negatives, positives, output_dir=None):
-        caches = []
-        model = []
+    def trainClass(self, i, positives, negatives):
+        # Train the classifier of the i-th class with minibootstrap over its batches of negatives.
+        # Returns the model, the cache (None unless return_caches is set) and the training time
         t = time.time()
-        for i in range(self.num_classes-1):
-            if (len(positives[i]) != 0) & (len(negatives[i]) != 0):
-                print('---------------------- Training Class number {} ----------------------'.format(i))
-                first_time = True
-                for j in range(len(negatives[i])):
-                    t_iter = time.time()
-                    if first_time:
-                        dataset = {}
-                        dataset['pos'] = positives[i]
-                        dataset['neg'] = negatives[i][j]
-                        caches.append(dataset)
-                        model.append(None)
-                        first_time = False
-                    else:
-                        t_hard = time.time()
-                        neg_pred = self.classifier.predict(model[i], negatives[i][j])
-                        hard_idx = torch.where(neg_pred > self.hard_tresh)[0]
-                        caches[i]['neg'] = torch.cat((caches[i]['neg'], negatives[i][j][hard_idx]), 0)
-                        print('Hard negatives selected in {} seconds'.format(time.time() - t_hard))
-                        print('Chosen {} hard negatives from the {}th batch'.format(len(hard_idx), j))
-
-                    print('Traning with {} positives and {} negatives'.format(len(caches[i]['pos']), len(caches[i]['neg'])))
-                    t_update = time.time()
-                    model[i] = self.updateModel(caches[i])
-                    print('Model updated in {} seconds'.format(time.time() - t_update))
-
-                    t_easy = time.time()
-                    if len(caches[i]['neg']) != 0 and not j == len(negatives[i]) - 1:
-                        neg_pred = self.classifier.predict(model[i], caches[i]['neg'])
-                        keep_idx = torch.where(neg_pred >= self.easy_tresh)[0]
-                        easy_idx = len(caches[i]['neg']) - len(keep_idx)
-                        caches[i]['neg'] = caches[i]['neg'][keep_idx]
-                        print('Easy negatives selected in {} seconds'.format(time.time() - t_easy))
-                        print('Removed {} easy negatives. {} Remaining'.format(easy_idx, len(caches[i]['neg'])))
-                        print('Iteration {}th done in {} seconds'.format(j, time.time() - t_iter))
-                    # Delete cache of the i-th classifier if it is the last iteration to free memory
-                    if j == len(negatives[i]) - 1 and not self.return_caches:
-                        caches[i] = None
-                        torch.cuda.empty_cache()
+        print('---------------------- Training Class number {} ----------------------'.format(i))
+        model = None
+        for j in range(len(negatives)):
+            t_iter = time.time()
+            if j == 0:
+                cache = {}
+                cache['pos'] = positives
+                cache['neg'] = negatives[j]
             else:
-                model.append(None)
-                dataset = {}
-                caches.append(dataset)
+                t_hard = time.time()
+                neg_pred = self.classifier.predict(model, negatives[j])
+                hard_idx = torch.where(neg_pred > self.hard_tresh)[0]
+                cache['neg'] = torch.cat((cache['neg'], negatives[j][hard_idx]), 0)
+                print('Hard negatives selected in {} seconds'.format(time.time() - t_hard))
+                print('Chosen {} hard negatives from the {}th batch'.format(len(hard_idx), j))
+
+            print('Traning with {} positives and {} negatives'.format(len(cache['pos']), len(cache['neg'])))
+            t_update = time.time()
+            model = self.updateModel(cache, warm_model=model)
+            print('Model updated in {} seconds'.format(time.time() - t_update))
+
+            t_easy = time.time()
+            if len(cache['neg']) != 0 and not j == len(negatives) - 1:
+                neg_pred = self.classifier.predict(model, cache['neg'])
+                keep_idx = torch.where(neg_pred >= self.easy_tresh)[0]
+                easy_idx = len(cache['neg']) - len(keep_idx)
+                cache['neg'] = cache['neg'][keep_idx]
+                print('Easy negatives selected in {} seconds'.format(time.time() - t_easy))
+                print('Removed {} easy negatives. {} Remaining'.format(easy_idx, len(cache['neg'])))
+                print('Iteration {}th done in {} seconds'.format(j, time.time() - t_iter))
+        # Delete the cache of the classifier to free memory
+        if not self.return_caches:
+            cache = None
+            torch.cuda.empty_cache()
+        return model, cache, time.time() - t
+
+    def classMemory(self, i, negatives, positives):
+        # Estimate of the gpu memory needed to train a class. Its cache holds the positives and at most two
+        # batches of negatives, and conjugate gradient allocates the kernel block between the n cached
+        # samples and the M Nystrom centers, besides the M x M preconditioner
+        n = len(positives[i]) + 2 * max(len(neg) for neg in negatives[i])
+        M = self.classifier.nyst_centers
+        return positives[i].element_size() * (n * positives[i].size()[1] + n * M + M * M)
+
+    def trainInStreams(self, classes, negatives, positives, num_workers):
+        # Train the given classes with a pool of threads, each one issuing its kernels on a different cuda stream,
+        # so that the training of several classes overlaps on the gpu
+        streams = queue.Queue()
+        for _ in range(num_workers):
+            streams.put(torch.cuda.Stream())
+
+        def train(i):
+            stream = streams.get()
+            try:
+                # The wrapper keeps the model being trained, so each class needs its own
+                trainer = copy.copy(self)
+                trainer.classifier = copy.copy(self.classifier)
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    result = trainer.trainClass(i, positives[i], negatives[i])
+                stream.synchronize()
+                return i, result
+            finally:
+                streams.put(stream)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return dict(executor.map(train, classes))
+
+    def trainWithMinibootstrap(self, negatives, positives, output_dir=None):
+        t = time.time()
+        classes = [i for i in range(self.num_classes-1) if (len(positives[i]) != 0) & (len(negatives[i]) != 0)]
+        num_workers = min(self.num_workers, len(classes))
+        if num_workers > 1 and hasattr(torch.cuda, 'mem_get_info'):
+            # Classes are trained in parallel only if they fit in the free memory
+            free_memory = torch.cuda.mem_get_info()[0]
+            num_workers = min(num_workers, int(free_memory // max(self.classMemory(i, negatives, positives) for i in classes)))
+        if num_workers > 1:
+            print('Training {} classes on {} cuda streams'.format(len(classes), num_workers))
+            results = self.trainInStreams(classes, negatives, positives, num_workers)
+        else:
+            results = {i: self.trainClass(i, positives[i], negatives[i]) for i in classes}
+        model = [results[i][0] if i in results else None for i in range(self.num_classes-1)]
+        caches = [results[i][1] if i in results else {} for i in range(self.num_classes-1)]
 
         training_time = time.time() - t
         print('Online Classifier trained in {} seconds'.format(training_time))
@@ -159,6 +209,10 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
         elif output_dir and not self.is_rpn and not self.is_segmentation:
             with open(os.path.join(output_dir, "result.txt"), "a") as fid:
                 fid.write("Detector's Online Classifier training time: {}min:{}s \n".format(int(training_time/60), round(training_time%60)))
+        if output_dir:
+            with open(os.path.join(output_dir, "result.txt"), "a") as fid:
+                for i in classes:
+                    fid.write("    Class {} training time: {}min:{}s \n".format(i, int(results[i][2]/60), round(results[i][2]%60)))
         if self.return_caches:
             self.caches = caches
         return model
@@ -185,34 +239,55 @@ class OnlineRegionClassifier(rcA.RegionClassifierAbstract):
         else:
             return model, self.caches
 
-    def testRegionClassifier(self, model, test_boxes):
+    def prepareTesting(self, model, device='cuda'):
+        # Stack the models of all the classes on the device where the test features are, so that they are
+        # evaluated with a single kernel computation
+        self.fused_model = FALKONMulticlassPredictor.from_models(model, device=device)
+        self.fused_model_src = model
+
+    def scoreFeatures(self, model, X_test, out=None):
+        # Scores (N x num_classes) of the features of a set of proposals, computed on their device.
+        # The background column is set to -1
+        if getattr(self, 'fused_model_src', None) is not model:
+            self.prepareTesting(model, X_test.device)
+        if self.mean_norm != 0:
+           X_test = self.zScores(X_test)
+        if out is None:
+            out = torch.empty((X_test.size()[0], self.num_classes), dtype=X_test.dtype, device=X_test.device)
+        out[:, 0] = -1
+        self.fused_model.predict(X_test, out=out[:, 1:])
+        return out
+
+    def testRegionClassifier(self, model, test_boxes, block_size=2**16):
+        # The proposals of consecutive images are scored together, in blocks of at most block_size proposals
+        # (unless an image has more), and the scores are then split back into one BoxList for each image
         print('Online Region Classifier testing')
         predictions = []
         total_testing_time = 0
-        try:
-            for c in range(0, self.num_classes-1):
-                model[c].ny_points_ = model[c].ny_points_.to('cuda')
-                model[c].alpha_ = model[c].alpha_.to('cuda')
-        except:
-            pass
-        for i in range(len(test_boxes)):
-            l = test_boxes[i]
-            if l is not None:
-                I = np.nonzero(l['gt'] == 0)
-                boxes = l['boxes'][I, :][0]
-                X_test = torch.tensor(l['feat'][I, :][0], device='cuda')
-                t0 = time.time()
-                if self.mean_norm != 0:
-                   X_test = self.zScores(X_test)
-                scores = - torch.ones((len(boxes), self.num_classes))
-                for c in range(0, self.num_classes-1):
-                    pred = self.classifier.predict(model[c], X_test)
-                    scores[:, c+1] = torch.squeeze(pred)
-
-                total_testing_time = total_testing_time + time.time() - t0
-                b = BoxList(torch.from_numpy(boxes), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
-                b.add_field("scores", scores.to('cpu'))
+        self.prepareTesting(model, 'cuda')
+        test_boxes_valid = [l for l in test_boxes if l is not None]
+        start = 0
+        while start < len(test_boxes_valid):
+            end = start + 1
+            num_proposals = len(test_boxes_valid[start]['feat'])
+            while end < len(test_boxes_valid) and num_proposals + len(test_boxes_valid[end]['feat']) <= block_size:
+                num_proposals += len(test_boxes_valid[end]['feat'])
+                end += 1
+            block = test_boxes_valid[start:end]
+            # Exclude ground-truth boxes
+            not_gt = [l['gt'].reshape(-1) == 0 for l in block]
+            X_test = np.concatenate([l['feat'][I] for l, I in zip(block, not_gt)])
+
+            t0 = time.time()
+            X_test = torch.from_numpy(X_test).to('cuda')
+            scores = self.scoreFeatures(model, X_test).to('cpu')
+            total_testing_time = total_testing_time + time.time() - t0
+
+            for l, I, scores_i in zip(block, not_gt, scores.split([int(I.sum()) for I in not_gt])):
+                b = BoxList(torch.from_numpy(l['boxes'][I]), (l['img_size'][0], l['img_size'][1]), mode="xyxy")
+                b.add_field("scores", scores_i)
                 predictions.append(b)
+            start = end
 
         avg_time = total_testing_time/len(test_boxes)
         print('Average image testing time: {} seconds.'.format(avg_time))
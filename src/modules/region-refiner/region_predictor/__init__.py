@@ -1 +1,2 @@
-from .predict_regions import RegionPredictor
\ No newline at end of file
+from .predict_regions import RegionPredictor
+from .stacked_regressors import StackedRegressors, decode_boxes
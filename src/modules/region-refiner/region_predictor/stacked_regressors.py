@@ -0,0 +1,89 @@
+import numpy as np
+import torch
+
+
+# Class used to apply the RLS regressors of all the classes with a single matrix product
+
+class StackedRegressors():
+    def __init__(self, weights, bias, available):
+        # Weights of all the classes, with T_inv already applied (D x 4C)
+        self.weights = weights
+        # Bias of all the classes, with T_inv and mu already applied (4C)
+        self.bias = bias
+        # Classes whose regressor is available
+        self.available = available
+        self.num_classes = len(available)
+
+    @classmethod
+    def from_models(cls, models, device='cuda'):
+        # Compile the regressors returned by RegionRefinerTrainer into stacked tensors. For each class c the
+        # prediction (x * W_c + b_c) * T_inv_c + mu_c is rewritten as x * (W_c * T_inv_c) + (b_c * T_inv_c + mu_c).
+        # Classes without a regressor predict null deltas, which leave the boxes unchanged with the box coder of the
+        # heads. Their availability is kept in available, since decode_boxes does not invert null deltas exactly
+        if isinstance(models, cls):
+            return models.to(device)
+        available = torch.tensor([model['Beta'] is not None for model in models], dtype=torch.bool)
+        feat_size = None
+        for model in models:
+            if model['Beta'] is not None:
+                feat_size = model['Beta']['0']['weights'].numel() - 1
+                break
+        if feat_size is None:
+            return cls(None, torch.zeros(4 * len(models), device=device), available.to(device))
+
+        stacked = torch.zeros((len(models), feat_size + 1, 4), dtype=torch.float32, device=device)
+        T_inv = torch.zeros((len(models), 4, 4), dtype=torch.float32, device=device)
+        mu = torch.zeros((len(models), 4), dtype=torch.float32, device=device)
+        for c, model in enumerate(models):
+            if model['Beta'] is None:
+                continue
+            stacked[c] = torch.stack([model['Beta'][str(k)]['weights'].to(device).view(-1) for k in range(4)], dim=1)
+            T_inv[c] = model['T_inv'].to(device)
+            mu[c] = model['mu'].to(device)
+
+        stacked = torch.bmm(stacked, T_inv)
+        weights = stacked[:, :-1].permute(1, 0, 2).reshape(feat_size, 4 * len(models)).contiguous()
+        bias = (stacked[:, -1] + mu).view(-1)
+        return cls(weights, bias, available.to(device))
+
+    def __len__(self):
+        return self.num_classes
+
+    def to(self, device):
+        if self.weights is not None:
+            self.weights = self.weights.to(device)
+        self.bias = self.bias.to(device)
+        self.available = self.available.to(device)
+        return self
+
+    def predict(self, features, out=None):
+        # Compute the (N x 4C) deltas matrix. If out is given, deltas are written in it (it can be a strided view)
+        if self.weights is None:
+            deltas = self.bias.expand(features.size()[0], -1)
+        else:
+            deltas = torch.addmm(self.bias, features, self.weights)
+        if out is None:
+            return deltas.contiguous()
+        out.copy_(deltas)
+        return out
+
+
+def decode_boxes(ex_box, deltas, img_width, img_height, out=None):
+    # Apply the (N x C x 4) deltas to the (N x 4) example boxes and clip the results to the image
+    src_w = ex_box[:, 2] - ex_box[:, 0] + np.spacing(1)
+    src_h = ex_box[:, 3] - ex_box[:, 1] + np.spacing(1)
+    src_ctr_x = ex_box[:, 0] + 0.5 * src_w
+    src_ctr_y = ex_box[:, 1] + 0.5 * src_h
+
+    pred_ctr_x = deltas[:, :, 0] * src_w[:, None] + src_ctr_x[:, None]
+    pred_ctr_y = deltas[:, :, 1] * src_h[:, None] + src_ctr_y[:, None]
+    pred_w = torch.exp(deltas[:, :, 2]) * src_w[:, None]
+    pred_h = torch.exp(deltas[:, :, 3]) * src_h[:, None]
+
+    if out is None:
+        out = torch.empty_like(deltas)
+    out[:, :, 0] = torch.clamp(pred_ctr_x - 0.5 * pred_w, min=0)
+    out[:, :, 1] = torch.clamp(pred_ctr_y - 0.5 * pred_h, min=0)
+    out[:, :, 2] = torch.clamp(pred_ctr_x + 0.5 * pred_w - 1, max=img_width - 1)
+    out[:, :, 3] = torch.clamp(pred_ctr_y + 0.5 * pred_h - 1, max=img_height - 1)
+    return out
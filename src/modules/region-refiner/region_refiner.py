@@ -27,10 +27,14 @@ class RegionRefiner(RegionRefinerAbstract):
     def testRegionRefiner(self):
         return
 
-    def predict(self, boxes, features, models=None, normalize_features=False, stats=None):
+    def getPredictor(self, models=None):
+        # The predictor stacks the regressors once, so it can be reused to refine the boxes of many images
         if models is None:
-            predictor = RegionPredictor(self.cfg, self.models)
+            return RegionPredictor(self.cfg, self.models)
         else:
-            predictor = RegionPredictor(self.cfg, models)
+            return RegionPredictor(self.cfg, models)
+
+    def predict(self, boxes, features, models=None, normalize_features=False, stats=None):
+        predictor = self.getPredictor(models)
         refined_regions = predictor(boxes, features, normalize_features=normalize_features, stats=stats)
         return refined_regions
@@ -10,16 +10,19 @@ sys.path.append(os.path.abspath(os.path.join(basedir, os.path.pardir, os.path.pa
 sys.path.append(os.path.abspath(os.path.join(basedir, os.path.pardir, os.path.pardir, os.path.pardir)))
 
 
+from mrcnn_modified.utils.regression_statistics import RegressionStatistics
+
+
 class RegionRefinerTrainer():
     def __init__(self, cfg, lmbd, is_rpn):
         self.cfg = cfg
         self.lambd = lmbd
-        self.percentile = 0
-        self.COXY = None
+        self.stats = None
         self.is_rpn = is_rpn
 
     def __call__(self, COXY, output_dir=None):
-        self.COXY = COXY
+        # COXY can be either the regression examples or their RegressionStatistics, accumulated during the extraction
+        self.stats = COXY if isinstance(COXY, RegressionStatistics) else RegressionStatistics.from_COXY(COXY)
         models = self.train(output_dir=output_dir)
         return models
 
@@ -36,13 +39,35 @@ class RegionRefinerTrainer():
         models = np.empty((0))
 
         start_time = time.time()
+        # Classes are solved all together: their statistics are stacked and factorized with batched operations
+        counts = {i: self.stats.count(i) for i in range(start_index, num_clss)}
+        trained = [i for i in counts if counts[i] > 0]
+        if trained:
+            # Statistics of the features, extended with a bias column, and of the targets
+            XX = torch.stack([self.stats[i]['XX'] for i in trained])
+            XY = torch.stack([self.stats[i]['XY'] for i in trained])
+            YY = torch.stack([self.stats[i]['YY'] for i in trained])
+            n = torch.tensor([counts[i] for i in trained], device=XX.device, dtype=torch.float64)
+
+            # Center and decorrelate targets
+            mu = XY[:, -1] / n[:, None]
+            S = (YY - n[:, None, None] * mu[:, :, None] * mu[:, None, :]) / n[:, None, None]
+            D, W = torch.linalg.eigh(S)
+            W_t = W.transpose(1, 2)
+            T = torch.matmul(torch.matmul(W, torch.diag_embed(torch.sqrt(D + 0.001).pow_(-1))), W_t)
+            T_inv = torch.matmul(torch.matmul(W, torch.diag_embed(torch.sqrt(D + 0.001))), W_t)
+            # Statistics of the transformed targets (Y - mu) T. The last column of XX is the sum of the features
+            XY = torch.matmul(XY - XX[:, :, -1:] * mu[:, None, :], T)
+            YY = torch.matmul(torch.matmul(T.transpose(1, 2), n[:, None, None] * S), T)
+
+            Betas = self.solve(XX, XY, YY, n, self.lambd)
+            solved = {i: b for b, i in enumerate(trained)}
+
         for i in range(start_index, num_clss):
             print('Training regressor for class %s (%d/%d)' % (chosen_classes[i], i, num_clss - 1))
-            # Compute indices where bboxes of class i overlap with the ground truth
-            I = self.COXY['C'] == i
-            I = torch.where(I == True)[0]
-            print('Training with %i examples' %len(I))
-            if len(I) == 0:
+            # Number of examples where bboxes of class i overlap with the ground truth
+            print('Training with %i examples' % counts[i])
+            if counts[i] == 0:
                 models = np.append(models, {'mu': None,
                                             'T': None,
                                             'T_inv': None,
@@ -50,47 +75,15 @@ class RegionRefinerTrainer():
                                             })
                 print('No indices for class %s' % (chosen_classes[i]))
                 continue
-            # Extract the corresponding values in the X matrix
-            # Transpose is used to set the number of features as the number of columns (instead of the number of rows)
-            Xi = self.COXY['X'][I].type(torch.float64)
-            Yi = self.COXY['Y'][I].type(torch.float64)
-            # Add bias values to Xi
-            bias = torch.ones((Xi.size()[0], 1), dtype=torch.float64, device=Xi.device)
-            Xi = torch.cat((Xi, bias), dim=1)
-
-            # Center and decorrelate targets
-            mu = torch.mean(Yi, dim=0)
-            Yi -= mu
-            S = torch.matmul(torch.t(Yi), Yi) / Yi.size()[0]
-            D, W = torch.eig(S, eigenvectors=True)
-            D = D[:, 0]
-            T = torch.matmul(torch.matmul(W, torch.diag(torch.sqrt(D + 0.001).pow_(-1))), torch.t(W))
-            T_inv = torch.matmul(torch.matmul(W, torch.diag(torch.sqrt(D + 0.001))), torch.t(W))
-            Yi = torch.matmul(Yi, T)
-
-
-            Beta = self.solve(Xi, Yi, self.lambd)
-
-            if self.percentile > 0:
-                indices = []
-                for elem in Beta:
-                    losses_i = Beta[elem]['losses']
-                    threshold_i = np.percentile(losses_i.cpu(), self.percentile)
-                    indices_i = torch.where(losses_i > threshold_i)[0]
-                    indices.append(indices_i)
-                Beta = self.solve(Xi, Yi, self.lambd, Xi_test, Yi_test, indices)
-
+            b = solved[i]
             models = np.append(models, {
-                'mu': mu.to("cuda").type(torch.float32),
-                'T': T.to("cuda").type(torch.float32),
-                'T_inv': T_inv.to("cuda").type(torch.float32),
-                'Beta': Beta
+                'mu': mu[b].to("cuda").type(torch.float32),
+                'T': T[b].to("cuda").type(torch.float32),
+                'T_inv': T_inv[b].to("cuda").type(torch.float32),
+                'Beta': Betas[b]
             })
 
-            mean_losses = torch.empty(0, device=Xi.device, dtype=torch.float32)
-
-            for elem in models[i - start_index]['Beta']:
-                mean_losses = torch.cat((mean_losses, torch.mean(models[i - start_index]['Beta'][elem]['losses'], dim=0, keepdim=True)))
+            mean_losses = torch.cat([models[i - start_index]['Beta'][elem]['losses'] for elem in models[i - start_index]['Beta']])
             print('Mean losses:', mean_losses)
 
         end_time = time.time()
@@ -107,25 +100,17 @@ class RegionRefinerTrainer():
         return models
 
 
-    def solve(self, X, y, lmbd, X_test=None, Y_test=None, indices=None):
-        if indices is None:
-            X_transposed_X = torch.matmul(torch.t(X), X) + lmbd * torch.eye(X.size()[1], device=X.device, dtype=torch.float64)
-            R = torch.cholesky(X_transposed_X)
-        to_return = {}
-        X_original = X.clone()
-        y_original = y.clone()
-        for i in range(0, 4):
-            if indices is not None:
-                X = X_original[indices[i]]
-                y = y_original[indices[i]]
-                X_transposed_X = torch.matmul(torch.t(X), X) + lmbd * torch.eye(X.size()[1], device=X.device, dtype=torch.float64)
-                R = torch.cholesky(X_transposed_X)
-            y_torch_i = y[:, i]
-            z = torch.triangular_solve(torch.matmul(torch.t(X), y_torch_i).view(X.size()[1], 1), R, upper=False).solution
-            w = torch.triangular_solve(z, torch.t(R)).solution.view(X.size()[1])
-            losses = 0.5 * torch.pow((torch.matmul(X, w) - y_torch_i), 2)
-            to_return[str(i)] = {'weights': w.to('cuda').type(torch.float32),
-                                 'losses': losses.type(torch.float32)}
+    def solve(self, XX, XY, YY, n, lmbd):
+        # Ridge regression of the 4 targets of a batch of classes from their sufficient statistics, with a
+        # batched Cholesky factorization and a multi right-hand side solve
+        R = torch.linalg.cholesky(XX + lmbd * torch.eye(XX.size()[-1], device=XX.device, dtype=torch.float64))
+        w = torch.cholesky_solve(XY, R)
+        # Mean training loss of each target, 0.5 * mean((X w - y)^2), expanded in terms of the statistics
+        losses = 0.5 * ((torch.matmul(XX, w) * w).sum(dim=1) - 2 * (XY * w).sum(dim=1) + torch.diagonal(YY, dim1=1, dim2=2)) / n[:, None]
+        w = w.to('cuda').type(torch.float32)
+        losses = losses.type(torch.float32)
+        to_return = []
+        for b in range(len(w)):
+            to_return.append({str(i): {'weights': w[b, :, i],
+                                       'losses': losses[b, i:i + 1]} for i in range(0, 4)})
         return to_return
-
-
@@ -23,24 +23,18 @@ def computeFeatStatistics(positives, negatives, feature_folder, is_rpn, num_samp
         take_from_pos = math.ceil((num_samples/num_classes)*pos_fraction)
         take_from_neg = math.ceil(((num_samples/num_classes)*neg_fraction)/len(negatives[0]))
 
-        sampled_X = 0
-        ns = 0
-        for i in range(num_classes):
-            if len(positives[i]) != 0:
-                sampled_X = positives[i][0].cpu()
-                ns = np.transpose(np.linalg.norm(positives[i][0].cpu()))
+        # Samples are collected in a list and concatenated once
+        sampled_X = []
         for i in range(num_classes):
             if len(positives[i]) != 0:
                 pos_idx = np.random.randint(len(positives[i]), size=take_from_pos)
-                pos_picked = positives[i][pos_idx]
-                sampled_X = np.vstack((sampled_X, pos_picked.cpu()))
-                ns = np.vstack((ns, np.transpose(np.linalg.norm(pos_picked.cpu(), axis=1)[np.newaxis])))
+                sampled_X.append(positives[i][pos_idx].cpu().numpy())
             for j in range(len(negatives[i])):
                 if len(negatives[i][j]) != 0:
                     neg_idx = np.random.choice(len(negatives[i][j]), size=take_from_neg)
-                    neg_picked = negatives[i][j][neg_idx]
-                    sampled_X = np.vstack((sampled_X, neg_picked.cpu()))
-                    ns = np.vstack((ns, np.transpose(np.linalg.norm(neg_picked.cpu(), axis=1)[np.newaxis])))
+                    sampled_X.append(negatives[i][j][neg_idx].cpu().numpy())
+        sampled_X = np.concatenate(sampled_X)
+        ns = np.linalg.norm(sampled_X, axis=1)
 
         mean = np.mean(sampled_X, axis=0)
         std = np.std(sampled_X, axis=0)
@@ -66,20 +60,18 @@ def computeFeatStatistics_torch(positives, negatives, num_samples=4000, features
     num_classes = len(positives)
     take_from_pos = math.ceil((num_samples/num_classes)*pos_fraction)
     take_from_neg = math.ceil(((num_samples/num_classes)*neg_fraction)/len(negatives[0]))
-    sampled_X = torch.empty((0, features_dim), device=device)
-    ns = torch.empty((0,1), device=device)
+    # Samples are collected in a list and concatenated once
+    sampled_X = []
     for i in range(num_classes):
         if len(positives[i]) != 0:
             pos_idx = torch.randint(len(positives[i]), (take_from_pos,))
-            pos_picked = positives[i][pos_idx]
-            sampled_X = torch.cat((sampled_X, pos_picked))
-            ns = torch.cat((ns, torch.norm(pos_picked.view(-1, features_dim) , dim=1).view(-1,1)), dim=0)
+            sampled_X.append(positives[i][pos_idx].view(-1, features_dim).to(device))
         for j in range(len(negatives[i])):
             if len(negatives[i][j]) != 0:
                 neg_idx = torch.randint(len(negatives[i][j]), (take_from_neg,))
-                neg_picked = negatives[i][j][neg_idx]
-                sampled_X = torch.cat((sampled_X, neg_picked))
-                ns = torch.cat((ns, torch.norm(neg_picked.view(-1, features_dim) , dim=1).view(-1,1)), dim=0)
+                sampled_X.append(negatives[i][j][neg_idx].view(-1, features_dim).to(device))
+    sampled_X = torch.cat(sampled_X)
+    ns = torch.norm(sampled_X, dim=1)
 
     mean = torch.mean(sampled_X, dim=0)
     std = torch.std(sampled_X, dim=0)
@@ -89,6 +81,19 @@ def computeFeatStatistics_torch(positives, negatives, num_samples=4000, features
     return stats
 
 
+def load_feature_statistics(features_dir, pos_fraction=None):
+    # Statistics accumulated during the extraction and saved with the features, if any. They are the same
+    # returned by computeFeatStatistics_torch, without sampling the features again
+    from mrcnn_modified.utils.feature_statistics import FeatureStatistics, STATS_FILE
+    stats_path = os.path.join(features_dir, STATS_FILE)
+    if not os.path.exists(stats_path):
+        return None
+    feature_stats = FeatureStatistics.load(stats_path)
+    if feature_stats.is_empty():
+        return None
+    return feature_stats.compute(pos_fraction=pos_fraction)
+
+
 def zScores(feat, mean, mean_norm, target_norm=20):
     feat = torch.tensor(feat)
     feat = feat - mean
@@ -97,6 +102,10 @@ def zScores(feat, mean, mean_norm, target_norm=20):
 
 
 def normalize_COXY(COXY, stats, cpu=False):
+    from mrcnn_modified.utils.regression_statistics import RegressionStatistics
+    if isinstance(COXY, RegressionStatistics):
+        # The statistics of the normalized features are derived from the ones of the features
+        return COXY.normalize(stats)
     if cpu:
         COXY['X'] = COXY['X'] - stats['mean'].to('cpu')
     else:
@@ -111,7 +120,48 @@ def falkon_models_to_cuda(models):
             models[i].alpha_ = models[i].alpha_.to('cuda')
     return models
 
+def load_features_classifier_from_cache(features_dir, is_segm=False, cpu_tensor=False, sample_ratio=1):
+    from mrcnn_modified.utils.feature_cache import FeatureCache
+    cache = FeatureCache(features_dir)
+    device = 'cpu' if cpu_tensor else None
+    positives = []
+    negatives = []
+    for clss_id in range(cache.num_classes()):
+        # If there are not positives for this class, add an empty tensor
+        if 'positives_cl_{}'.format(clss_id) in cache:
+            name = 'positives_cl_{}'.format(clss_id)
+            if not cpu_tensor and sample_ratio < 1:
+                # Only the sampled rows are read from the cache
+                positives_i = cache.load_rows(name, torch.randint(cache.rows(name), (int(cache.rows(name)*sample_ratio),)).numpy(), device=device)
+            else:
+                positives_i = cache.load(name, device=device)
+            positives.append(positives_i)
+        else:
+            positives.append(torch.empty((0)))
+        if is_segm:
+            # If there are not negatives for this class, add an empty tensor
+            if 'negatives_cl_{}'.format(clss_id) in cache:
+                name = 'negatives_cl_{}'.format(clss_id)
+                if not cpu_tensor and sample_ratio < 1:
+                    # Only the sampled rows are read from the cache
+                    negatives_i = cache.load_rows(name, torch.randint(cache.rows(name), (int(cache.rows(name)*sample_ratio),)).numpy(), device=device)
+                else:
+                    negatives_i = cache.load(name, device=device)
+                negatives.append(negatives_i)
+            else:
+                negatives.append(torch.empty((0)))
+        else:
+            if 'negatives_cl_{}'.format(clss_id) in cache:
+                negatives.append(cache.load_batches('negatives_cl_{}'.format(clss_id), device=device))
+            else:
+                negatives.append([])
+
+    return positives, negatives
+
 def load_features_classifier(features_dir, is_segm=False, cpu_tensor=False, sample_ratio=1):
+    # Features saved in the feature cache are memory-mapped, instead of loading every batch
+    if os.path.exists(os.path.join(features_dir, 'index.json')):
+        return load_features_classifier_from_cache(features_dir, is_segm=is_segm, cpu_tensor=cpu_tensor, sample_ratio=sample_ratio)
     positives_to_load = len(glob.glob(os.path.join(features_dir, 'positives_*')))
     positives_loaded = 0
     negatives_to_load = len(glob.glob(os.path.join(features_dir, 'negatives_*')))
@@ -169,7 +219,46 @@ def load_features_classifier(features_dir, is_segm=False, cpu_tensor=False, samp
 
     return positives, negatives
 
+def load_features_regressor_from_cache(features_dir, samples_fraction=1.0):
+    from mrcnn_modified.utils.feature_cache import FeatureCache
+    cache = FeatureCache(features_dir)
+    if samples_fraction < 1.0:
+        X_list = []
+        C_list = []
+        Y_list = []
+        # Only the sampled rows of each batch are read from the mapped files
+        for X_i, C_i, Y_i in zip(cache.map_batches('reg_x'), cache.map_batches('reg_c'), cache.map_batches('reg_y')):
+            ind_i = torch.randperm(len(C_i))[:int(len(C_i)*samples_fraction)]
+            X_list.append(X_i[ind_i].to(device=cache.device('reg_x'), dtype=torch.float32))
+            C_list.append(C_i[ind_i].to(device=cache.device('reg_c'), dtype=torch.float32))
+            Y_list.append(Y_i[ind_i].to(device=cache.device('reg_y'), dtype=torch.float32))
+        COXY = {'C': torch.cat(C_list),
+                'O': None,
+                'X': torch.cat(X_list),
+                'Y': torch.cat(Y_list)
+                }
+    else:
+        # Entries are loaded by batch id, so that the rows of X, C and Y stay aligned
+        COXY = {'C': cache.load('reg_c'),
+                'O': None,
+                'X': cache.load('reg_x'),
+                'Y': cache.load('reg_y')
+                }
+    return COXY
+
+def load_regression_statistics(features_dir, device='cuda'):
+    # Statistics of the regression examples saved with the features, if any. They can replace COXY to train
+    # the region refiner
+    from mrcnn_modified.utils.regression_statistics import RegressionStatistics, REGRESSION_STATS_FILE
+    stats_path = os.path.join(features_dir, REGRESSION_STATS_FILE)
+    if not os.path.exists(stats_path):
+        return None
+    return RegressionStatistics.load(stats_path, device=device)
+
 def load_features_regressor(features_dir, samples_fraction=1.0):
+    # Features saved in the feature cache are memory-mapped, instead of loading every batch
+    if os.path.exists(os.path.join(features_dir, 'index.json')):
+        return load_features_regressor_from_cache(features_dir, samples_fraction=samples_fraction)
     reg_num_batches = len(glob.glob(os.path.join(features_dir, 'reg_x_*')))
     X_list = []
     C_list = []
@@ -194,6 +283,9 @@ def load_features_regressor(features_dir, samples_fraction=1.0):
     return COXY
 
 def load_positives_from_COXY(COXY, del_COXY=False):
+    from mrcnn_modified.utils.regression_statistics import RegressionStatistics
+    if isinstance(COXY, RegressionStatistics):
+        raise ValueError('Positives cannot be taken from regression statistics: extract features with REGRESSORS.KEEP_EXAMPLES set to True')
     positives = []
     num_classes = len(torch.unique(COXY['C']))
     for i in range(num_classes):
@@ -256,10 +348,8 @@ def mask_iou(mask_a, mask_b):
     """Calculate the Intersection of Unions (IoUs) between masks.
     IoU is calculated as a ratio of area of the intersection
     and area of the union.
-    This function accepts both :obj:`numpy.ndarray` and :obj:`cupy.ndarray` as
-    inputs. Please note that both :obj:`mask_a` and :obj:`mask_b` need to be
-    same type.
-    The output is same type as the type of the inputs.
+    Masks are cropped to the union of their bounding boxes and the intersections
+    of all the pairs are computed with a single matrix product.
     Args:
         mask_a (array): An array whose shape is :math:`(N, H, W)`.
             :math:`N` is the number of masks.
@@ -280,10 +370,22 @@ def mask_iou(mask_a, mask_b):
 
     n_mask_a = len(mask_a)
     n_mask_b = len(mask_b)
-    iou = np.empty((n_mask_a, n_mask_b), dtype=np.float32)
-    for n, m_a in enumerate(mask_a):
-        for k, m_b in enumerate(mask_b):
-            intersect = np.bitwise_and(m_a, m_b).sum()
-            union = np.bitwise_or(m_a, m_b).sum()
-            iou[n, k] = intersect / union
+    mask_a = np.asarray(mask_a) != 0
+    mask_b = np.asarray(mask_b) != 0
+
+    # Pixels outside the union of the bounding boxes of the masks are zero in every mask
+    rows = np.flatnonzero(mask_a.any(axis=(0, 2)) | mask_b.any(axis=(0, 2)))
+    cols = np.flatnonzero(mask_a.any(axis=(0, 1)) | mask_b.any(axis=(0, 1)))
+    if len(rows) > 0:
+        mask_a = mask_a[:, rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        mask_b = mask_b[:, rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    flat_a = mask_a.reshape(n_mask_a, mask_a.shape[1] * mask_a.shape[2])
+    flat_b = mask_b.reshape(n_mask_b, mask_b.shape[1] * mask_b.shape[2])
+
+    # Pixel counts are exact in float32 up to 2^24 pixels
+    dtype = np.float32 if flat_a.shape[1] < 2 ** 24 else np.float64
+    intersect = np.dot(flat_a.astype(dtype), flat_b.astype(dtype).T).astype(np.int64)
+    union = np.count_nonzero(flat_a, axis=1)[:, None] + np.count_nonzero(flat_b, axis=1)[None, :] - intersect
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = (intersect / union).astype(np.float32)
     return iou